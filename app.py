@@ -1,16 +1,41 @@
 # System libraries
 import asyncio
+from concurrent.futures import ThreadPoolExecutor
 import json
 import os
+import time
+from typing import Iterator
 # Third party libraries
+import numpy as np
 from telegram import Bot
 from openai import RateLimitError
 # Local libraries
+from data_access.cache.cache_client import make_cache_key, make_filter_key
 from data_access.vector.vector_filter import VectorFilter
+from embedding.Embeddings import instance as embeddor
 from MyLogger import logger
+from query_log import instance as query_log
 import startup
 import threading
-from search import search, llm
+from search import search, llm, llm_stream
+from single_flight import SingleFlight
+
+# Concurrent requests for the same query wait for a single search() / llm() instead of all running their own
+query_flight = SingleFlight("query")
+llm_flight = SingleFlight("llm")
+# Callers stop waiting for an in-flight computation after this many seconds, and compute the result themselves
+SINGLE_FLIGHT_TIMEOUT = 60
+
+# Stale-while-revalidate. Cached search results that are older than CACHE_QUERY_MAX_AGE seconds, or older than the last change to the
+# vector index (see scripts/process_tdps.py), are still served immediately, but are also recomputed by a small background worker
+CACHE_QUERY_MAX_AGE = int(os.getenv("CACHE_QUERY_MAX_AGE", 7*24*3600))
+MAX_PENDING_REFRESHES = 100
+refresh_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="refresh")
+refresh_pending:set[str] = set()
+refresh_lock = threading.Lock()
+
+# Cache-Control header of search results. Browsers and CDNs may serve a stored response for an hour, and serve it while revalidating for a week
+CACHE_CONTROL_QUERY = "max-age=3600, stale-while-revalidate=604800, public"
 
 def send_to_telegram(text):
     bot, chat_id = startup.get_telegram_bot()
@@ -67,13 +92,142 @@ def api_tdps() -> str:
     
     return json.dumps(response)
 
+def run_query(query:str, filter:VectorFilter, cache_key:str, record:dict=None, force:bool=False) -> str:
+    """ Runs the search and stores the result in the cache. Called once per cache_key for all concurrent requests. The stage timings
+    are stored in record['timings'] for the query log. Unless force, a fresh result in the database is returned instead """
+    vector_client = startup.get_vector_client()
+    cache_client = startup.get_cache_client()
+    timings = {} if record is None else record['timings']
+
+    # A previous leader may have stored the result between the cache miss of the caller and the start of this call
+    if not force:
+        cache_hit, timestamp = cache_client.cache_client.find_query(cache_key, count_hit=False)
+        if cache_hit is not None and not is_stale(timestamp):
+            if record is not None: record['cache'] = 'hit'
+            return cache_hit
+
+    paragraphs, keywords = search(vector_client, query, filter=filter, compress_text=True, metadata_store=startup.get_vector_metadata_store(), timings=timings)
+
+    paragraphs_json = []
+    for paragraph in paragraphs:
+        paragraphs_json.append({
+            'tdp_name': paragraph.tdp_name.to_dict(),
+            'title': paragraph.text_raw,
+            'content': paragraph.content_raw(),
+            'questions': paragraph.questions,
+        })
+
+    result = {
+        'paragraphs': paragraphs_json,
+        'keywords': keywords
+    }
+
+    json_response = json.dumps(result)
+
+    cache_client.insert_query(cache_key, json_response)
+
+    return json_response
+
+def find_llm_semantic(query:str, filter:VectorFilter, cache_key:str, record:dict) -> tuple[np.ndarray, str, str]:
+    """ Embeds the query and looks for the cached answer of a near-duplicate query under the same filter. Returns the dense vector,
+    the filter key, and the cached answer or None. The dense vector is needed for the search anyway """
+    cache_client = startup.get_cache_client()
+    semantic_cache = startup.get_semantic_cache()
+
+    t_start = time.time()
+    dense_vector = embeddor.embed_dense_openai(query)
+    filter_key = make_filter_key(filter)
+    record['timings']['embed_dense'] = time.time() - t_start
+
+    if semantic_cache is not None:
+        similar_cache_key, similarity = semantic_cache.find(filter_key, dense_vector)
+        if similar_cache_key is not None:
+            cache_hit, timestamp = cache_client.find_llm(similar_cache_key)
+            if cache_hit is not None:
+                logger.info(f"Answering '{cache_key}' with the cached answer of '{similar_cache_key}' (similarity {similarity:.3f})")
+                record['cache'] = 'semantic'
+                return dense_vector, filter_key, cache_hit
+
+    return dense_vector, filter_key, None
+
+def store_llm(cache_key:str, llm_input:str, llm_response:str, dense_vector:np.ndarray, filter_key:str) -> str:
+    """ Stores the answer in the LLM cache and the semantic cache, and returns it as it is served by /api/query/llm """
+    semantic_cache = startup.get_semantic_cache()
+
+    result = {
+        'llm_input': llm_input,
+        'llm_response': llm_response
+    }
+
+    json_response = json.dumps(result)
+
+    startup.get_cache_client().insert_llm(cache_key, json_response, embedding=dense_vector, filter_key=filter_key)
+    if semantic_cache is not None: semantic_cache.add(filter_key, cache_key, dense_vector)
+
+    return json_response
+
+def run_query_llm(query:str, filter:VectorFilter, cache_key:str, record:dict=None, force:bool=False) -> str:
+    """ Runs the LLM and stores the result in the cache, unless the semantic cache has the answer to a near-duplicate query. Called
+    once per cache_key for all concurrent requests. The stage timings are stored in record['timings'] for the query log. Unless
+    force, an answer in the database is returned instead """
+    vector_client = startup.get_vector_client()
+    if record is None: record = { 'cache': 'miss', 'timings': {} }
+
+    # A previous leader may have stored the answer between the cache miss of the caller and the start of this call
+    if not force:
+        cache_hit, _ = startup.get_cache_client().cache_client.find_llm(cache_key, count_hit=False)
+        if cache_hit is not None:
+            record['cache'] = 'hit'
+            return cache_hit
+
+    dense_vector, filter_key, cache_hit = find_llm_semantic(query, filter, cache_key, record)
+    if cache_hit is not None:
+        return cache_hit
+
+    llm_input, llm_response = llm(vector_client, query, filter, metadata_store=startup.get_vector_metadata_store(), dense_vector=dense_vector, timings=record['timings'])
+
+    return store_llm(cache_key, llm_input, llm_response, dense_vector, filter_key)
+
+def is_stale(timestamp:int) -> bool:
+    if timestamp is None: return False
+    if timestamp < time.time() - CACHE_QUERY_MAX_AGE: return True
+    return timestamp < startup.get_cache_client().get_index_updated_at()
+
+def schedule_refresh(query:str, filter:VectorFilter, cache_key:str) -> bool:
+    """ Recompute a stale search result in the background. Every cache_key is queued at most once, and at most MAX_PENDING_REFRESHES
+    refreshes are queued at any time, so that a burst of stale hits (e.g. right after ingestion) cannot overload the worker """
+    with refresh_lock:
+        if cache_key in refresh_pending or MAX_PENDING_REFRESHES <= len(refresh_pending):
+            return False
+        refresh_pending.add(cache_key)
+
+    def refresh():
+        try:
+            # The stale hit may come from the in-process cache, while another worker already refreshed the entry in the database
+            _, timestamp = startup.get_cache_client().reload_query(cache_key)
+            if timestamp is not None and not is_stale(timestamp):
+                logger.info(f"Stale cache entry {cache_key} was already refreshed")
+                return
+            # Shares the computation with any foreground request for the same key that misses the cache at the same time
+            query_flight.do(cache_key, run_query, query, filter, cache_key, timeout=SINGLE_FLIGHT_TIMEOUT)
+            logger.info(f"Refreshed stale cache entry {cache_key}")
+        except Exception as e:
+            logger.error(f"Could not refresh stale cache entry {cache_key}: {e}")
+        finally:
+            with refresh_lock:
+                refresh_pending.discard(cache_key)
+
+    refresh_executor.submit(refresh)
+    return True
+
 def api_query(query:str, filter:VectorFilter) -> str:
+    t_start = time.time()
+    record = { 'cache': 'miss', 'timings': {} }
     
     try:
-        vector_client = startup.get_vector_client()
         cache_client = startup.get_cache_client()
 
-        cache_key = query.lower() + "_" + str(filter)
+        cache_key = make_cache_key(query, filter)
         
         cache_hit, timestamp = cache_client.find_query(cache_key)
 
@@ -84,50 +238,44 @@ def api_query(query:str, filter:VectorFilter) -> str:
             thread.start()
 
         if cache_hit is not None:
+            record['cache'] = 'hit'
+            if is_stale(timestamp):
+                record['cache'] = 'stale'
+                schedule_refresh(query, filter, cache_key)
             return cache_hit
         
-        paragraphs, keywords = search(vector_client, query, filter=filter, compress_text=True)
-
-        paragraphs_json = []
-        for paragraph in paragraphs:
-            paragraphs_json.append({
-                'tdp_name': paragraph.tdp_name.to_dict(),
-                'title': paragraph.text_raw,
-                'content': paragraph.content_raw(),
-                'questions': paragraph.questions,
-            })
-
-        result = {
-            'paragraphs': paragraphs_json,
-            'keywords': keywords
-        }
-
-        json_response = json.dumps(result)
-
-        cache_client.insert_query(cache_key, json_response)
-
-        return json_response
+        result, shared = query_flight.do_shared(cache_key, run_query, query, filter, cache_key, record, timeout=SINGLE_FLIGHT_TIMEOUT)
+        # The timings of a coalesced request are in the record of the request that computed the result
+        if shared: record['cache'] = 'coalesced'
+        return result
     
     except RateLimitError as e:
+        record['cache'] = 'error'
         raise Exception(json.dumps({
             'error': 'RateLimitError',
             'message': 'OpenAI wants more money!'
         }))
     
     except Exception as e:
+        record['cache'] = 'error'
         logger.error(str(e))
         raise Exception(json.dumps({
             'error': 'Exception',
             'message': str(e)
         }))
 
+    finally:
+        query_log.record("query", query, None if filter is None else filter.to_dict(), record['cache'], (time.time() - t_start) * 1000, record['timings'])
+
 
 def api_query_llm(query:str, filter:VectorFilter) -> str:
+    t_start = time.time()
+    record = { 'cache': 'miss', 'timings': {} }
+
     try:
-        vector_client = startup.get_vector_client()
         cache_client = startup.get_cache_client()
 
-        cache_key = query.lower() + "_" + str(filter)
+        cache_key = make_cache_key(query, filter)
         
         cache_hit, timestamp = cache_client.find_llm(cache_key)
 
@@ -138,30 +286,98 @@ def api_query_llm(query:str, filter:VectorFilter) -> str:
             thread.start()
 
         if cache_hit is not None:
+            record['cache'] = 'hit'
             return cache_hit
         
-        llm_input, llm_response = llm(vector_client, query, filter)
-
-        result = {
-            'llm_input': llm_input,
-            'llm_response': llm_response
-        }
-
-        json_response = json.dumps(result)
-
-        cache_client.insert_llm(cache_key, json_response)
-
-        return json_response
+        result, shared = llm_flight.do_shared(cache_key, run_query_llm, query, filter, cache_key, record, timeout=SINGLE_FLIGHT_TIMEOUT)
+        # The timings of a coalesced request are in the record of the request that computed the result
+        if shared: record['cache'] = 'coalesced'
+        return result
     
     except RateLimitError as e:
+        record['cache'] = 'error'
         raise Exception(json.dumps({
             'error': 'RateLimitError',
             'message': 'OpenAI wants more money!'
         }))
     
     except Exception as e:
+        record['cache'] = 'error'
         logger.error(str(e))
         raise Exception(json.dumps({
             'error': 'Exception',
             'message': str(e)
         }))
+
+    finally:
+        query_log.record("llm", query, None if filter is None else filter.to_dict(), record['cache'], (time.time() - t_start) * 1000, record['timings'])
+
+def sse_event(event:str, data:dict) -> str:
+    # The data is JSON encoded, so that newlines in the answer don't end the event
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def api_query_llm_stream(query:str, filter:VectorFilter) -> Iterator[str]:
+    """ Same as api_query_llm(), but yields Server-Sent Events, so that the answer can be shown while it is being generated:
+
+    event: token    data: { "text": "..." }                                  a piece of the answer, source ids already replaced by links
+    event: done     data: { "llm_input": "...", "llm_response": "..." }      the full answer, same as the response of /api/query/llm
+    event: error    data: { "error": "...", "message": "..." }
+
+    A cached answer is sent as a single token event. A generated answer is written to the cache once it is complete. Unlike
+    api_query_llm(), concurrent requests for the same query are not coalesced, since every request needs its own stream """
+    t_start = time.time()
+    record = { 'cache': 'miss', 'timings': {} }
+
+    try:
+        cache_client = startup.get_cache_client()
+
+        cache_key = make_cache_key(query, filter)
+
+        cache_hit, timestamp = cache_client.find_llm(cache_key)
+
+        if startup.get_telegram_bot()[0] is not None:
+            cached = "(c)" if cache_hit is not None else ""
+            message = f"LLM stream {cached}: {query} | {str(filter)}"
+            thread = threading.Thread(target=send_to_telegram, args=[message])
+            thread.start()
+
+        if cache_hit is not None:
+            record['cache'] = 'hit'
+        else:
+            dense_vector, filter_key, cache_hit = find_llm_semantic(query, filter, cache_key, record)
+
+        if cache_hit is not None:
+            result = json.loads(cache_hit)
+            yield sse_event("token", { 'text': result['llm_response'] })
+            yield sse_event("done", result)
+            return
+
+        llm_input, stream = llm_stream(startup.get_vector_client(), query, filter, metadata_store=startup.get_vector_metadata_store(), dense_vector=dense_vector, timings=record['timings'])
+
+        llm_response = ""
+        for text in stream:
+            llm_response += text
+            yield sse_event("token", { 'text': text })
+
+        # Only reached if the whole answer was generated. If the client disconnects, the generator is closed and nothing is cached
+        llm_response = llm_response.strip()
+        json_response = store_llm(cache_key, llm_input, llm_response, dense_vector, filter_key)
+        yield sse_event("done", json.loads(json_response))
+
+    except RateLimitError as e:
+        record['cache'] = 'error'
+        yield sse_event("error", {
+            'error': 'RateLimitError',
+            'message': 'OpenAI wants more money!'
+        })
+
+    except Exception as e:
+        record['cache'] = 'error'
+        logger.error(str(e))
+        yield sse_event("error", {
+            'error': 'Exception',
+            'message': str(e)
+        })
+
+    finally:
+        query_log.record("llm", query, None if filter is None else filter.to_dict(), record['cache'], (time.time() - t_start) * 1000, record['timings'])
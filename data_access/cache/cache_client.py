@@ -4,19 +4,65 @@ import sys
 sys.path.append(os.path.dirname(os.path.dirname(__file__)))
 sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
 from abc import ABC, abstractmethod
+import atexit
+from collections import OrderedDict
+import datetime
+import gzip
+import json
+import threading
 import time
 # Third party libraries
+from bson.binary import Binary
+import numpy as np
 import pymongo
+from pymongo import UpdateOne
 import pymongo.collection
+import pymongo.errors
 import pymongo.database
 from pymongo.mongo_client import MongoClient
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 # Local libraries
 from data_structures.TDP import TDP
 from data_structures.TDPName import TDPName
 from data_structures.Paragraph import Paragraph   
 from data_structures.ProcessStateEnum import ProcessStateEnum
+from data_access.vector.vector_filter import VectorFilter
 from MyLogger import logger
 
+def make_filter_key(filter:VectorFilter=None) -> str:
+    """ Canonical representation of a filter. JSON with sorted keys and sorted lists """
+    filter_dict = {} if filter is None else filter.to_dict()
+    filter_dict = { key: sorted(value) if isinstance(value, list) else value for key, value in filter_dict.items() }
+    return json.dumps(filter_dict, sort_keys=True, separators=(",", ":"))
+
+def make_cache_key(query:str, filter:VectorFilter=None) -> str:
+    """ Canonical cache key. Whitespace is collapsed and the query is lowercased, and the filter is serialized with sorted keys and
+    sorted lists, so that e.g. 'Robot  kicker' with teams=[b,a] and 'robot kicker' with teams=[a,b] share a single cache entry """
+    query = " ".join(query.lower().split())
+    return query + "_" + make_filter_key(filter)
+
+""" Compression of cached values. Documents store the compressed value together with its encoding, so that documents written with zstd
+can still be read after switching to gzip and vice versa. Documents without an encoding are plain strings, as written before compression """
+
+def compress_value(value:str) -> tuple[bytes, str]:
+    if zstandard is not None:
+        return zstandard.ZstdCompressor(level=10).compress(value.encode("utf-8")), "zstd"
+    return gzip.compress(value.encode("utf-8"), compresslevel=6), "gzip"
+
+def decompress_value(value:bytes|str, encoding:str=None) -> str:
+    if encoding is None:
+        return value
+    if encoding == "zstd":
+        if zstandard is None:
+            raise ImportError("Cached value is compressed with zstd, but the zstandard package is not installed")
+        return zstandard.ZstdDecompressor().decompress(value).decode("utf-8")
+    if encoding == "gzip":
+        return gzip.decompress(value).decode("utf-8")
+    raise ValueError(f"Unknown cache value encoding '{encoding}'")
+
 class CacheClient(ABC):
     @abstractmethod
     def insert_query(self, key:str, value:str, overwrite=False):
@@ -34,13 +80,158 @@ class CacheClient(ABC):
     def find_llm(self):
         raise NotImplementedError
 
+class LRUCache:
+    """ Thread-safe in-process LRU cache with a time-to-live. Bounded both in number of entries and in total size of the values """
+
+    def __init__(self, max_entries:int=1000, max_bytes:int=64*1024*1024, ttl:float=600) -> None:
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries:OrderedDict[str, tuple[float, int, object]] = OrderedDict() # { key: (expires_at, size, value) }
+        self.n_bytes = 0
+        self.lock = threading.Lock()
+
+    def get(self, key:str):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.time():
+                self._remove(key)
+                return None
+            self.entries.move_to_end(key)
+            return entry[2]
+
+    def put(self, key:str, value, size:int=0) -> None:
+        # Values larger than the entire cache are never stored
+        if self.max_bytes < size: return
+        with self.lock:
+            if key in self.entries: self._remove(key)
+            self.entries[key] = (time.time() + self.ttl, size, value)
+            self.n_bytes += size
+            # Evict least recently used entries until within bounds
+            while self.max_entries < len(self.entries) or self.max_bytes < self.n_bytes:
+                self._remove(next(iter(self.entries)))
+
+    def invalidate(self, key:str) -> None:
+        with self.lock:
+            if key in self.entries: self._remove(key)
+
+    def _remove(self, key:str) -> None:
+        _, size, _ = self.entries.pop(key)
+        self.n_bytes -= size
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+class TwoTierCacheClient(CacheClient):
+    """ In-process LRU cache in front of another CacheClient (MongoDB). Hot queries are answered from memory without touching the
+    database. Hits are counted in memory, and written to the database in batches by a background thread every flush_interval seconds,
+    and when the process exits """
+
+    def __init__(self, cache_client:"MongoDBClient", max_entries:int=1000, max_bytes:int=64*1024*1024, ttl:float=600, flush_interval:float=30) -> None:
+        self.cache_client = cache_client
+        self.cache_query = LRUCache(max_entries, max_bytes, ttl)
+        self.cache_llm = LRUCache(max_entries, max_bytes, ttl)
+        self.flush_interval = flush_interval
+        self.index_updated_at:tuple[int, float] = None # (index_updated_at, time it was read)
+
+        # Hits that have not been written to the database yet. { collection: { key: hits } }
+        self.pending_hits:dict[str, dict[str, int]] = { "query": {}, "llm": {} }
+        self.pending_hits_lock = threading.Lock()
+
+        self.flush_thread = threading.Thread(target=self._flush_loop, name="cache-hits-flush", daemon=True)
+        self.flush_thread.start()
+        atexit.register(self.flush_hits)
+
+    def insert_query(self, key:str, value:str):
+        self.cache_client.insert_query(key, value)
+        self.cache_query.put(key, (value, int(time.time())), len(value))
+
+    def insert_llm(self, key:str, value:str, embedding:np.ndarray=None, filter_key:str=None):
+        self.cache_client.insert_llm(key, value, embedding=embedding, filter_key=filter_key)
+        self.cache_llm.put(key, (value, int(time.time())), len(value))
+
+    def find_llm_embeddings(self, limit:int=10000) -> list[tuple[str, str, np.ndarray]]:
+        return self.cache_client.find_llm_embeddings(limit)
+
+    def compact(self) -> dict:
+        self.flush_hits()
+        return self.cache_client.compact()
+
+    def get_index_updated_at(self, max_age:float=60) -> int:
+        """ Same as MongoDBClient.get_index_updated_at(), but only read from the database once every max_age seconds """
+        now = time.time()
+        if self.index_updated_at is None or self.index_updated_at[1] + max_age < now:
+            self.index_updated_at = (self.cache_client.get_index_updated_at(), now)
+        return self.index_updated_at[0]
+
+    def find_query(self, key:str) -> tuple[str, int]:
+        return self._find(self.cache_query, "query", key, self.cache_client.find_query)
+
+    def find_llm(self, key:str) -> tuple[str, int]:
+        return self._find(self.cache_llm, "llm", key, self.cache_client.find_llm)
+
+    def reload_query(self, key:str) -> tuple[str, int]:
+        """ Reads a query from the database, bypassing the in-process cache, and replaces the in-process entry with it. Used before
+        refreshing a stale entry, since another worker may have refreshed it in the database already """
+        value, timestamp = self.cache_client.find_query(key, count_hit=False)
+        if value is None:
+            self.cache_query.invalidate(key)
+            return None, None
+        self.cache_query.put(key, (value, timestamp), len(value))
+        return value, timestamp
+
+    def _find(self, cache:LRUCache, collection:str, key:str, find_function) -> tuple[str, int]:
+        hit = cache.get(key)
+        if hit is None:
+            value, timestamp = find_function(key, count_hit=False)
+            if value is None:
+                return None, None
+            hit = (value, timestamp)
+            cache.put(key, hit, len(value))
+        else:
+            logger.info(f"In-process cache hit for {collection} with key {key}")
+
+        with self.pending_hits_lock:
+            self.pending_hits[collection][key] = self.pending_hits[collection].get(key, 0) + 1
+
+        return hit
+
+    def flush_hits(self) -> None:
+        """ Write all hits that were counted in memory to the database """
+        with self.pending_hits_lock:
+            pending_hits, self.pending_hits = self.pending_hits, { "query": {}, "llm": {} }
+
+        for collection, hits in pending_hits.items():
+            if not len(hits): continue
+            try:
+                self.cache_client.increment_hits(collection, hits)
+            except Exception as e:
+                logger.error(f"Could not flush {len(hits)} cache hits for {collection}: {e}")
+
+    def _flush_loop(self) -> None:
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush_hits()
+
 class MongoDBClient(CacheClient):
-    
-    def __init__(self, connection_string:str):
+    """ Values are stored compressed. Every entry expires ttl seconds after it was last used, through a TTL index on 'expires_at'.
+    compact() additionally bounds every collection both in number of entries and in stored bytes, evicting the entries with the fewest
+    hits first, then the oldest. The stored bytes of an entry ('size') are its compressed value plus its embedding, if any """
+
+    def __init__(self, connection_string:str, ttl_query:float=30*24*3600, ttl_llm:float=90*24*3600, max_queries:int=50000, max_llms:int=20000,
+                 max_query_bytes:int=256*1024*1024, max_llm_bytes:int=256*1024*1024):
         self.client = MongoClient(connection_string, serverSelectionTimeoutMS = 3000)
+        self.ttl = { "query": ttl_query, "llm": ttl_llm }
+        self.max_entries = { "query": max_queries, "llm": max_llms }
+        self.max_bytes = { "query": max_query_bytes, "llm": max_llm_bytes }
         self.ensure_collection_cache_query()
         self.ensure_collection_cache_llm()
 
+    def expires_at(self, collection:str) -> datetime.datetime:
+        return datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=self.ttl[collection])
+
     def count_queries(self) -> int:
         db:pymongo.database.Database = self.client.get_database("cache")
         col:pymongo.collection.Collection = db.get_collection("query")
@@ -59,48 +250,184 @@ class MongoDBClient(CacheClient):
         db:pymongo.database.Database = self.client.get_database("cache")
         col:pymongo.collection.Collection = db.get_collection("query")
 
-        idx = col.update_one({"key": key}, { "$set": { "value": value, "timestamp": int(time.time()), "hits": 0 } }, upsert=True)
+        value_compressed, encoding = compress_value(value)
+        document = { "value": Binary(value_compressed), "encoding": encoding, "size": len(value_compressed), "timestamp": int(time.time()), "expires_at": self.expires_at("query"), "hits": 0 }
+
+        idx = col.update_one({"key": key}, { "$set": document }, upsert=True)
 
-        logger.info(f"Inserted query of length {len(value)} with key {key} with id {idx.upserted_id}")
+        logger.info(f"Inserted query of length {len(value)} ({len(value_compressed)} compressed) with key {key} with id {idx.upserted_id}")
 
-    def insert_llm(self, key, value):
+    def insert_llm(self, key, value, embedding:np.ndarray=None, filter_key:str=None):
         logger.info(f"Inserting LLM with key {key}")
 
         db:pymongo.database.Database = self.client.get_database("cache")
         col:pymongo.collection.Collection = db.get_collection("llm")
 
-        idx = col.update_one({"key": key}, { "$set": { "value": value, "timestamp": int(time.time()), "hits": 0 } }, upsert=True)
+        value_compressed, encoding = compress_value(value)
+        document = { "value": Binary(value_compressed), "encoding": encoding, "size": len(value_compressed), "timestamp": int(time.time()), "expires_at": self.expires_at("llm"), "hits": 0 }
+        # Stored for the semantic cache. The embedding is stored as raw float32 bytes, which is 4x smaller than a list of doubles
+        if embedding is not None and filter_key is not None:
+            document["embedding"] = Binary(np.asarray(embedding, dtype=np.float32).tobytes())
+            document["filter_key"] = filter_key
+            document["size"] += len(document["embedding"])
 
-        logger.info(f"Inserted LLM with key {key} with id {idx.upserted_id}")
+        idx = col.update_one({"key": key}, { "$set": document }, upsert=True)
 
-    def find_query(self, key:str) -> tuple[str, int]:
+        logger.info(f"Inserted LLM of length {len(value)} ({len(value_compressed)} compressed) with key {key} with id {idx.upserted_id}")
+
+    def find_query(self, key:str, count_hit:bool=True) -> tuple[str, int]:
         db:pymongo.database.Database = self.client.get_database("cache")
         col:pymongo.collection.Collection = db.get_collection("query")
         
-        query = col.find_one({ "key": key })
+        # Find and increment the hits in a single round trip
+        if count_hit:
+            query = col.find_one_and_update({ "key": key }, { "$inc": { "hits": 1 }, "$set": { "expires_at": self.expires_at("query") } })
+        else:
+            query = col.find_one({ "key": key })
         
         if query is None: 
             logger.info(f"Cache miss for query with key {key}")
             return None, None
         
-        col.update_one({ "key": key }, { "$inc": { "hits": 1 } })
         logger.info(f"Cache hit for query with key {key}")
-        return query["value"], query["timestamp"]
+        return decompress_value(query["value"], query.get("encoding")), query["timestamp"]
 
-    def find_llm(self, key:str) -> tuple[str, int]:
+    def find_llm(self, key:str, count_hit:bool=True) -> tuple[str, int]:
         db:pymongo.database.Database = self.client.get_database("cache")
         col:pymongo.collection.Collection = db.get_collection("llm")
         
-        llm = col.find_one({ "key": key })
+        # Find and increment the hits in a single round trip
+        if count_hit:
+            llm = col.find_one_and_update({ "key": key }, { "$inc": { "hits": 1 }, "$set": { "expires_at": self.expires_at("llm") } })
+        else:
+            llm = col.find_one({ "key": key })
         
         if llm is None:
             logger.info(f"Cache miss for LLM with key {key}")
             return None, None
         
-        col.update_one({ "key": key }, { "$inc": { "hits": 1 } })
         logger.info(f"Cache hit for LLM with key {key}")
-        return llm["value"], llm["timestamp"]
+        return decompress_value(llm["value"], llm.get("encoding")), llm["timestamp"]
+
+    def find_llm_embeddings(self, limit:int=10000) -> list[tuple[str, str, np.ndarray]]:
+        """ Returns (key, filter_key, embedding) of the most recent LLM entries that have an embedding, used to fill the semantic cache """
+        db:pymongo.database.Database = self.client.get_database("cache")
+        col:pymongo.collection.Collection = db.get_collection("llm")
+
+        cursor = col.find({ "embedding": { "$exists": True } }, { "key": 1, "filter_key": 1, "embedding": 1 }).sort("timestamp", pymongo.DESCENDING).limit(limit)
+        # Oldest first, so that the most recent entries are the last to be evicted from the semantic cache
+        return [ (doc["key"], doc["filter_key"], np.frombuffer(doc["embedding"], dtype=np.float32)) for doc in cursor ][::-1]
+
+    def increment_hits(self, collection:str, hits:dict[str, int]) -> None:
+        """ Add hits to multiple entries of collection 'query' or 'llm' in a single bulk write. hits = { key: n_hits } """
+        db:pymongo.database.Database = self.client.get_database("cache")
+        col:pymongo.collection.Collection = db.get_collection(collection)
+
+        # Used entries live longer
+        expires_at = self.expires_at(collection)
+        col.bulk_write([ UpdateOne({ "key": key }, { "$inc": { "hits": n_hits }, "$set": { "expires_at": expires_at } }) for key, n_hits in hits.items() ], ordered=False)
+        logger.info(f"Flushed {sum(hits.values())} hits over {len(hits)} entries to cache collection {collection}")
+
+    """ Index version. Bumped whenever the vector index changes, marking all entries created before as stale """
+
+    def bump_index_version(self) -> dict:
+        db:pymongo.database.Database = self.client.get_database("cache")
+        col:pymongo.collection.Collection = db.get_collection("meta")
+        meta = col.find_one_and_update({ "_id": "index" }, { "$inc": { "version": 1 }, "$set": { "updated_at": int(time.time()) } }, upsert=True, return_document=pymongo.ReturnDocument.AFTER)
+        logger.info(f"Bumped index version to {meta['version']}")
+        return meta
+
+    def get_index_updated_at(self) -> int:
+        """ Timestamp of the last index version bump. Cache entries with an older timestamp are stale """
+        db:pymongo.database.Database = self.client.get_database("cache")
+        col:pymongo.collection.Collection = db.get_collection("meta")
+        meta = col.find_one({ "_id": "index" })
+        return 0 if meta is None else meta["updated_at"]
+
+    """ Compaction """
+
+    def count_bytes(self, collection:str) -> int:
+        """ Total stored bytes of all entries in the collection """
+        db:pymongo.database.Database = self.client.get_database("cache")
+        col:pymongo.collection.Collection = db.get_collection(collection)
+        result = list(col.aggregate([ { "$group": { "_id": None, "size": { "$sum": "$size" } } } ]))
+        return 0 if not len(result) else result[0]["size"]
+
+    def add_sizes(self, collection:str) -> int:
+        """ Set the stored bytes of entries that were written before sizes were stored. Uses $binarySize, which needs MongoDB 4.4 or later.
+        On older or merely MongoDB-compatible servers this update fails, and with it compact() """
+        db:pymongo.database.Database = self.client.get_database("cache")
+        col:pymongo.collection.Collection = db.get_collection(collection)
+        size = { "$add": [ { "$binarySize": "$value" }, { "$ifNull": [ { "$binarySize": "$embedding" }, 0 ] } ] }
+        return col.update_many({ "size": { "$exists": False } }, [ { "$set": { "size": size } } ]).modified_count
+
+    def evict(self, collection:str, max_entries:int, max_bytes:int=None) -> int:
+        """ Delete entries until at most max_entries remain, and they take at most max_bytes. Entries with the fewest hits are deleted
+        first, and the oldest among those """
+        db:pymongo.database.Database = self.client.get_database("cache")
+        col:pymongo.collection.Collection = db.get_collection(collection)
+
+        n_excess = max(0, col.count_documents({}) - max_entries)
+        n_bytes_excess = 0 if max_bytes is None else max(0, self.count_bytes(collection) - max_bytes)
+        if n_excess <= 0 and n_bytes_excess <= 0:
+            return 0
+
+        n_deleted, n_bytes_deleted = 0, 0
+        # Delete in batches, to keep the size of a single delete request bounded
+        while n_deleted < n_excess or n_bytes_deleted < n_bytes_excess:
+            cursor = col.find({}, { "_id": 1, "size": 1 }).sort([("hits", pymongo.ASCENDING), ("timestamp", pymongo.ASCENDING)]).limit(1000)
+            ids = []
+            for doc in cursor:
+                if n_excess <= n_deleted + len(ids) and n_bytes_excess <= n_bytes_deleted: break
+                ids.append(doc["_id"])
+                n_bytes_deleted += doc.get("size", 0)
+            if not len(ids): break
+            n_deleted += col.delete_many({ "_id": { "$in": ids } }).deleted_count
+
+        logger.info(f"Evicted {n_deleted} entries ({n_bytes_deleted} bytes) from cache collection {collection}")
+        return n_deleted
+
+    def compress_legacy(self, collection:str) -> int:
+        """ Compress all values that were stored as plain strings, and give them an expiry date based on their timestamp """
+        db:pymongo.database.Database = self.client.get_database("cache")
+        col:pymongo.collection.Collection = db.get_collection(collection)
+
+        n_compressed, updates = 0, []
+        for doc in col.find({ "encoding": { "$exists": False } }, { "value": 1, "timestamp": 1 }):
+            value_compressed, encoding = compress_value(doc["value"])
+            expires_at = datetime.datetime.fromtimestamp(doc.get("timestamp", time.time()) + self.ttl[collection], datetime.timezone.utc)
+            updates.append(UpdateOne({ "_id": doc["_id"] }, { "$set": { "value": Binary(value_compressed), "encoding": encoding, "size": len(value_compressed), "expires_at": expires_at } }))
+            if len(updates) == 500:
+                n_compressed += col.bulk_write(updates, ordered=False).modified_count
+                updates = []
+        if len(updates):
+            n_compressed += col.bulk_write(updates, ordered=False).modified_count
+
+        logger.info(f"Compressed {n_compressed} legacy entries in cache collection {collection}")
+        return n_compressed
+
+    def compact(self) -> dict:
+        """ Background compaction job. Compresses legacy entries, deletes expired entries (the TTL monitor only runs once a minute, and
+        not every MongoDB-compatible database supports TTL indexes on arbitrary fields), and evicts entries beyond the count and size bounds """
+        db:pymongo.database.Database = self.client.get_database("cache")
+        statistics = {}
+        for collection in ["query", "llm"]:
+            col:pymongo.collection.Collection = db.get_collection(collection)
+            n_compressed = self.compress_legacy(collection)
+            self.add_sizes(collection)
+            n_expired = col.delete_many({ "expires_at": { "$lt": datetime.datetime.now(datetime.timezone.utc) } }).deleted_count
+            n_evicted = self.evict(collection, self.max_entries[collection], self.max_bytes[collection])
+            statistics[collection] = { "compressed": n_compressed, "expired": n_expired, "evicted": n_evicted, "remaining": col.count_documents({}), "bytes": self.count_bytes(collection) }
+            logger.info(f"Compacted cache collection {collection}: {statistics[collection]}")
+        return statistics
         
+    def ensure_ttl_index(self, col:pymongo.collection.Collection) -> None:
+        try:
+            col.create_index("expires_at", expireAfterSeconds=0)
+        except pymongo.errors.OperationFailure as e:
+            # Azure CosmosDB only supports TTL on _ts. Expired entries are then only deleted by compact()
+            logger.warning(f"Could not create TTL index on expires_at of cache collection {col.name}, relying on compact(): {e}")
+
     def ensure_collection_cache_query(self):
         # Ensure that database "cache" exists
         if "cache" not in self.client.list_database_names():
@@ -117,6 +444,10 @@ class MongoDBClient(CacheClient):
             logger.info("Creating index on key")
         col.create_index("key")
 
+        # TTL index, MongoDB deletes entries once expires_at has passed. Index on hits and timestamp, used for eviction
+        self.ensure_ttl_index(col)
+        col.create_index([("hits", pymongo.ASCENDING), ("timestamp", pymongo.ASCENDING)])
+
     def ensure_collection_cache_llm(self):
         # Ensure that database "cache" exists
         if "cache" not in self.client.list_database_names():
@@ -133,6 +464,10 @@ class MongoDBClient(CacheClient):
             logger.info("Creating index on key")
         col.create_index("key")
 
+        # TTL index, MongoDB deletes entries once expires_at has passed. Index on hits and timestamp, used for eviction
+        self.ensure_ttl_index(col)
+        col.create_index([("hits", pymongo.ASCENDING), ("timestamp", pymongo.ASCENDING)])
+
 if __name__ == "__main__":
     from dotenv import load_dotenv
     load_dotenv()
@@ -0,0 +1,99 @@
+# System libraries
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
+import threading
+# Third party libraries
+import numpy as np
+# Local libraries
+from MyLogger import logger
+
+class SemanticCache:
+    """ Finds cached queries that are semantically near-duplicates of a new query, e.g. "dribbler design" and "design of the dribbler".
+
+    For every filter, the normalized dense embeddings of the cached queries are kept in a small in-memory matrix. A lookup is a single
+    matrix-vector product followed by an argmax, which takes well under a millisecond for a thousand queries. Only queries under
+    exactly the same filter can match each other. The responses themselves stay in the regular cache, this class only maps a new query
+    to the cache key of an existing one.
+
+    When the matrix of a filter is full, the oldest query is overwritten
+    """
+
+    class Entries:
+        def __init__(self, dim:int, capacity:int) -> None:
+            self.matrix = np.zeros((capacity, dim), dtype=np.float32)
+            self.keys:list[str] = [None] * capacity
+            self.key_to_row:dict[str, int] = {}
+            self.n = 0 # Number of valid rows
+            self.i_next = 0 # Row that is written next
+
+    def __init__(self, threshold:float=0.93, max_entries_per_filter:int=1000) -> None:
+        self.threshold = threshold
+        self.max_entries_per_filter = max_entries_per_filter
+        self.entries:dict[str, SemanticCache.Entries] = {} # { filter_key: Entries }
+        self.lock = threading.Lock()
+
+    def add(self, filter_key:str, cache_key:str, embedding:np.ndarray) -> None:
+        embedding = np.asarray(embedding, dtype=np.float32).ravel()
+        norm = np.linalg.norm(embedding)
+        if norm == 0: return
+
+        with self.lock:
+            entries = self.entries.get(filter_key)
+            if entries is None:
+                entries = self.entries[filter_key] = SemanticCache.Entries(len(embedding), self.max_entries_per_filter)
+            # The same query could be added twice, e.g. by two processes. Keep only one
+            if cache_key in entries.key_to_row:
+                return
+            entries.key_to_row.pop(entries.keys[entries.i_next], None)
+            entries.matrix[entries.i_next] = embedding / norm
+            entries.keys[entries.i_next] = cache_key
+            entries.key_to_row[cache_key] = entries.i_next
+            entries.i_next = (entries.i_next + 1) % self.max_entries_per_filter
+            entries.n = min(entries.n + 1, self.max_entries_per_filter)
+
+    def find(self, filter_key:str, embedding:np.ndarray) -> tuple[str, float] | tuple[None, None]:
+        """ Returns the cache key of the most similar cached query under the same filter and its cosine similarity, if the similarity is
+        at least the threshold. Returns (None, None) otherwise """
+        embedding = np.asarray(embedding, dtype=np.float32).ravel()
+        norm = np.linalg.norm(embedding)
+
+        with self.lock:
+            entries = self.entries.get(filter_key)
+            if entries is None or entries.n == 0 or norm == 0:
+                return None, None
+            similarities = entries.matrix[:entries.n] @ (embedding / norm)
+            i_best = int(np.argmax(similarities))
+            similarity, cache_key = float(similarities[i_best]), entries.keys[i_best]
+
+        if similarity < self.threshold:
+            return None, None
+
+        logger.info(f"Semantic cache hit with similarity {similarity:.3f} for key {cache_key}")
+        return cache_key, similarity
+
+    def load(self, records:list[tuple[str, str, np.ndarray]]) -> None:
+        """ Add records (cache_key, filter_key, embedding), e.g. loaded from the cache database at startup """
+        for cache_key, filter_key, embedding in records:
+            self.add(filter_key, cache_key, embedding)
+        logger.info(f"Loaded {len(records)} queries into the semantic cache")
+
+    def __len__(self) -> int:
+        return sum([ entries.n for entries in self.entries.values() ])
+
+if __name__ == "__main__":
+    import time
+
+    cache = SemanticCache(threshold=0.9)
+    rng = np.random.default_rng(0)
+    embeddings = rng.normal(size=(cache.max_entries_per_filter, 1536)).astype(np.float32)
+    for i, embedding in enumerate(embeddings):
+        cache.add("{}", f"query_{i}", embedding)
+
+    # A slightly perturbed version of an existing query should be found
+    query = embeddings[123] + rng.normal(scale=0.1, size=1536).astype(np.float32)
+
+    t_start = time.perf_counter()
+    for _ in range(100): result = cache.find("{}", query)
+    print(f"Result: {result}. Duration per lookup over {len(cache)} queries: {(time.perf_counter()-t_start)*10:.3f}ms")
@@ -0,0 +1,127 @@
+# System libraries
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
+import json
+from typing import Iterator
+# Local libraries
+from data_structures.TDPName import TDPName
+from MyLogger import logger
+
+# Directory of the archive, relative to the root of the file client. The old one-file-per-chunk directory was "chunks"
+CHUNK_ARCHIVE_DIR = "chunk_archive"
+
+def chunk_key(paragraph_sequence_id:int, chunk_sequence_id:int) -> str:
+    return f"{paragraph_sequence_id}__{chunk_sequence_id}"
+
+class ChunkArchive:
+    """ All paragraph chunks written by process_tdps.py, as one JSONL shard per TDP instead of one JSON file per chunk:
+
+    <root>/<league parts>/<year>/<tdp filename>.jsonl      : one chunk per line, ordered by paragraph and chunk
+    <root>/<league parts>/<year>/<tdp filename>.index.json : { "<paragraph>__<chunk>": [byte offset, byte length] }
+
+    A TDP is always written as a whole, to temporary files that then replace the shard and its index. Readers never see a half written
+    TDP, and re-ingesting a TDP simply replaces its shard. Streaming all chunks reads a few thousand files sequentially instead of tens of
+    thousands of tiny ones. The offset index gives random access to a single chunk without parsing the rest of the shard.
+    """
+
+    def __init__(self, root_dir:str) -> None:
+        self.root_dir = root_dir
+
+    def shard_filepath(self, tdp_name:TDPName) -> str:
+        return os.path.join(self.root_dir, os.path.splitext(tdp_name.to_filepath(TDPName.PDF_EXT))[0] + ".jsonl")
+
+    def index_filepath(self, tdp_name:TDPName) -> str:
+        return self.shard_filepath(tdp_name)[:-len(".jsonl")] + ".index.json"
+
+    """ Writing """
+
+    def write_tdp(self, tdp_name:TDPName, chunks:list[dict]) -> None:
+        """ Replaces all chunks of a TDP. Every chunk is a dict with at least 'paragraph_sequence_id', 'chunk_sequence_id' and 'text' """
+        filepath = self.shard_filepath(tdp_name)
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+
+        chunks = sorted(chunks, key=lambda chunk: (chunk['paragraph_sequence_id'], chunk['chunk_sequence_id']))
+        index, offset = {}, 0
+        with open(filepath + ".tmp", "wb") as file:
+            for chunk in chunks:
+                line = (json.dumps(chunk, ensure_ascii=False) + "\n").encode("utf-8")
+                index[chunk_key(chunk['paragraph_sequence_id'], chunk['chunk_sequence_id'])] = [offset, len(line)]
+                file.write(line)
+                offset += len(line)
+        with open(self.index_filepath(tdp_name) + ".tmp", "w") as file:
+            json.dump(index, file)
+
+        os.replace(filepath + ".tmp", filepath)
+        os.replace(self.index_filepath(tdp_name) + ".tmp", self.index_filepath(tdp_name))
+        logger.info(f"Archived {len(chunks)} chunks of {tdp_name} ({offset} bytes)")
+
+    def delete_tdp(self, tdp_name:TDPName) -> None:
+        for filepath in [self.shard_filepath(tdp_name), self.index_filepath(tdp_name)]:
+            if os.path.isfile(filepath): os.remove(filepath)
+
+    """ Reading """
+
+    def read_tdp(self, tdp_name:TDPName) -> list[dict]:
+        if not os.path.isfile(self.shard_filepath(tdp_name)): return []
+        with open(self.shard_filepath(tdp_name), "rb") as file:
+            return [ json.loads(line) for line in file ]
+
+    def get_chunk(self, tdp_name:TDPName, paragraph_sequence_id:int, chunk_sequence_id:int) -> dict | None:
+        """ Reads a single chunk through the offset index """
+        if not os.path.isfile(self.index_filepath(tdp_name)): return None
+        with open(self.index_filepath(tdp_name), "r") as file:
+            location = json.load(file).get(chunk_key(paragraph_sequence_id, chunk_sequence_id))
+        if location is None: return None
+
+        with open(self.shard_filepath(tdp_name), "rb") as file:
+            file.seek(location[0])
+            line = file.read(location[1])
+
+        # The shard is replaced just before its index. A reader in between gets the new shard with the old index, and falls back to a scan
+        try:
+            chunk = json.loads(line)
+        except ValueError:
+            chunk = None
+        if chunk is None or (chunk['paragraph_sequence_id'], chunk['chunk_sequence_id']) != (paragraph_sequence_id, chunk_sequence_id):
+            return next(( _ for _ in self.read_tdp(tdp_name) if (_['paragraph_sequence_id'], _['chunk_sequence_id']) == (paragraph_sequence_id, chunk_sequence_id) ), None)
+        return chunk
+
+    def list_shards(self) -> list[str]:
+        """ Returns the filepaths of all shards, sorted """
+        filepaths = []
+        for directory, _, filenames in os.walk(self.root_dir):
+            filepaths += [ os.path.join(directory, filename) for filename in filenames if filename.endswith(".jsonl") ]
+        return sorted(filepaths)
+
+    def iterate(self, limit:int=None) -> Iterator[dict]:
+        """ Streams all chunks of all TDPs, shard by shard """
+        n_chunks = 0
+        for filepath in self.list_shards():
+            with open(filepath, "rb") as file:
+                for line in file:
+                    if limit is not None and limit <= n_chunks: return
+                    yield json.loads(line)
+                    n_chunks += 1
+
+    def iterate_texts(self, batch_size:int=500, limit:int=None) -> Iterator[list[str]]:
+        """ Streams the texts of all chunks in batches, e.g. to refit BM25 or to re-embed everything """
+        batch = []
+        for chunk in self.iterate(limit):
+            batch.append(chunk['text'])
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if len(batch): yield batch
+
+    def count(self) -> int:
+        n_chunks = 0
+        for filepath in self.list_shards():
+            with open(filepath, "rb") as file:
+                n_chunks += sum([ 1 for _ in file ])
+        return n_chunks
+
+if __name__ == "__main__":
+    archive = ChunkArchive(sys.argv[1] if 1 < len(sys.argv) else CHUNK_ARCHIVE_DIR)
+    print(f"Shards: {len(archive.list_shards())}    Chunks: {archive.count()}")
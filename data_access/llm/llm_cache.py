@@ -0,0 +1,111 @@
+# System libraries
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
+import hashlib
+import sqlite3
+import threading
+import time
+# Local libraries
+from MyLogger import logger
+
+def text_hash(text:str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+def prompt_version(*templates:str) -> str:
+    """ Version of a prompt, derived from its templates. Any change to a template gives a new version, and thus new cache keys """
+    return text_hash("\n".join(templates))[:16]
+
+class LLMResponseCache:
+    """ Persistent cache of LLM responses, keyed by (prompt name, model, prompt version, hash of the prompt input). Only used for
+    deterministic work such as question generation during ingestion, where the same input should give the same output anyway.
+    Re-running process_tdps.py then only pays for chunks that changed, or for prompts that changed.
+
+    The cache is a single SQLite file in WAL mode, so that it can be shared by threads and by the extraction processes. Every thread
+    gets its own connection, just like VectorMetadataStore. Old prompt versions are never read again, remove them with delete_stale()
+    """
+
+    def __init__(self, filepath:str) -> None:
+        self.filepath = filepath
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.n_hits = 0
+        self.n_misses = 0
+
+        connection = self.connection()
+        connection.execute("""CREATE TABLE IF NOT EXISTS response (
+            key TEXT PRIMARY KEY, name TEXT NOT NULL, model TEXT NOT NULL, version TEXT NOT NULL, created REAL NOT NULL, response TEXT NOT NULL
+        ) WITHOUT ROWID""")
+        connection.commit()
+
+    def connection(self) -> sqlite3.Connection:
+        """ Returns the connection of the current thread, and opens it if needed. A forked process never reuses its parent's connection """
+        connection, pid = getattr(self.local, "connection", (None, None))
+        if connection is not None and pid == os.getpid():
+            return connection
+
+        # The timeout is how long a writer waits for another writer, e.g. another extraction process
+        connection = sqlite3.connect(self.filepath, timeout=30)
+        connection.execute("PRAGMA journal_mode = WAL")
+        connection.execute("PRAGMA synchronous = NORMAL")
+        self.local.connection = (connection, os.getpid())
+        return connection
+
+    @staticmethod
+    def key(name:str, model:str, version:str, input:str) -> str:
+        return text_hash(f"{name}\n{model}\n{version}\n{text_hash(input)}")
+
+    def get(self, name:str, model:str, version:str, input:str) -> str | None:
+        """ Returns the cached response, or None if there is none """
+        row = self.connection().execute("SELECT response FROM response WHERE key = ?", (self.key(name, model, version, input),)).fetchone()
+        with self.lock:
+            if row is None: self.n_misses += 1
+            else: self.n_hits += 1
+        return None if row is None else row[0]
+
+    def put(self, name:str, model:str, version:str, input:str, response:str) -> None:
+        try:
+            connection = self.connection()
+            connection.execute("INSERT OR REPLACE INTO response (key, name, model, version, created, response) VALUES (?, ?, ?, ?, ?, ?)",
+                               (self.key(name, model, version, input), name, model, version, time.time(), response))
+            connection.commit()
+        except sqlite3.Error as e:
+            # E.g. a full disk or a locked database. Caching should never break the LLM call itself
+            logger.error(f"Could not write to LLM response cache {self.filepath}: {e}")
+
+    def delete_stale(self, versions:dict[str, str]) -> int:
+        """ Removes all responses of the given prompt names that are not of the given version. versions is { name: current version } """
+        connection = self.connection()
+        n_deleted = 0
+        for name, version in versions.items():
+            n_deleted += connection.execute("DELETE FROM response WHERE name = ? AND version != ?", (name, version)).rowcount
+        connection.commit()
+        return n_deleted
+
+    def hit_rate(self) -> float:
+        with self.lock:
+            return self.n_hits / max(1, self.n_hits + self.n_misses)
+
+    def statistics(self) -> dict:
+        """ Returns the hits and misses of this process, and the number of cached responses per prompt name, model and version """
+        with self.lock:
+            statistics = { 'hits': self.n_hits, 'misses': self.n_misses }
+        statistics['hit_rate'] = self.hit_rate()
+        statistics['entries'] = { f"{name} {model} {version}": count for name, model, version, count in
+            self.connection().execute("SELECT name, model, version, COUNT(*) FROM response GROUP BY name, model, version") }
+        return statistics
+
+if __name__ == "__main__":
+    # Usage: python llm_cache.py [filepath] [--delete-stale]
+    arguments = [ _ for _ in sys.argv[1:] if not _.startswith("--") ]
+    cache = LLMResponseCache(arguments[0] if len(arguments) else os.getenv("LLM_RESPONSE_CACHE", "llm_cache.sqlite"))
+    if "--delete-stale" in sys.argv:
+        from data_access.llm import llm_client
+        n_deleted = cache.delete_stale({
+            "paragraph_titles": llm_client.PROMPT_PARAGRAPH_TITLES_VERSION,
+            "paragraph_chunk_information": llm_client.PROMPT_PARAGRAPH_CHUNK_INFORMATION_VERSION
+        })
+        print(f"Deleted {n_deleted} responses of old prompt versions")
+    for entry, count in cache.statistics()['entries'].items():
+        print(f"{count:8} {entry}")
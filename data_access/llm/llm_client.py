@@ -5,6 +5,9 @@ sys.path.append(os.path.dirname(os.path.dirname(__file__)))
 sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
 from abc import ABC, abstractmethod
 import json
+from concurrent.futures import ThreadPoolExecutor
+import threading
+from typing import Iterator
 # Third party libraries
 from dotenv import load_dotenv
 load_dotenv()
@@ -14,8 +17,52 @@ from openai import OpenAI
 from data_structures.TDPName import TDPName
 from data_structures.Paragraph import Paragraph
 from data_structures.ParagraphChunk import ParagraphChunk
+from data_access.llm.llm_cache import LLMResponseCache, prompt_version
+from data_access.llm.openai_scheduler import OpenAIScheduler, PRIORITY_SERVING, estimate_chat_tokens, get_scheduler
 from MyLogger import logger
 
+# Prompt templates of the cached LLM calls. Their version is a hash of the templates, so changing a template invalidates its cache entries
+PROMPT_PARAGRAPH_TITLES = (
+    "The overal goal of your task is paragraph extraction from a PDF based on titles, headers, subheaders, and subsubheaders. "
+    "You will receive a list of lines extracted from a PDF. These lines are chosen specifically because they differ from 'normal' text lines. "
+    "Each line type could be a possible title, header, subheader, or subsubheader. There is also the possiblity that a line is simply nothing. "
+    "For each line, you will receive its line number, its text, and a list of corresponding features. "
+    "For each line, decide if the type is a title, header, subheader, subsubheader, or nothing. "
+    "For each line, respond with a list [line number, line text, line type]. "
+    "Use the following line type mapping: title=0, header=1, subheader=2, subsubheader=3, nothing=99. "
+    "Be conservative. It's better to miss a few titles or headers than too have too much. Precision over recall."
+    "Rule: if one header or subheader starts with a number, they all do. If a line does not have a number while there are headers or subheaders with a number, then the line is probably a subsubheader. "
+    "Rule: a header should always be followed by a subheader, and a subheader should always be followed by a subsubheader. "
+    "Rule: the feature 'group' is very important. All titles, headers, subheaders, and subsubheaders should be in the same group. "
+    #"Rule: it is more like that a line is a header than a subheader or subsubheader. Make more headers"
+    "Rule: a group of headers or subheader should be sequential and start with 1 or a or A. If it doesn't start with 1, then it is probably nothing. "
+    "Respond with a JSON list of tuples. \n"
+)
+PROMPT_PARAGRAPH_TITLES_HINT = (
+    "The following line types have already be determined and can be used as a guideline. These are not leading, and might be wrong, and can be disregarded if they are wrong. \n"
+    "{hint_string} \n"
+)
+PROMPT_PARAGRAPH_TITLES_LINES = (
+    "Process the following lines: \n"
+    "{feature_string} \n"
+)
+PROMPT_PARAGRAPH_TITLES_VERSION = prompt_version(PROMPT_PARAGRAPH_TITLES, PROMPT_PARAGRAPH_TITLES_HINT, PROMPT_PARAGRAPH_TITLES_LINES)
+
+PROMPT_PARAGRAPH_CHUNK_INFORMATION = (
+    "Analyze the following paragraph and provide a response in JSON format with two fields: "
+    # "'summary' (a brief summary of the paragraph), "
+    "'questions_specific' (a list of {n_questions} questions or less that the paragraph would answer, specifically for this league team year product algorithm). "
+    "'questions_generic' (a list of {n_questions} questions or less that the paragraph would answer, without referencing team specifics, source specifics, product names etc). "
+    # "'keywords' (a list of important keywords from the paragraph), "
+    # "'domain_specific' (a list of domain-specific words from the paragraph, that could be unknown to any reader or dictionary). "
+    "Keep in mind that the questions should be useful. Ensure that questions_specific are specific. For example, say 'ball sensor' instead of 'sensor', or 'dribbler motor' instead of 'motor'."
+    "It is better to have fewer questions that are more useful than more questions that are less useful or too obvious. "
+    "The source of the following paragraph is as follows: league={league}, team={team}, year={year}."
+    "\n\n"
+    "Paragraph: {text}"
+)
+PROMPT_PARAGRAPH_CHUNK_INFORMATION_VERSION = prompt_version(PROMPT_PARAGRAPH_CHUNK_INFORMATION)
+
 
 class LLMClient(ABC):
     @abstractmethod
@@ -48,110 +95,98 @@ class OpenAIClient(LLMClient):
         },
     }
 
-    def __init__(self):
+    def __init__(self, response_cache:LLMResponseCache=None, priority:int=PRIORITY_SERVING, scheduler:OpenAIScheduler=None):
         self.client = OpenAI()
+        # Rate limits requests when OPENAI_RATE_LIMITS is set. Ingestion uses PRIORITY_INGESTION, so that it never starves user queries
+        self.scheduler:OpenAIScheduler = scheduler or get_scheduler()
+        self.priority = priority
         self.total_costs = 0
+        # answer_question_map_reduce calls the API from multiple threads
+        self.costs_lock = threading.Lock()
+        # Cache of generate_paragraph_titles and generate_paragraph_chunk_information. Only used when LLM_RESPONSE_CACHE is set
+        if response_cache is None and os.getenv("LLM_RESPONSE_CACHE"):
+            response_cache = LLMResponseCache(os.getenv("LLM_RESPONSE_CACHE"))
+        self.response_cache:LLMResponseCache = response_cache
+
+    def create_completion(self, **kwargs):
+        """ Same as self.client.chat.completions.create without streaming, but through the scheduler if there is one """
+        if self.scheduler is not None:
+            return self.scheduler.chat_completion_sync(self.priority, **kwargs)
+        return self.client.chat.completions.create(**kwargs)
+
+    def track_costs(self, response) -> None:
+        with self.costs_lock:
+            self.total_costs += response.usage.prompt_tokens * self.api_costs[response.model]["input"]
+            self.total_costs += response.usage.completion_tokens * self.api_costs[response.model]["output"]
+
+    def complete_json_cached(self, name:str, version:str, prompt:str, model:str, brackets:str) -> object | None:
+        """ Completes a single user prompt, and parses the JSON between the outermost brackets, e.g. "{}" or "[]", of the response.
+        The response is looked up in and stored in the response cache, keyed by the prompt name, model, version and the prompt itself.
+        Responses that can't be parsed are not cached, so that they are retried on the next run. Returns None if parsing fails """
+        response_text = None
+        if self.response_cache is not None:
+            response_text = self.response_cache.get(name, model, version, prompt)
+
+        is_cached = response_text is not None
+        if not is_cached:
+            response = self.create_completion(
+                model=model,
+                messages=[{
+                    'role': 'user',
+                    'content': prompt
+                }]
+            )
+            self.track_costs(response)
+
+            response_text = response.choices[0].message.content.strip()
+            response_text = response_text[response_text.find(brackets[0]):response_text.rfind(brackets[1])+1]
+
+        try:
+            result = json.loads(response_text)
+        except json.JSONDecodeError:
+            logger.error(f"Failed to parse response: {response_text}")
+            return None
+
+        if self.response_cache is not None and not is_cached:
+            self.response_cache.put(name, model, version, prompt, response_text)
+        return result
 
     def generate_paragraph_titles(self, feature_string:str, hint_string:str="",model="gpt-4o-mini") -> list[str]:
         """
         Generate paragraph titles using OpenAI's LLM.
         """
         
-        prompt = (
-            "The overal goal of your task is paragraph extraction from a PDF based on titles, headers, subheaders, and subsubheaders. "
-            "You will receive a list of lines extracted from a PDF. These lines are chosen specifically because they differ from 'normal' text lines. "
-            "Each line type could be a possible title, header, subheader, or subsubheader. There is also the possiblity that a line is simply nothing. "
-            "For each line, you will receive its line number, its text, and a list of corresponding features. "
-            "For each line, decide if the type is a title, header, subheader, subsubheader, or nothing. "
-            "For each line, respond with a list [line number, line text, line type]. "
-            "Use the following line type mapping: title=0, header=1, subheader=2, subsubheader=3, nothing=99. "
-            "Be conservative. It's better to miss a few titles or headers than too have too much. Precision over recall."
-            "Rule: if one header or subheader starts with a number, they all do. If a line does not have a number while there are headers or subheaders with a number, then the line is probably a subsubheader. "
-            "Rule: a header should always be followed by a subheader, and a subheader should always be followed by a subsubheader. "
-            "Rule: the feature 'group' is very important. All titles, headers, subheaders, and subsubheaders should be in the same group. "
-            #"Rule: it is more like that a line is a header than a subheader or subsubheader. Make more headers"
-            "Rule: a group of headers or subheader should be sequential and start with 1 or a or A. If it doesn't start with 1, then it is probably nothing. "
-            "Respond with a JSON list of tuples. \n"
-        )
-
+        prompt = PROMPT_PARAGRAPH_TITLES
         if len(hint_string):
-            prompt += (
-                "The following line types have already be determined and can be used as a guideline. These are not leading, and might be wrong, and can be disregarded if they are wrong. \n"
-                f"{hint_string} \n"
-            )
-
-        prompt += (
-            "Process the following lines: \n"
-            f"{feature_string} \n"
-        )
+            prompt += PROMPT_PARAGRAPH_TITLES_HINT.format(hint_string=hint_string)
+        prompt += PROMPT_PARAGRAPH_TITLES_LINES.format(feature_string=feature_string)
 
-        response = self.client.chat.completions.create(
-            model=model,
-            messages=[{
-                'role': 'user',
-                'content': prompt
-            }]
-        )
-
-        self.total_costs += response.usage.prompt_tokens * self.api_costs[response.model]["input"]
-        self.total_costs += response.usage.completion_tokens * self.api_costs[response.model]["output"]
+        response_obj = self.complete_json_cached("paragraph_titles", PROMPT_PARAGRAPH_TITLES_VERSION, prompt, model, "[]")
 
         print("Total costs: ", self.total_costs)
 
-        response_text = response.choices[0].message.content.strip()
-        response_text = response_text[response_text.find("["):response_text.rfind("]")+1]
-
-        try:
-            return [ tuple(_) for _ in json.loads(response_text) ]
-        except json.JSONDecodeError:
-            logger.error(f"Failed to parse response: {response_text}")
-            return []
+        return [] if response_obj is None else [ tuple(_) for _ in response_obj ]
 
     def generate_paragraph_chunk_information(self, chunk:ParagraphChunk, n_questions:int=3, model="gpt-4o-mini") -> dict:
         """
         Generate information about a paragraph using OpenAI's LLM.
         """
         
-        prompt = (
-            f"Analyze the following paragraph and provide a response in JSON format with two fields: "
-            # f"'summary' (a brief summary of the paragraph), "
-            f"'questions_specific' (a list of {n_questions} questions or less that the paragraph would answer, specifically for this league team year product algorithm). "
-            f"'questions_generic' (a list of {n_questions} questions or less that the paragraph would answer, without referencing team specifics, source specifics, product names etc). "
-            # f"'keywords' (a list of important keywords from the paragraph), "
-            # f"'domain_specific' (a list of domain-specific words from the paragraph, that could be unknown to any reader or dictionary). "
-            f"Keep in mind that the questions should be useful. Ensure that questions_specific are specific. For example, say 'ball sensor' instead of 'sensor', or 'dribbler motor' instead of 'motor'."
-            f"It is better to have fewer questions that are more useful than more questions that are less useful or too obvious. "
-            f"The source of the following paragraph is as follows: league={chunk.tdp_name.league.name_pretty}, team={chunk.tdp_name.team_name.name_pretty}, year={chunk.tdp_name.year}."
-            f"\n\n"
-            f"Paragraph: {chunk.text}"
-        )
-
-        response = self.client.chat.completions.create(
-            model=model,
-            messages=[{
-                'role': 'user',
-                'content': prompt
-            }]
+        prompt = PROMPT_PARAGRAPH_CHUNK_INFORMATION.format(
+            n_questions=n_questions,
+            league=chunk.tdp_name.league.name_pretty,
+            team=chunk.tdp_name.team_name.name_pretty,
+            year=chunk.tdp_name.year,
+            text=chunk.text
         )
 
-        self.total_costs += response.usage.prompt_tokens * self.api_costs[response.model]["input"]
-        self.total_costs += response.usage.completion_tokens * self.api_costs[response.model]["output"]
+        response_obj = self.complete_json_cached("paragraph_chunk_information", PROMPT_PARAGRAPH_CHUNK_INFORMATION_VERSION, prompt, model, "{}")
 
-        response_text = response.choices[0].message.content.strip()
-        # if response_text.startswith("json"): response_text = response_text[4:]
-        # response_text = response_text.replace("```", "")
-        # Trim from first '{' to last '}'
-        response_text = response_text[response_text.find("{"):response_text.rfind("}")+1]
+        return {} if response_obj is None else response_obj
 
-        try:
-            return json.loads(response_text)
-        except json.JSONDecodeError:
-            logger.error(f"Failed to decode response from OpenAI: {response_text}")
-            return {}
-
-    def answer_question(self, question:str, source_text:str, model="gpt-4o-mini") -> str:
+    def answer_question_messages(self, question:str, source_text:str) -> list[dict]:
         """
-        Ask a question about a source text using OpenAI's LLM.
+        Create the messages for answer_question and answer_question_stream.
         """
         # * Format sources as follows: ### {{team}} {{year}}, {{league}} : {{paragraph title}}
         system_role = f"""
@@ -194,20 +229,107 @@ exhaustively answer the following question (ignore paragraphs without relevant d
         #     'content': "For each paragraph given, answer the following question (ignore paragraphs without relevant data), and end with a summary: " + question
         # })
 
+        return messages
+
+    def track_answer_costs(self, model:str, response_model:str, usage) -> None:
+        if response_model in self.api_costs:
+            cost_input = usage.prompt_tokens * self.api_costs[response_model]["input"]
+            cost_output = usage.completion_tokens * self.api_costs[response_model]["output"]
+            with self.costs_lock:
+                self.total_costs += cost_input + cost_output
+            logger.info(f"Model: {model}, tokens in: {usage.prompt_tokens}, tokens out: {usage.completion_tokens}, cost in: {cost_input}, cost out: {cost_output}")
+        else:
+            logger.error(f"Model {response_model} not found in API costs")
+
+    def answer_question(self, question:str, source_text:str, model="gpt-4o-mini") -> str:
+        """
+        Ask a question about a source text using OpenAI's LLM.
+        """
+        messages = self.answer_question_messages(question, source_text)
+
         # The messages are now ready to be sent to the OpenAI API
-        response = self.client.chat.completions.create(
+        response = self.create_completion(
             model=model,
             messages=messages
         )
 
-        if response.model in self.api_costs:
-            cost_input = response.usage.prompt_tokens * self.api_costs[response.model]["input"]
-            cost_output = response.usage.completion_tokens * self.api_costs[response.model]["output"]
-            self.total_costs += cost_input + cost_output
-            logger.info(f"Model: {model}, tokens in: {response.usage.prompt_tokens}, tokens out: {response.usage.completion_tokens}, cost in: {cost_input}, cost out: {cost_output}")
-        else:
-            logger.error(f"Model {response.model} not found in API costs")
+        self.track_answer_costs(model, response.model, response.usage)
 
         # print(response)
 
-        return response.choices[0].message.content.strip()
\ No newline at end of file
+        return response.choices[0].message.content.strip()
+
+    def answer_question_stream(self, question:str, source_text:str, model="gpt-4o-mini") -> Iterator[str]:
+        """
+        Same as answer_question, but yields the answer piece by piece while it is being generated.
+        """
+        messages = self.answer_question_messages(question, source_text)
+
+        # A stream can't be sent from the loop of the scheduler, so only wait for capacity here, and settle once the usage is known
+        n_tokens_estimated = None
+        if self.scheduler is not None:
+            n_tokens_estimated = estimate_chat_tokens(model, messages)
+            self.scheduler.acquire_sync(model, n_tokens_estimated, self.priority)
+
+        # include_usage adds a final chunk without choices, that holds the token usage of the whole completion
+        stream = self.client.chat.completions.create(
+            model=model,
+            messages=messages,
+            stream=True,
+            stream_options={"include_usage": True}
+        )
+
+        try:
+            for chunk in stream:
+                if chunk.usage is not None:
+                    self.track_answer_costs(model, chunk.model, chunk.usage)
+                    if n_tokens_estimated is not None: self.scheduler.settle(model, n_tokens_estimated, chunk.usage.total_tokens)
+                if len(chunk.choices) and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+        finally:
+            # Closes the connection if the consumer stops early, e.g. because the client disconnected
+            stream.close()
+
+    def extract_facts(self, question:str, source_text:str, model="gpt-4o-mini") -> str:
+        """
+        Extract the facts that are relevant to a question from a source text, each with its source id. Returns an empty string if
+        there are none. Used as the map stage of answer_question_map_reduce.
+        """
+        system_role = f"""
+You will be given a question from a participant in the RoboCup and a list of paragraphs, each with an id.
+
+Your task:
+    * Extract every fact from the paragraphs that is relevant to the question. Ignore paragraphs without relevant data.
+    * Give one fact per line, and end every line with the id of its paragraph, using the format [id].
+    * Keep numbers, names, part names and technical details exactly as they are in the paragraph.
+    * Do not answer the question. Do not add facts that are not in the paragraphs.
+    * If no paragraph is relevant, respond with NONE.
+
+Question: "{question}"
+"""
+        response = self.create_completion(
+            model=model,
+            messages=[
+                { 'role': 'system', 'content': system_role },
+                { 'role': 'user', 'content': source_text }
+            ]
+        )
+
+        self.track_answer_costs(model, response.model, response.usage)
+
+        facts = response.choices[0].message.content.strip()
+        return "" if facts == "NONE" else facts
+
+    def answer_question_map_reduce(self, question:str, source_texts:list[str], model="gpt-4o-mini", max_workers:int=4) -> str:
+        """
+        Answer a question about a list of source texts, e.g. groups of paragraphs. The relevant facts are first extracted from every
+        source text in parallel, with at most max_workers requests in flight. The answer is then generated from the facts only. Since
+        every fact keeps the [id] of its paragraph, the answer cites the same ids as answer_question would.
+        """
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            facts = list(executor.map(lambda source_text: self.extract_facts(question, source_text, model), source_texts))
+
+        facts = [ _ for _ in facts if len(_) ]
+        logger.info(f"Extracted facts from {len(facts)}/{len(source_texts)} groups of paragraphs")
+
+        return self.answer_question(question, "\n\n".join(facts), model=model)
@@ -0,0 +1,331 @@
+# System libraries
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
+import asyncio
+from concurrent.futures import Future
+import functools
+import heapq
+import itertools
+import json
+import random
+import threading
+import time
+# Third party libraries
+from openai import AsyncOpenAI, RateLimitError
+import tiktoken
+# Local libraries
+from MyLogger import logger
+
+# Requests of a lower number go first. Ingestion also leaves SERVING_RESERVE of every limit unused, see ModelLimiter
+PRIORITY_SERVING = 0
+PRIORITY_INGESTION = 1
+
+# Requests per minute and tokens per minute, per model. Roughly the limits of usage tier 1. Override them with the environment variable
+# OPENAI_RATE_LIMITS, e.g. '{"gpt-4o-mini": [5000, 2000000]}'. Models that are not listed are not rate limited
+DEFAULT_RATE_LIMITS = {
+    "gpt-3.5-turbo": (3_500, 200_000),
+    "gpt-4o": (500, 30_000),
+    "gpt-4o-mini": (500, 200_000),
+    "text-embedding-3-small": (3_000, 1_000_000),
+    "text-embedding-3-large": (3_000, 1_000_000),
+}
+
+# Fraction of every limit that ingestion-priority requests can't use. A user query then finds capacity right away, even while a bulk
+# job is saturating the limits. This also holds when the API and process_tdps.py run as separate processes with their own scheduler
+SERVING_RESERVE = 0.2
+
+# Tokens that the chat format adds per message, and per completion
+TOKENS_PER_MESSAGE = 4
+TOKENS_PER_COMPLETION = 3
+
+# Seconds. Backoff of requests that hit the rate limit anyway, e.g. because another process uses the same API key
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 60
+
+def get_retry_after(e:Exception) -> float | None:
+    """ Returns the number of seconds in the Retry-After (or retry-after-ms) header of a failed OpenAI request, if any """
+    response = getattr(e, "response", None)
+    if response is None: return None
+    try:
+        if "retry-after-ms" in response.headers: return float(response.headers["retry-after-ms"]) / 1000
+        if "retry-after" in response.headers: return float(response.headers["retry-after"])
+    except ValueError:
+        # Retry-After can also be an HTTP date. Fall back to the exponential backoff
+        return None
+    return None
+
+@functools.lru_cache(maxsize=None)
+def get_model_encoding(model:str) -> tiktoken.Encoding:
+    """ The tokenizer of a model, e.g. o200k_base for gpt-4o. Falls back to cl100k_base for models that tiktoken doesn't know """
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+def estimate_chat_tokens(model:str, messages:list[dict], max_tokens:int=None) -> int:
+    """ Tokens of a chat completion request, as counted against the rate limit: the input, plus max_tokens if given """
+    encoding = get_model_encoding(model)
+    n_tokens = sum([ TOKENS_PER_MESSAGE + len(encoding.encode(message['content'], disallowed_special=())) for message in messages ])
+    return n_tokens + TOKENS_PER_COMPLETION + (max_tokens or 0)
+
+def estimate_embedding_tokens(model:str, texts:str | list[str]) -> int:
+    texts = [texts] if isinstance(texts, str) else texts
+    return sum([ len(tokens) for tokens in get_model_encoding(model).encode_batch(texts, disallowed_special=()) ])
+
+def get_rate_limits() -> dict[str, tuple[int, int]]:
+    rate_limits = dict(DEFAULT_RATE_LIMITS)
+    rate_limits.update({ model: tuple(limits) for model, limits in json.loads(os.getenv("OPENAI_RATE_LIMITS") or "{}").items() })
+    return rate_limits
+
+class TokenBucket:
+    """ Holds at most capacity units, and refills at capacity units per minute. The level goes negative when a request turns out to
+    use more than estimated, which then delays the requests after it """
+
+    def __init__(self, capacity:float) -> None:
+        self.capacity = capacity
+        self.level = capacity
+        self.per_second = capacity / 60
+        self.t_updated = time.monotonic()
+
+    def refill(self) -> None:
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.t_updated) * self.per_second)
+        self.t_updated = now
+
+    def seconds_until(self, amount:float, reserve:float=0) -> float:
+        """ Seconds until amount can be taken while leaving reserve in the bucket. A request larger than the bucket waits for a full bucket """
+        self.refill()
+        needed = min(amount, self.capacity - reserve) + reserve
+        return max(0, (needed - self.level) / self.per_second)
+
+    def take(self, amount:float) -> None:
+        """ A negative amount returns units, e.g. when a request used fewer tokens than estimated """
+        self.refill()
+        self.level = min(self.capacity, self.level - amount)
+
+class ModelLimiter:
+    """ Meters the requests per minute and tokens per minute of a single model. Waiting requests are granted strictly by priority, and
+    first come first served within a priority. Lives on the event loop of the scheduler, and must only be used from that loop """
+
+    def __init__(self, model:str, rpm:int, tpm:int, serving_reserve:float) -> None:
+        self.model = model
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.serving_reserve = serving_reserve
+        self.waiters:list[tuple[int, int, int, asyncio.Future]] = [] # heap of (priority, sequence, tokens, future)
+        self.sequence = itertools.count()
+        self.changed = asyncio.Event()
+        self.paused_until = 0
+
+        self.n_granted = { PRIORITY_SERVING: 0, PRIORITY_INGESTION: 0 }
+        self.seconds_waited = { PRIORITY_SERVING: 0, PRIORITY_INGESTION: 0 }
+        self.n_rate_limited = 0
+
+        self.task = asyncio.get_running_loop().create_task(self.dispatch())
+
+    async def acquire(self, n_tokens:int, priority:int) -> None:
+        """ Waits until the request may be sent """
+        t_start = time.monotonic()
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (priority, next(self.sequence), n_tokens, future))
+        self.changed.set()
+        await future
+        self.n_granted[priority] = self.n_granted.get(priority, 0) + 1
+        self.seconds_waited[priority] = self.seconds_waited.get(priority, 0) + time.monotonic() - t_start
+
+    def settle(self, n_tokens_estimated:int, n_tokens_used:int) -> None:
+        """ Corrects the token bucket once the actual usage of a request is known """
+        self.tokens.take(n_tokens_used - n_tokens_estimated)
+        self.changed.set()
+
+    def pause(self, seconds:float) -> None:
+        """ Holds all requests, e.g. after OpenAI responded with 429 """
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.n_rate_limited += 1
+        self.changed.set()
+
+    async def dispatch(self) -> None:
+        while True:
+            self.changed.clear()
+            # Drop requests of callers that stopped waiting
+            while len(self.waiters) and self.waiters[0][3].done():
+                heapq.heappop(self.waiters)
+            if not len(self.waiters):
+                await self.changed.wait()
+                continue
+
+            priority, _, n_tokens, future = self.waiters[0]
+            reserve = 0 if priority <= PRIORITY_SERVING else self.serving_reserve
+            delay = max(
+                self.requests.seconds_until(1, reserve * self.requests.capacity),
+                self.tokens.seconds_until(n_tokens, reserve * self.tokens.capacity),
+                self.paused_until - time.monotonic()
+            )
+            if delay <= 0:
+                heapq.heappop(self.waiters)
+                self.requests.take(1)
+                self.tokens.take(n_tokens)
+                future.set_result(None)
+                continue
+
+            # Wakes up early if a request of a higher priority arrives, or if capacity was returned
+            try:
+                await asyncio.wait_for(self.changed.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def report(self) -> str:
+        waiting = { PRIORITY_SERVING: 0, PRIORITY_INGESTION: 0 }
+        for priority, _, _, future in self.waiters:
+            if not future.done(): waiting[priority] = waiting.get(priority, 0) + 1
+        mean_wait = { priority: self.seconds_waited[priority] / max(1, n) for priority, n in self.n_granted.items() }
+        return (f"{self.model:>24} | requests {self.requests.level:8.0f}/{self.requests.capacity:<8.0f} | tokens {self.tokens.level:10.0f}/{self.tokens.capacity:<10.0f} | "
+                f"serving {self.n_granted[PRIORITY_SERVING]:6} waiting {waiting[PRIORITY_SERVING]:3} mean wait {mean_wait[PRIORITY_SERVING]:6.2f}s | "
+                f"ingestion {self.n_granted[PRIORITY_INGESTION]:6} waiting {waiting[PRIORITY_INGESTION]:4} mean wait {mean_wait[PRIORITY_INGESTION]:6.2f}s | "
+                f"429s {self.n_rate_limited}")
+
+class OpenAIScheduler:
+    """ Sends OpenAI requests from a single asyncio event loop, which runs on a background thread. Every model has a ModelLimiter that
+    meters its requests per minute and tokens per minute. Tokens are estimated with tiktoken before a request is sent, and corrected
+    with the usage in the response.
+
+    Works from any thread and from any event loop: blocking code, such as the thread pools of process_tdps.py and the Flask app, calls
+    the *_sync methods, and asyncio code awaits the async methods. Either way the request itself runs on the loop of the scheduler, so
+    that all requests of a process share one set of limits and one AsyncOpenAI connection pool. Use get_scheduler() for that instance.
+    """
+
+    def __init__(self, rate_limits:dict[str, tuple[int, int]], serving_reserve:float=SERVING_RESERVE, max_retries:int=6) -> None:
+        self.rate_limits = rate_limits
+        self.serving_reserve = serving_reserve
+        self.max_retries = max_retries
+        self.lock = threading.Lock()
+        self.loop:asyncio.AbstractEventLoop = None
+        self.loop_pid:int = None
+        self.limiters:dict[str, ModelLimiter] = {}
+        self.client:AsyncOpenAI = None
+
+    def get_loop(self) -> asyncio.AbstractEventLoop:
+        """ Starts the event loop on first use. A forked process, such as an extraction process, starts its own """
+        with self.lock:
+            if self.loop is None or self.loop_pid != os.getpid():
+                self.loop, self.loop_pid = asyncio.new_event_loop(), os.getpid()
+                self.limiters, self.client = {}, None
+                threading.Thread(target=self.loop.run_forever, name="OpenAIScheduler", daemon=True).start()
+            return self.loop
+
+    def run(self, coroutine) -> Future:
+        return asyncio.run_coroutine_threadsafe(coroutine, self.get_loop())
+
+    def limiter(self, model:str) -> ModelLimiter | None:
+        """ The limiter of a model, e.g. "gpt-4o-mini-2024-07-18" falls under "gpt-4o-mini". Must be called on the loop """
+        if model not in self.limiters:
+            names = [ name for name in self.rate_limits if model.startswith(name) ]
+            if not len(names):
+                self.limiters[model] = None
+            else:
+                rpm, tpm = self.rate_limits[max(names, key=len)]
+                self.limiters[model] = ModelLimiter(model, rpm, tpm, self.serving_reserve)
+        return self.limiters[model]
+
+    async def _acquire(self, model:str, n_tokens:int, priority:int) -> None:
+        limiter = self.limiter(model)
+        if limiter is not None: await limiter.acquire(n_tokens, priority)
+
+    def _settle(self, model:str, n_tokens_estimated:int, n_tokens_used:int) -> None:
+        limiter = self.limiters.get(model)
+        if limiter is not None: limiter.settle(n_tokens_estimated, n_tokens_used)
+
+    async def _request(self, kind:str, priority:int, kwargs:dict, max_retries:int=None):
+        """ max_retries overrides self.max_retries. Callers with a retry loop of their own pass 0, so that attempts don't multiply """
+        if max_retries is None: max_retries = self.max_retries
+        if self.client is None:
+            # The retries of the OpenAI client itself are disabled. Rate limits are retried here, after pausing the whole model
+            self.client = AsyncOpenAI(max_retries=0)
+
+        model = kwargs['model']
+        if kind == "chat":
+            n_tokens = estimate_chat_tokens(model, kwargs['messages'], kwargs.get('max_tokens'))
+        else:
+            n_tokens = estimate_embedding_tokens(model, kwargs['input'])
+
+        for attempt in range(max_retries + 1):
+            await self._acquire(model, n_tokens, priority)
+            try:
+                if kind == "chat":
+                    response = await self.client.chat.completions.create(**kwargs)
+                else:
+                    response = await self.client.embeddings.create(**kwargs)
+                self._settle(model, n_tokens, response.usage.total_tokens)
+                return response
+            except RateLimitError as e:
+                delay = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2**attempt))
+                retry_after = get_retry_after(e)
+                if retry_after is not None: delay = max(delay, retry_after)
+                # The model is paused even if this request gives up, so that all other requests to it back off as well
+                limiter = self.limiters.get(model)
+                if limiter is not None: limiter.pause(delay)
+                if max_retries <= attempt:
+                    if 0 < max_retries: logger.error(f"Request to {model} failed after {attempt+1} attempts: {e}")
+                    raise e
+                logger.warning(f"Rate limited on {model}, pausing it for {delay:.2f}s ({attempt+1}/{max_retries})")
+                if limiter is None: await asyncio.sleep(delay)
+
+    """ asyncio """
+
+    async def chat_completion(self, priority:int=PRIORITY_SERVING, **kwargs):
+        """ Same arguments as AsyncOpenAI().chat.completions.create, without streaming """
+        return await asyncio.wrap_future(self.run(self._request("chat", priority, kwargs)))
+
+    async def embeddings(self, priority:int=PRIORITY_SERVING, max_retries:int=None, **kwargs):
+        """ Same arguments as AsyncOpenAI().embeddings.create """
+        return await asyncio.wrap_future(self.run(self._request("embeddings", priority, kwargs, max_retries)))
+
+    """ Blocking """
+
+    def chat_completion_sync(self, priority:int=PRIORITY_SERVING, **kwargs):
+        return self.run(self._request("chat", priority, kwargs)).result()
+
+    def embeddings_sync(self, priority:int=PRIORITY_SERVING, max_retries:int=None, **kwargs):
+        return self.run(self._request("embeddings", priority, kwargs, max_retries)).result()
+
+    def acquire_sync(self, model:str, n_tokens:int, priority:int=PRIORITY_SERVING) -> None:
+        """ Waits for capacity without sending anything, for requests that are sent elsewhere, e.g. streaming completions. Call
+        settle() once the usage is known """
+        self.run(self._acquire(model, n_tokens, priority)).result()
+
+    def settle(self, model:str, n_tokens_estimated:int, n_tokens_used:int) -> None:
+        self.get_loop().call_soon_threadsafe(self._settle, model, n_tokens_estimated, n_tokens_used)
+
+    def report(self) -> str:
+        async def report():
+            return "\n".join([ limiter.report() for limiter in self.limiters.values() if limiter is not None ])
+        return self.run(report()).result()
+
+scheduler:OpenAIScheduler = None
+scheduler_lock = threading.Lock()
+
+def get_scheduler() -> OpenAIScheduler | None:
+    """ The scheduler shared by all OpenAI clients of this process. None if OPENAI_RATE_LIMITS is not set, e.g. '{}' for the default limits """
+    global scheduler
+    if os.getenv("OPENAI_RATE_LIMITS") is None: return None
+    with scheduler_lock:
+        if scheduler is None:
+            scheduler = OpenAIScheduler(get_rate_limits())
+        return scheduler
+
+if __name__ == "__main__":
+    # Fills a tiny bucket with ingestion requests, then shows that a serving request still goes first
+    async def demo():
+        limiter = ModelLimiter("demo", rpm=60, tpm=6000, serving_reserve=SERVING_RESERVE)
+        t_start = time.monotonic()
+        async def request(name:str, priority:int):
+            await limiter.acquire(1000, priority)
+            print(f"{time.monotonic() - t_start:5.2f}s {name}")
+        tasks = [ asyncio.create_task(request(f"ingestion {i}", PRIORITY_INGESTION)) for i in range(6) ]
+        await asyncio.sleep(0.5)
+        tasks.append(asyncio.create_task(request("serving", PRIORITY_SERVING)))
+        await asyncio.gather(*tasks)
+        print(limiter.report())
+    asyncio.run(demo())
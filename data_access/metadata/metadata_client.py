@@ -4,8 +4,10 @@ import sys
 sys.path.append(os.path.dirname(os.path.dirname(__file__)))
 sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
 from abc import ABC, abstractmethod
+import time
 # Third party libraries
 import pymongo
+from pymongo import ReturnDocument
 import pymongo.collection
 import pymongo.database
 from pymongo.mongo_client import MongoClient
@@ -169,11 +171,17 @@ class MongoDBClient(MetadataTDPClient, MetadataParagraphClient):
         col:pymongo.collection.Collection = db.get_collection("tdp")
         tdp = col.find_one({ "team": tdp_name.team_name.name, "year": tdp_name.year, "league": tdp_name.league.name, "index": tdp_name.index })
         if tdp is None: return None
+        return self.tdp_from_document(tdp)
+
+    def tdp_from_document(self, tdp:dict) -> TDP:
         tdp_obj = TDP(TDPName.from_string(tdp["filename"]).set_filehash(tdp["filehash"]))
         tdp_obj.state = {
             "run_id": tdp["state"]["run_id"],
             "process_state": ProcessStateEnum.from_string(tdp["state"]["process_state"]),
-            "error": tdp["state"]["error"]
+            "error": tdp["state"]["error"],
+            # Only set for TDPs that went through the work queue
+            "worker": tdp["state"].get("worker"),
+            "attempts": tdp["state"].get("attempts", 0)
         }
         return tdp_obj
 
@@ -187,6 +195,116 @@ class MongoDBClient(MetadataTDPClient, MetadataParagraphClient):
         col:pymongo.collection.Collection = db.get_collection("tdp")
         col.drop()
 
+    """ Work queue. Workers on any number of machines claim PENDING or FAILED TDPs, and hold a lease on them while processing """
+
+    def enqueue_tdp(self, tdp_name:TDPName, filehash:str) -> bool:
+        """ Adds the TDP as PENDING, unless it is already known in any state. Returns True if it was added """
+        db:pymongo.database.Database = self.client.get_database("metadata")
+        col:pymongo.collection.Collection = db.get_collection("tdp")
+        tdp = TDP(tdp_name, filehash=filehash)
+        result = col.update_one(
+            { "team": tdp_name.team_name.name, "year": tdp_name.year, "league": tdp_name.league.name, "index": tdp_name.index },
+            { "$setOnInsert": {
+                "team": tdp_name.team_name.name,
+                "year": tdp_name.year,
+                "league": tdp_name.league.name,
+                "index": tdp_name.index,
+                "filename": tdp_name.filename,
+                "filehash": filehash,
+                "state": {
+                    "run_id": tdp.state["run_id"],
+                    "process_state": ProcessStateEnum.to_string(ProcessStateEnum.PENDING),
+                    "error": None,
+                    "worker": None,
+                    "lease_expires": 0,
+                    "attempts": 0
+                }
+            }},
+            upsert=True
+        )
+        return result.upserted_id is not None
+
+    def claim_tdp(self, worker_id:str, lease_seconds:float, max_attempts:int) -> TDP | None:
+        """ Atomically claims a PENDING TDP, or a FAILED TDP that has been attempted less than max_attempts times. The TDP is set to
+        IN_PROGRESS with a lease of lease_seconds, which the worker has to renew with renew_tdp_lease(). Returns None if there is nothing
+        to claim. Leases use the clock of the worker, so the lease should be much longer than the clock skew between machines """
+        db:pymongo.database.Database = self.client.get_database("metadata")
+        col:pymongo.collection.Collection = db.get_collection("tdp")
+        tdp = col.find_one_and_update(
+            {
+                "state.process_state": { "$in": [ ProcessStateEnum.to_string(ProcessStateEnum.PENDING), ProcessStateEnum.to_string(ProcessStateEnum.FAILED) ] },
+                # $not also matches TDPs that were inserted before the work queue existed, which have no attempts yet
+                "state.attempts": { "$not": { "$gte": max_attempts } }
+            },
+            {
+                "$set": {
+                    "state.process_state": ProcessStateEnum.to_string(ProcessStateEnum.IN_PROGRESS),
+                    "state.worker": worker_id,
+                    "state.lease_expires": time.time() + lease_seconds
+                },
+                "$inc": { "state.attempts": 1 }
+            },
+            return_document=ReturnDocument.AFTER
+        )
+        if tdp is None: return None
+        logger.info(f"Worker {worker_id} claimed TDP {tdp['filename']} (attempt {tdp['state']['attempts']})")
+        return self.tdp_from_document(tdp)
+
+    def renew_tdp_lease(self, tdp_name:TDPName, worker_id:str, lease_seconds:float) -> bool:
+        """ Extends the lease of a claimed TDP. Returns False if the worker lost the lease, e.g. because it expired and another worker
+        claimed the TDP. The worker should then stop processing it """
+        db:pymongo.database.Database = self.client.get_database("metadata")
+        col:pymongo.collection.Collection = db.get_collection("tdp")
+        result = col.update_one(
+            { "team": tdp_name.team_name.name, "year": tdp_name.year, "league": tdp_name.league.name, "index": tdp_name.index,
+              "state.worker": worker_id, "state.process_state": ProcessStateEnum.to_string(ProcessStateEnum.IN_PROGRESS) },
+            { "$set": { "state.lease_expires": time.time() + lease_seconds } }
+        )
+        return 0 < result.matched_count
+
+    def release_tdp(self, tdp_name:TDPName, worker_id:str, process_state:ProcessStateEnum, error:str=None) -> bool:
+        """ Sets the final state of a claimed TDP, e.g. COMPLETED or FAILED. Returns False if the worker no longer holds the lease, in
+        which case the state is left to the worker that does """
+        db:pymongo.database.Database = self.client.get_database("metadata")
+        col:pymongo.collection.Collection = db.get_collection("tdp")
+        result = col.update_one(
+            { "team": tdp_name.team_name.name, "year": tdp_name.year, "league": tdp_name.league.name, "index": tdp_name.index,
+              "state.worker": worker_id, "state.process_state": ProcessStateEnum.to_string(ProcessStateEnum.IN_PROGRESS) },
+            { "$set": { "state.process_state": ProcessStateEnum.to_string(process_state), "state.error": error, "state.lease_expires": 0 } }
+        )
+        if result.matched_count == 0:
+            logger.warning(f"Worker {worker_id} no longer holds the lease on TDP {tdp_name}, not setting it to {process_state}")
+            return False
+        logger.info(f"Released TDP {tdp_name} with state {process_state}")
+        return True
+
+    def requeue_expired_tdps(self, max_attempts:int) -> int:
+        """ Puts IN_PROGRESS TDPs whose lease expired, e.g. because their worker crashed, back to PENDING. TDPs that already had
+        max_attempts attempts are set to FAILED instead. This includes IN_PROGRESS TDPs without a lease, left behind by a crashed run
+        that did not use the work queue. Returns the number of TDPs that were requeued """
+        db:pymongo.database.Database = self.client.get_database("metadata")
+        col:pymongo.collection.Collection = db.get_collection("tdp")
+        expired = {
+            "state.process_state": ProcessStateEnum.to_string(ProcessStateEnum.IN_PROGRESS),
+            "state.lease_expires": { "$not": { "$gte": time.time() } }
+        }
+        n_failed = col.update_many(
+            { **expired, "state.attempts": { "$gte": max_attempts } },
+            { "$set": { "state.process_state": ProcessStateEnum.to_string(ProcessStateEnum.FAILED), "state.error": "Lease expired", "state.lease_expires": 0 } }
+        ).modified_count
+        n_requeued = col.update_many(
+            expired,
+            { "$set": { "state.process_state": ProcessStateEnum.to_string(ProcessStateEnum.PENDING), "state.lease_expires": 0 } }
+        ).modified_count
+        if n_failed or n_requeued:
+            logger.info(f"Requeued {n_requeued} TDPs with an expired lease. {n_failed} TDPs failed too often and were set to FAILED")
+        return n_requeued
+
+    def count_tdps_by_process_state(self) -> dict[str, int]:
+        db:pymongo.database.Database = self.client.get_database("metadata")
+        col:pymongo.collection.Collection = db.get_collection("tdp")
+        return { group["_id"]: group["count"] for group in col.aggregate([{ "$group": { "_id": "$state.process_state", "count": { "$sum": 1 } } }]) }
+
     def ensure_collection_tdp(self):
         # self.client.drop_database("metadata")
         # Ensure that database "metadata" exists
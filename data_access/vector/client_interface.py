@@ -3,9 +3,13 @@ import os
 import sys
 sys.path.append(os.path.dirname(os.path.dirname(__file__)))
 from abc import ABC, abstractmethod
+import hashlib
+import json
 # Local libraries
 from data_structures.Sentence import Sentence
 from data_structures.Paragraph import Paragraph
+from data_structures.ParagraphChunk import ParagraphChunk
+from uniqid import uniqid
 
 class ClientInterface(ABC):
     """Abstract class that holds the data access interface for the client"""
@@ -14,4 +18,57 @@ class ClientInterface(ABC):
     # def reset_everything(self) -> None:
     #     """Resets the client"""
     #     raise NotImplementedError
-        
\ No newline at end of file
+
+""" Vector ids and metadata, shared by all vector clients so that they all store exactly the same records """
+
+def paragraph_chunk_vector_id(chunk:ParagraphChunk) -> str:
+    return chunk.tdp_name.filename + "__" + str(chunk.paragraph_sequence_id) + "__" + str(chunk.sequence_id)
+
+def question_vector_id(chunk:ParagraphChunk, question_id:str) -> str:
+    return paragraph_chunk_vector_id(chunk) + "__" + question_id
+
+def paragraph_chunk_vector_id_of_question(question_vector_id:str) -> str:
+    return question_vector_id.rsplit("__", 1)[0]
+
+def tdp_filename_of_paragraph_chunk_vector_id(paragraph_chunk_vector_id:str) -> str:
+    # The TDP filename contains "__" itself, so only strip the paragraph and chunk sequence ids
+    return paragraph_chunk_vector_id.rsplit("__", 2)[0]
+
+def paragraph_chunk_hash(chunk:ParagraphChunk) -> str:
+    """ Hash of everything that ends up in the vectors of a chunk and its questions: the title, the text and the position. Used by
+    process_tdps.py --reingest to skip chunks that did not change """
+    content = json.dumps([ chunk.title, chunk.text, chunk.start, chunk.end, chunk.paragraph_sequence_id, chunk.sequence_id ])
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+def paragraph_chunk_metadata(chunk:ParagraphChunk) -> dict:
+    return {
+        'text': chunk.text,
+        'start': chunk.start,
+        'end': chunk.end,
+        'paragraph_sequence_id': chunk.paragraph_sequence_id,
+        'chunk_sequence_id': chunk.sequence_id,
+
+        'tdp_name': chunk.tdp_name.filename,
+        'paragraph_title': chunk.title,
+        'league': chunk.tdp_name.league.name,
+        'team': chunk.tdp_name.team_name.name,
+        'year': chunk.tdp_name.year,
+
+        'chunk_hash': paragraph_chunk_hash(chunk),
+        'run_id': uniqid
+    }
+
+def question_metadata(chunk:ParagraphChunk, question:str) -> dict:
+    return {
+        'question': question,
+        'paragraph_sequence_id': chunk.paragraph_sequence_id,
+        'chunk_sequence_id': chunk.sequence_id,
+        
+        'tdp_name': chunk.tdp_name.filename,
+        'paragraph_title': chunk.title,
+        'league': chunk.tdp_name.league.name,
+        'team': chunk.tdp_name.team_name.name,
+        'year': chunk.tdp_name.year,
+
+        'run_id': uniqid
+    }
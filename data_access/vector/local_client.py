@@ -0,0 +1,513 @@
+from __future__ import annotations
+# System libraries
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
+from concurrent.futures import Future
+import json
+import threading
+import time
+# Third party libraries
+import numpy as np
+from scipy.sparse import coo_array, csr_matrix
+# Local libraries
+from data_access.vector.client_interface import ClientInterface, paragraph_chunk_vector_id, question_vector_id, paragraph_chunk_metadata, question_metadata
+from data_access.vector.vector_filter import VectorFilter
+from data_structures.Paragraph import Paragraph
+from data_structures.ParagraphChunk import ParagraphChunk
+from data_structures.TDPName import TDPName
+from MyLogger import logger
+
+class LocalIndex:
+    """ Hybrid dense + sparse index that is stored on disk and queried fully in process. Scores are calculated exactly like a
+    Pinecone 'dotproduct' index does for hybrid queries: dense_vector·query_dense + sparse_vector·query_sparse.
+
+    Files in the index directory:
+        metadata.jsonl                   : One line { id, metadata } per vector, in row order
+        dense.npy                        : float32 matrix [n_vectors x dim], memory-mapped
+        sparse_vocab.npy                 : Sorted uint32 token hashes. Row i of the inverted index belongs to token sparse_vocab[i]
+        sparse_indptr.npy                : CSR inverted index, token -> range in sparse_rows / sparse_values
+        sparse_rows.npy                  : CSR inverted index, vector rows in which the token occurs
+        sparse_values.npy                : CSR inverted index, sparse values of the token in those vectors
+        filter_{league,team,year}.npy    : Precomputed columns used to apply a VectorFilter without touching the metadata
+        filter_columns.json              : Mapping from league / team code to name
+
+    Vectors that are stored or deleted are kept in memory, and only written to disk by flush(). Reads combine the index on disk with
+    these pending changes, so that reading in between writes (e.g. during ingestion) never rebuilds the index.
+
+    The index on disk is held in a single immutable State, which flush() replaces with one assignment. Every read takes one snapshot of
+    the state and the pending changes at its start, so it never mixes the arrays of two different versions of the index
+    """
+
+    FILES_NPY = ["dense", "sparse_vocab", "sparse_indptr", "sparse_rows", "sparse_values", "filter_league", "filter_team", "filter_year"]
+
+    class State:
+        def __init__(self, ids:list[str], metadatas:list[dict], arrays:dict[str, np.ndarray], filter_columns:dict[str, list[str]]) -> None:
+            self.ids = ids
+            self.metadatas = metadatas
+            self.id_to_row = { id: row for row, id in enumerate(ids) }
+            self.dense:np.ndarray = arrays['dense']
+            self.sparse_vocab:np.ndarray = arrays['sparse_vocab']
+            self.sparse_indptr:np.ndarray = arrays['sparse_indptr']
+            self.sparse_rows:np.ndarray = arrays['sparse_rows']
+            self.sparse_values:np.ndarray = arrays['sparse_values']
+            self.filter_league:np.ndarray = arrays['filter_league']
+            self.filter_team:np.ndarray = arrays['filter_team']
+            self.filter_year:np.ndarray = arrays['filter_year']
+            self.filter_columns = filter_columns
+
+        @staticmethod
+        def empty() -> LocalIndex.State:
+            return LocalIndex.State([], [], {
+                'dense': np.zeros((0, 0), dtype=np.float32),
+                'sparse_vocab': np.zeros(0, dtype=np.uint32),
+                'sparse_indptr': np.zeros(1, dtype=np.int64),
+                'sparse_rows': np.zeros(0, dtype=np.int32),
+                'sparse_values': np.zeros(0, dtype=np.float32),
+                'filter_league': np.zeros(0, dtype=np.int32),
+                'filter_team': np.zeros(0, dtype=np.int32),
+                'filter_year': np.zeros(0, dtype=np.int32),
+            }, { 'league': [], 'team': [] })
+
+    def __init__(self, root_dir:str) -> None:
+        self.root_dir = root_dir
+        os.makedirs(root_dir, exist_ok=True)
+        # Serializes flushes, which can take a while. The pending lock is only held briefly, so reads never wait for a flush
+        self.flush_lock = threading.Lock()
+        self.pending_lock = threading.Lock()
+
+        # Changes that have not been written to disk yet
+        self.pending_store:dict[str, tuple[np.ndarray, coo_array, dict]] = {}
+        self.pending_delete:set[str] = set()
+
+        self.state:LocalIndex.State = self.load()
+
+    def load(self) -> LocalIndex.State:
+        ids, metadatas = [], []
+        filepath_metadata = os.path.join(self.root_dir, "metadata.jsonl")
+        if os.path.isfile(filepath_metadata):
+            with open(filepath_metadata, "r") as file:
+                for line in file:
+                    record = json.loads(line)
+                    ids.append(record['id'])
+                    metadatas.append(record['metadata'])
+
+        if not len(ids):
+            return LocalIndex.State.empty()
+
+        arrays = { name: np.load(os.path.join(self.root_dir, f"{name}.npy"), mmap_mode='r') for name in self.FILES_NPY }
+        with open(os.path.join(self.root_dir, "filter_columns.json"), "r") as file:
+            filter_columns = json.load(file)
+
+        return LocalIndex.State(ids, metadatas, arrays, filter_columns)
+
+    def snapshot(self) -> tuple[LocalIndex.State, dict[str, tuple[np.ndarray, coo_array, dict]], set[str]]:
+        """ Returns the state and copies of the pending changes, consistent with each other """
+        with self.pending_lock:
+            return self.state, dict(self.pending_store), set(self.pending_delete)
+
+    def flush(self) -> None:
+        """ Write all pending stores and deletes to disk, and reload the index """
+        with self.flush_lock:
+            state, pending_store, pending_delete = self.snapshot()
+            if not len(pending_store) and not len(pending_delete): return
+
+            t_start = time.time()
+
+            # Rows that survive. Overwritten rows are removed and added again at the end
+            keep_rows = np.array([ row for row, id in enumerate(state.ids) if id not in pending_delete and id not in pending_store ], dtype=np.int64)
+            row_map = np.full(len(state.ids), -1, dtype=np.int64)
+            row_map[keep_rows] = np.arange(len(keep_rows))
+            n_kept = len(keep_rows)
+
+            ids = [ state.ids[row] for row in keep_rows ] + list(pending_store.keys())
+            metadatas = [ state.metadatas[row] for row in keep_rows ] + [ _[2] for _ in pending_store.values() ]
+
+            # Dense matrix
+            dense_new = [ np.asarray(_[0], dtype=np.float32) for _ in pending_store.values() ]
+            dense_kept = np.asarray(state.dense[keep_rows]) if n_kept else np.zeros((0, len(dense_new[0]) if len(dense_new) else 0), dtype=np.float32)
+            dense = np.vstack([dense_kept] + dense_new) if len(dense_new) else dense_kept
+
+            # Sparse inverted index. Convert back to (token hash, row, value) triplets, drop removed rows, add new rows, and rebuild
+            n_per_token = np.diff(state.sparse_indptr)
+            hashes = np.repeat(np.asarray(state.sparse_vocab, dtype=np.int64), n_per_token)
+            rows = row_map[np.asarray(state.sparse_rows, dtype=np.int64)]
+            values = np.asarray(state.sparse_values, dtype=np.float32)
+            is_kept = 0 <= rows
+            hashes, rows, values = [hashes[is_kept]], [rows[is_kept]], [values[is_kept]]
+            for i_new, (_, sparse_vector, _) in enumerate(pending_store.values()):
+                hashes.append(np.asarray(sparse_vector.col, dtype=np.int64))
+                rows.append(np.full(len(sparse_vector.col), n_kept + i_new, dtype=np.int64))
+                values.append(np.asarray(sparse_vector.data, dtype=np.float32))
+            hashes, rows, values = np.concatenate(hashes), np.concatenate(rows), np.concatenate(values)
+
+            sparse_vocab, token_idx = np.unique(hashes, return_inverse=True)
+            inverted = csr_matrix((values, (token_idx, rows)), shape=(len(sparse_vocab), len(ids)), dtype=np.float32)
+            inverted.sum_duplicates()
+            inverted.sort_indices()
+
+            # Filter columns
+            leagues = sorted(set([ _.get('league', "") for _ in metadatas ]))
+            teams = sorted(set([ _.get('team', "") for _ in metadatas ]))
+            league_code = { league: i for i, league in enumerate(leagues) }
+            team_code = { team: i for i, team in enumerate(teams) }
+
+            arrays = {
+                'dense': dense.astype(np.float32),
+                'sparse_vocab': sparse_vocab.astype(np.uint32),
+                'sparse_indptr': inverted.indptr.astype(np.int64),
+                'sparse_rows': inverted.indices.astype(np.int32),
+                'sparse_values': inverted.data.astype(np.float32),
+                'filter_league': np.array([ league_code[_.get('league', "")] for _ in metadatas ], dtype=np.int32),
+                'filter_team': np.array([ team_code[_.get('team', "")] for _ in metadatas ], dtype=np.int32),
+                'filter_year': np.array([ int(_.get('year', 0)) for _ in metadatas ], dtype=np.int32),
+            }
+
+            # Write everything to temporary files first and then replace, so that a crash never leaves a half written file
+            for name, array in arrays.items():
+                np.save(os.path.join(self.root_dir, f"{name}.tmp.npy"), array)
+            with open(os.path.join(self.root_dir, "filter_columns.json.tmp"), "w") as file:
+                json.dump({ 'league': leagues, 'team': teams }, file)
+            with open(os.path.join(self.root_dir, "metadata.jsonl.tmp"), "w") as file:
+                for id, metadata in zip(ids, metadatas):
+                    file.write(json.dumps({ 'id': id, 'metadata': metadata }) + "\n")
+
+            for name in arrays.keys():
+                os.replace(os.path.join(self.root_dir, f"{name}.tmp.npy"), os.path.join(self.root_dir, f"{name}.npy"))
+            os.replace(os.path.join(self.root_dir, "filter_columns.json.tmp"), os.path.join(self.root_dir, "filter_columns.json"))
+            os.replace(os.path.join(self.root_dir, "metadata.jsonl.tmp"), os.path.join(self.root_dir, "metadata.jsonl"))
+
+            state_new = self.load()
+
+            # Swap in the new state, and drop the pending changes that it contains. Changes made during the flush stay pending
+            with self.pending_lock:
+                self.state = state_new
+                for id, vector in pending_store.items():
+                    if self.pending_store.get(id) is vector: del self.pending_store[id]
+                self.pending_delete -= pending_delete
+
+            logger.info(f"Flushed index {self.root_dir} with {len(ids)} vectors in {time.time()-t_start:.2f}s")
+
+    def store(self, id:str, dense_vector:np.ndarray, sparse_vector:coo_array, metadata:dict) -> None:
+        with self.pending_lock:
+            self.pending_delete.discard(id)
+            self.pending_store[id] = (dense_vector, sparse_vector, metadata)
+
+    def delete(self, ids:list[str]) -> None:
+        with self.pending_lock:
+            for id in ids:
+                self.pending_store.pop(id, None)
+                self.pending_delete.add(id)
+
+    def delete_all(self) -> None:
+        with self.pending_lock:
+            self.pending_store = {}
+            self.pending_delete = set(self.state.ids)
+
+    def list_ids(self, prefix:str) -> list[str]:
+        state, pending_store, pending_delete = self.snapshot()
+        ids = [ id for id in state.ids if id.startswith(prefix) and id not in pending_delete and id not in pending_store ]
+        return ids + [ id for id in pending_store if id.startswith(prefix) ]
+
+    def fetch(self, ids:list[str]) -> dict[str, dict]:
+        """ Returns { id: metadata }. Unknown ids are left out """
+        state, pending_store, pending_delete = self.snapshot()
+        metadatas = {}
+        for id in ids:
+            if id in pending_store: metadatas[id] = pending_store[id][2]
+            elif id in state.id_to_row and id not in pending_delete: metadatas[id] = state.metadatas[state.id_to_row[id]]
+        return metadatas
+
+    def count(self) -> int:
+        state, pending_store, pending_delete = self.snapshot()
+        n_removed = len([ id for id in pending_delete | set(pending_store) if id in state.id_to_row ])
+        return len(state.ids) - n_removed + len(pending_store)
+
+    @staticmethod
+    def filter_to_mask(state:LocalIndex.State, filter:VectorFilter=None) -> np.ndarray:
+        """ Same semantics as pinecone_client.filter_to_dict(), applied on the precomputed filter columns """
+        mask = np.ones(len(state.ids), dtype=bool)
+
+        if filter is None:
+            return mask
+
+        def codes(column:str, names:list[str]) -> list[int]:
+            return [ state.filter_columns[column].index(name) for name in names if name in state.filter_columns[column] ]
+
+        if filter.team is not None:
+            mask &= np.isin(state.filter_team, codes('team', [filter.team]))
+        elif filter.teams is not None:
+            mask &= np.isin(state.filter_team, codes('team', filter.teams))
+
+        if filter.year is not None:
+            mask &= state.filter_year == filter.year
+        else:
+            if filter.year_min is not None: mask &= filter.year_min <= state.filter_year
+            if filter.year_max is not None: mask &= state.filter_year <= filter.year_max
+
+        if filter.league is not None:
+            mask &= np.isin(state.filter_league, codes('league', [filter.league]))
+        elif filter.leagues is not None:
+            mask &= np.isin(state.filter_league, codes('league', filter.leagues))
+
+        return mask
+
+    @staticmethod
+    def filter_matches(metadata:dict, filter:VectorFilter=None) -> bool:
+        """ Same as filter_to_mask(), for the metadata of a single vector that is not on disk yet """
+        if filter is None: return True
+        if filter.team is not None and metadata.get('team') != filter.team: return False
+        if filter.team is None and filter.teams is not None and metadata.get('team') not in filter.teams: return False
+        year = int(metadata.get('year', 0))
+        if filter.year is not None and year != filter.year: return False
+        if filter.year is None and filter.year_min is not None and year < filter.year_min: return False
+        if filter.year is None and filter.year_max is not None and filter.year_max < year: return False
+        if filter.league is not None and metadata.get('league') != filter.league: return False
+        if filter.league is None and filter.leagues is not None and metadata.get('league') not in filter.leagues: return False
+        return True
+
+    def query(self, dense_vector:np.ndarray, sparse_vector:coo_array, limit:int=10, filter:VectorFilter=None, metadata_filter:dict=None, include_metadata=True) -> dict:
+        """ Exact hybrid search. Returns a dictionary with the same shape as a Pinecone QueryResponse. metadata_filter is a simple
+        equality filter on the metadata, e.g. { "team": "RoboTeam_Twente", "year": 2024 } """
+        state, pending_store, pending_delete = self.snapshot()
+        dense_vector = np.asarray(dense_vector, dtype=np.float32)
+
+        def matches_metadata_filter(metadata:dict) -> bool:
+            return all([ metadata.get(key) == value for key, value in (metadata_filter or {}).items() ])
+
+        ### Vectors on disk
+        scores = np.zeros(0, dtype=np.float32)
+        if len(state.ids):
+            # Dense scores
+            scores = state.dense @ dense_vector
+
+            # Sparse scores, by walking the inverted index for each token in the query
+            token_idx = np.searchsorted(state.sparse_vocab, np.asarray(sparse_vector.col, dtype=np.uint32))
+            for idx, token, value in zip(token_idx, sparse_vector.col, sparse_vector.data):
+                if len(state.sparse_vocab) <= idx or state.sparse_vocab[idx] != token: continue
+                start, end = state.sparse_indptr[idx], state.sparse_indptr[idx+1]
+                scores[state.sparse_rows[start:end]] += value * state.sparse_values[start:end]
+
+            mask = self.filter_to_mask(state, filter)
+            if metadata_filter is not None:
+                mask &= np.array([ matches_metadata_filter(metadata) for metadata in state.metadatas ], dtype=bool)
+            # Vectors that are deleted or overwritten, but not flushed yet
+            for id in pending_delete | set(pending_store):
+                if id in state.id_to_row: mask[state.id_to_row[id]] = False
+            scores[~mask] = -np.inf
+
+        ### Vectors that are not on disk yet, appended after the rows on disk
+        pending = [ (id, vector) for id, vector in pending_store.items() if self.filter_matches(vector[2], filter) and matches_metadata_filter(vector[2]) ]
+        if len(pending):
+            sparse_query = dict(zip(np.asarray(sparse_vector.col).tolist(), np.asarray(sparse_vector.data).tolist()))
+            scores_pending = np.array([ np.asarray(vector[0], dtype=np.float32) @ dense_vector
+                + sum([ sparse_query.get(token, 0) * value for token, value in zip(np.asarray(vector[1].col).tolist(), np.asarray(vector[1].data).tolist()) ])
+                for _, vector in pending ], dtype=np.float32)
+            scores = np.concatenate([scores, scores_pending])
+
+        limit = min(limit, int(np.isfinite(scores).sum()))
+        if limit <= 0:
+            return { 'matches': [], 'namespace': '' }
+
+        # Get the top-k rows, sorted by score from high to low
+        top_rows = np.argpartition(-scores, limit-1)[:limit]
+        top_rows = top_rows[np.argsort(-scores[top_rows], kind='stable')]
+
+        matches = []
+        for row in top_rows:
+            if row < len(state.ids): id, metadata = state.ids[row], state.metadatas[row]
+            else: id, metadata = pending[row - len(state.ids)][0], pending[row - len(state.ids)][1][2]
+            match = { 'id': id, 'score': float(scores[row]), 'values': [] }
+            if include_metadata: match['metadata'] = metadata
+            matches.append(match)
+
+        return { 'matches': matches, 'namespace': '' }
+
+class LocalVectorClient(ClientInterface):
+    """ Drop-in replacement for PineconeClient that stores all vectors on disk and answers queries fully in process """
+
+    INDEX_NAME_PARAGRAPH = "paragraph"
+    INDEX_NAME_QUESTION = "question"
+    INDEX_NAME_DEVELOPMENT = "development"
+
+    def __init__(self, root_dir:str) -> None:
+        logger.info(f"Initializing local vector client at {root_dir}")
+        self.root_dir = root_dir
+        self.index_paragraph = LocalIndex(os.path.join(root_dir, self.INDEX_NAME_PARAGRAPH))
+        self.index_question = LocalIndex(os.path.join(root_dir, self.INDEX_NAME_QUESTION))
+        self.index_development = LocalIndex(os.path.join(root_dir, self.INDEX_NAME_DEVELOPMENT))
+
+    def flush(self) -> None:
+        self.index_paragraph.flush()
+        self.index_question.flush()
+        self.index_development.flush()
+
+    """ Paragraph chunks """
+
+    def get_paragraph_chunks_metadata_by_id(self, ids:list[str]) -> list[dict]:
+        logger.info(f"Retrieving paragraphs by id with {len(ids)} ids")
+        return list(self.index_paragraph.fetch(ids).values())
+
+    def fetch_paragraph_chunks_metadata(self, ids:list[str]) -> dict[str, dict]:
+        """ Returns { id: metadata }. Unknown ids are left out """
+        return self.index_paragraph.fetch(ids)
+
+    def get_paragraph_chunks_by_tdpname(self, tdp_name:TDPName) -> list[str]:
+        logger.info(f"Retrieving paragraphs by tdp name {tdp_name}")
+        return self.index_paragraph.list_ids(prefix=tdp_name.filename)
+
+    def store_paragraph_chunk(self, chunk: ParagraphChunk, dense_vector:np.ndarray, sparse_vector:coo_array) -> None:
+        self.index_paragraph.store(paragraph_chunk_vector_id(chunk), dense_vector, sparse_vector, paragraph_chunk_metadata(chunk))
+
+    def query_paragraph_chunks(self, dense_vector:np.ndarray, sparse_vector:coo_array, limit:int=10, filter:VectorFilter=None, include_metadata=True) -> dict:
+        logger.info(f"Querying index {self.INDEX_NAME_PARAGRAPH}")
+
+        t_start = time.time()
+        response = self.index_paragraph.query(dense_vector, sparse_vector, limit=limit, filter=filter, include_metadata=include_metadata)
+        t_stop = time.time()
+
+        logger.info(f"Index queried. Duration: {t_stop-t_start:.4f}s")
+        return response
+
+    def delete_paragraph_chunks(self):
+        logger.info(f"Deleting all vectors from index {self.INDEX_NAME_PARAGRAPH}")
+        self.index_paragraph.delete_all()
+        self.index_paragraph.flush()
+
+    def delete_paragraph_chunks_by_tdpname(self, tdp_name:TDPName) -> bool:
+        logger.info(f"Deleting all vectors from index {self.INDEX_NAME_PARAGRAPH} with name {tdp_name}")
+        self.index_paragraph.delete(self.index_paragraph.list_ids(prefix=tdp_name.filename))
+        return False
+
+    def delete_paragraph_chunks_by_id(self, ids:list[str]) -> None:
+        self.index_paragraph.delete(ids)
+
+    def count_paragraph_chunks(self) -> int:
+        return self.index_paragraph.count()
+
+    """ Questions """
+
+    def get_questions_metadata_by_id(self, ids:list[str]) -> list[dict]:
+        logger.info(f"Retrieving questions by id with {len(ids)} ids")
+        return list(self.index_question.fetch(ids).values())
+
+    def fetch_questions_metadata(self, ids:list[str]) -> dict[str, dict]:
+        """ Returns { id: metadata }. Unknown ids are left out """
+        return self.index_question.fetch(ids)
+
+    def get_questions_by_tdpname(self, tdp_name:TDPName) -> list[str]:
+        logger.info(f"Retrieving questions by tdp name {tdp_name}")
+        return self.index_question.list_ids(prefix=tdp_name.filename)
+
+    def store_question(self, chunk: ParagraphChunk, question: str, question_id:str, dense_vector:np.ndarray, sparse_vector:coo_array) -> None:
+        self.index_question.store(question_vector_id(chunk, question_id), dense_vector, sparse_vector, question_metadata(chunk, question))
+
+    def query_questions(self, dense_vector:np.ndarray, sparse_vector:coo_array, limit:int=10, filter:VectorFilter=None, include_metadata=True) -> dict:
+        logger.info(f"Querying index {self.INDEX_NAME_QUESTION}")
+
+        t_start = time.time()
+        response = self.index_question.query(dense_vector, sparse_vector, limit=limit, filter=filter, include_metadata=include_metadata)
+        t_stop = time.time()
+
+        logger.info(f"Index queried. Duration: {t_stop-t_start:.4f}s")
+        return response
+
+    def delete_questions(self):
+        logger.info(f"Deleting all vectors from index {self.INDEX_NAME_QUESTION}")
+        self.index_question.delete_all()
+        self.index_question.flush()
+
+    def delete_questions_by_tdpname(self, tdp_name:TDPName) -> bool:
+        logger.info(f"Deleting all vectors from index {self.INDEX_NAME_QUESTION} with name {tdp_name}")
+        self.index_question.delete(self.index_question.list_ids(prefix=tdp_name.filename))
+        return False
+
+    def delete_questions_by_id(self, ids:list[str]) -> None:
+        self.index_question.delete(ids)
+
+    def count_questions(self) -> int:
+        return self.index_question.count()
+
+    """ Development. Basic implementation """
+
+    def store_item(self, id:str, dense_vector:np.ndarray, sparse_vector:coo_array, metadata:dict=None) -> None:
+        self.index_development.store(id, dense_vector, sparse_vector, metadata if metadata is not None else {})
+
+    def query_items(self, dense_vector:np.ndarray, sparse_vector:coo_array, limit:int=100, filter:dict=None, include_metadata=True) -> dict:
+        logger.info(f"Querying index {self.INDEX_NAME_DEVELOPMENT}")
+
+        # Only simple equality filters are supported, e.g. { "team": "RoboTeam_Twente", "year": 2024 }
+        return self.index_development.query(dense_vector, sparse_vector, limit=limit, metadata_filter=filter, include_metadata=include_metadata)
+
+    def delete_items(self):
+        logger.info(f"Deleting all vectors from index {self.INDEX_NAME_DEVELOPMENT}")
+        self.index_development.delete_all()
+        self.index_development.flush()
+
+    def count_items(self) -> int:
+        return self.index_development.count()
+
+    """ Other """
+
+    def bulk_writer(self, **kwargs) -> LocalBulkWriter:
+        """ Same interface as PineconeClient.bulk_writer() """
+        return LocalBulkWriter(self)
+
+    def reset_everything(self, embedding_size:int=1536) -> None:
+        pass
+
+def completed_future() -> Future:
+    future = Future()
+    future.set_result(None)
+    return future
+
+class LocalBulkWriter:
+    """ Same interface as PineconeBulkWriter. LocalIndex already buffers all writes in memory, so vectors are stored immediately, and
+    the indexes are written to disk once the writer is closed """
+
+    def __init__(self, client:LocalVectorClient) -> None:
+        self.client = client
+        self.errors:list[tuple[str, list[str], Exception]] = []
+
+    def __enter__(self) -> LocalBulkWriter:
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+    def store_paragraph_chunk(self, chunk:ParagraphChunk, dense_vector:np.ndarray, sparse_vector:coo_array) -> Future:
+        self.client.store_paragraph_chunk(chunk, dense_vector, sparse_vector)
+        return completed_future()
+
+    def store_question(self, chunk:ParagraphChunk, question:str, question_id:str, dense_vector:np.ndarray, sparse_vector:coo_array) -> Future:
+        self.client.store_question(chunk, question, question_id, dense_vector, sparse_vector)
+        return completed_future()
+
+    def store_item(self, id:str, dense_vector:np.ndarray, sparse_vector:coo_array, metadata:dict=None) -> Future:
+        self.client.store_item(id, dense_vector, sparse_vector, metadata)
+        return completed_future()
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        self.client.flush()
+
+if __name__ == "__main__":
+    import tempfile
+    from data_structures.League import League
+    from data_structures.TeamName import TeamName
+
+    client = LocalVectorClient(tempfile.mkdtemp())
+    tdp_name = TDPName(League.from_string("soccer_smallsize"), TeamName("RoboTeam_Twente"), 2024)
+    paragraph = Paragraph(tdp_name=tdp_name, text_raw="1. Introduction", sequence_id=0)
+
+    rng = np.random.default_rng(0)
+    for i in range(100):
+        chunk = ParagraphChunk(paragraph, f"chunk {i}", i, 0, 10)
+        sparse_vector = coo_array((rng.random(5), (np.zeros(5, dtype=int), rng.integers(0, 2**32, 5))))
+        client.store_paragraph_chunk(chunk, rng.random(1536), sparse_vector)
+
+    response = client.query_paragraph_chunks(rng.random(1536), sparse_vector, limit=3, filter=VectorFilter(team="RoboTeam_Twente"))
+    for match in response['matches']: print(match['id'], match['score'])
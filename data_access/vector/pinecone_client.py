@@ -1,8 +1,12 @@
+from __future__ import annotations
 # System libraries
 import os
 import sys
 sys.path.append(os.path.dirname(os.path.dirname(__file__)))
 sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
+from concurrent.futures import Future, ThreadPoolExecutor
+import json
+import threading
 import time
 # Third party libraries
 import dotenv
@@ -10,14 +14,13 @@ import numpy as np
 from pinecone import Pinecone, Vector, SparseValues, UpsertResponse, QueryResponse
 from scipy.sparse import coo_array
 # Local libraries
-from data_access.vector.client_interface import ClientInterface
+from data_access.vector.client_interface import ClientInterface, paragraph_chunk_vector_id, question_vector_id, paragraph_chunk_metadata, question_metadata
 from data_access.vector.vector_filter import VectorFilter
 from data_structures.Paragraph import Paragraph
 from data_structures.ParagraphChunk import ParagraphChunk
 from data_structures.Sentence import Sentence
 from data_structures.TDPName import TDPName
 from MyLogger import logger
-from uniqid import uniqid
 
 def filter_to_dict(filter:VectorFilter=None) -> dict:
     d = {}
@@ -52,6 +55,10 @@ class PineconeClient(ClientInterface):
     INDEX_NAME_QUESTION = "question"
     INDEX_NAME_DEVELOPMENT = "development"
 
+    # Pinecone deletes at most 1000 ids per request. Fetch sends the ids in the URL, so it uses smaller batches
+    MAX_IDS_PER_DELETE = 1000
+    MAX_IDS_PER_FETCH = 100
+
     def __init__(self, api_key:str) -> None:
         logger.info("Initializing Pinecone client")
         self.client = Pinecone(api_key=api_key)
@@ -63,14 +70,18 @@ class PineconeClient(ClientInterface):
 
     def get_paragraph_chunks_metadata_by_id(self, ids:list[str]) -> list[dict]:
         logger.info(f"Retrieving paragraphs by id with {len(ids)} ids")
+        return list(self.fetch_paragraph_chunks_metadata(ids).values())
 
+    def fetch_paragraph_chunks_metadata(self, ids:list[str]) -> dict[str, dict]:
+        """ Returns { id: metadata }. Unknown ids are left out """
         if self.index_paragraph is None:
             self.index_paragraph = self.client.Index(self.INDEX_NAME_PARAGRAPH)
         
-        response = self.index_paragraph.fetch(ids)
-        
-        metadatas = [vector.metadata for vector in response['vectors'].values()]
-
+        metadatas = {}
+        # The ids are sent in the URL, so fetch them in batches
+        for i in range(0, len(ids), self.MAX_IDS_PER_FETCH):
+            response = self.index_paragraph.fetch(ids[i:i+self.MAX_IDS_PER_FETCH])
+            metadatas.update({ id: vector.metadata for id, vector in response['vectors'].items() })
         return metadatas
 
     def get_paragraph_chunks_by_tdpname(self, tdp_name:TDPName) -> list[str]:
@@ -79,36 +90,21 @@ class PineconeClient(ClientInterface):
         if self.index_paragraph is None:
             self.index_paragraph = self.client.Index(self.INDEX_NAME_PARAGRAPH)
         
-        response = list(self.index_paragraph.list(prefix=tdp_name.filename))
-
-        return [] if not len(response) else response[0]
+        # list() yields pages of ids
+        return [ id for ids in self.index_paragraph.list(prefix=tdp_name.filename) for id in ids ]
 
     def store_paragraph_chunk(self, chunk: ParagraphChunk, dense_vector:np.ndarray, sparse_vector:coo_array) -> None:
         if self.index_paragraph is None:
             self.index_paragraph = self.client.Index(self.INDEX_NAME_PARAGRAPH)
         
-        vector_id = chunk.tdp_name.filename + "__" + str(chunk.paragraph_sequence_id) + "__" + str(chunk.sequence_id)
+        vector_id = paragraph_chunk_vector_id(chunk)
                 
         # 40kb metadata limit
         if 40000*0.8 < len(chunk.text):
             logger.error(f"Metadata limit exceeded for paragraph {vector_id}")
             raise ValueError("Metadata limit exceeded")
 
-        metadata = {
-            'text': chunk.text,
-            'start': chunk.start,
-            'end': chunk.end,
-            'paragraph_sequence_id': chunk.paragraph_sequence_id,
-            'chunk_sequence_id': chunk.sequence_id,
-
-            'tdp_name': chunk.tdp_name.filename,
-            'paragraph_title': chunk.title,
-            'league': chunk.tdp_name.league.name,
-            'team': chunk.tdp_name.team_name.name,
-            'year': chunk.tdp_name.year,
-
-            'run_id': uniqid
-        }
+        metadata = paragraph_chunk_metadata(chunk)
                 
         sparse_vector = SparseValues(indices=sparse_vector.col.tolist(), values=sparse_vector.data.tolist())
         vector = Vector(id=vector_id, values=dense_vector.tolist(), sparse_values=sparse_vector, metadata=metadata)
@@ -171,6 +167,16 @@ class PineconeClient(ClientInterface):
 
         return error
 
+    def delete_paragraph_chunks_by_id(self, ids:list[str]) -> None:
+        if not len(ids): return
+        logger.info(f"Deleting {len(ids)} vectors from index {self.INDEX_NAME_PARAGRAPH}")
+
+        if self.index_paragraph is None:
+            self.index_paragraph = self.client.Index(self.INDEX_NAME_PARAGRAPH)
+
+        for i in range(0, len(ids), self.MAX_IDS_PER_DELETE):
+            self.index_paragraph.delete(ids=ids[i:i+self.MAX_IDS_PER_DELETE])
+
     def count_paragraph_chunks(self) -> int:
         if self.index_paragraph is None:
             self.index_paragraph = self.client.Index(self.INDEX_NAME_PARAGRAPH)
@@ -181,13 +187,17 @@ class PineconeClient(ClientInterface):
 
     def get_questions_metadata_by_id(self, ids:list[str]) -> list[dict]:
         logger.info(f"Retrieving questions by id with {len(ids)} ids")
+        return list(self.fetch_questions_metadata(ids).values())
+
+    def fetch_questions_metadata(self, ids:list[str]) -> dict[str, dict]:
+        """ Returns { id: metadata }. Unknown ids are left out """
         if self.index_question is None:
             self.index_question = self.client.Index(self.INDEX_NAME_QUESTION)
         
-        response = self.index_question.fetch(ids)
-        
-        metadatas = [vector.metadata for vector in response['vectors'].values()]
-
+        metadatas = {}
+        for i in range(0, len(ids), self.MAX_IDS_PER_FETCH):
+            response = self.index_question.fetch(ids[i:i+self.MAX_IDS_PER_FETCH])
+            metadatas.update({ id: vector.metadata for id, vector in response['vectors'].items() })
         return metadatas
 
     def get_questions_by_tdpname(self, tdp_name:TDPName) -> list[str]:
@@ -196,29 +206,16 @@ class PineconeClient(ClientInterface):
         if self.index_question is None:
             self.index_question = self.client.Index(self.INDEX_NAME_QUESTION)
         
-        response = list(self.index_question.list(prefix=tdp_name.filename))
-        
-        return [] if not len(response) else response[0]
+        # list() yields pages of ids
+        return [ id for ids in self.index_question.list(prefix=tdp_name.filename) for id in ids ]
 
     def store_question(self, chunk: ParagraphChunk, question: str, question_id:str, dense_vector:np.ndarray, sparse_vector:coo_array) -> None:
         if self.index_question is None:
             self.index_question = self.client.Index(self.INDEX_NAME_QUESTION)
         
-        vector_id = chunk.tdp_name.filename + "__" + str(chunk.paragraph_sequence_id) + "__" + str(chunk.sequence_id) + "__" + question_id
+        vector_id = question_vector_id(chunk, question_id)
                 
-        metadata = {
-            'question': question,
-            'paragraph_sequence_id': chunk.paragraph_sequence_id,
-            'chunk_sequence_id': chunk.sequence_id,
-            
-            'tdp_name': chunk.tdp_name.filename,
-            'paragraph_title': chunk.title,
-            'league': chunk.tdp_name.league.name,
-            'team': chunk.tdp_name.team_name.name,
-            'year': chunk.tdp_name.year,
-
-            'run_id': uniqid
-        }
+        metadata = question_metadata(chunk, question)
         sparse_vector = SparseValues(indices=sparse_vector.col.tolist(), values=sparse_vector.data.tolist())
         vector = Vector(id=vector_id, values=dense_vector.tolist(), sparse_values=sparse_vector, metadata=metadata)
 
@@ -280,6 +277,16 @@ class PineconeClient(ClientInterface):
 
         return error
 
+    def delete_questions_by_id(self, ids:list[str]) -> None:
+        if not len(ids): return
+        logger.info(f"Deleting {len(ids)} vectors from index {self.INDEX_NAME_QUESTION}")
+
+        if self.index_question is None:
+            self.index_question = self.client.Index(self.INDEX_NAME_QUESTION)
+
+        for i in range(0, len(ids), self.MAX_IDS_PER_DELETE):
+            self.index_question.delete(ids=ids[i:i+self.MAX_IDS_PER_DELETE])
+
     def count_questions(self) -> int:
         if self.index_question is None:
             self.index_question = self.client.Index(self.INDEX_NAME_QUESTION)
@@ -338,9 +345,150 @@ class PineconeClient(ClientInterface):
 
     """ Other """
 
+    def bulk_writer(self, **kwargs) -> PineconeBulkWriter:
+        """ Returns a writer that buffers vectors and upserts them in batches. See PineconeBulkWriter """
+        return PineconeBulkWriter(self, **kwargs)
+
     def reset_everything(self, embedding_size:int=1536) -> None:
         pass
 
+def estimate_vector_bytes(vector:Vector) -> int:
+    """ Rough size of a vector in an upsert request. Floats are sent as text of about 10 characters """
+    n_bytes = 10 * len(vector.values) + 100
+    if vector.sparse_values is not None: n_bytes += 20 * len(vector.sparse_values.indices)
+    if vector.metadata is not None: n_bytes += len(json.dumps(vector.metadata))
+    return n_bytes
+
+class PineconeBulkWriter:
+    """ Buffers vectors and upserts them in batches, instead of one upsert request per vector. A batch is sent once it holds batch_size
+    vectors or max_bytes bytes (Pinecone accepts at most 2MB per request), or once its oldest vector waited max_delay seconds. Batches
+    are sent by max_workers threads. At most max_pending_batches batches can be in flight, after which the store functions block.
+
+    Every store function returns a Future, which resolves once the batch of that vector is upserted, or fails with the error of that batch.
+    Failed batches are logged and kept in errors. Use as a context manager, which sends everything that is left on exit:
+
+        with vector_client.bulk_writer() as writer:
+            writer.store_paragraph_chunk(chunk, dense_vector, sparse_vector)
+    """
+
+    def __init__(self, client:PineconeClient, batch_size:int=100, max_bytes:int=1_500_000, max_delay:float=2, max_workers:int=4, max_pending_batches:int=None) -> None:
+        self.client = client
+        self.batch_size = batch_size
+        self.max_bytes = max_bytes
+        self.max_delay = max_delay
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="upsert")
+        self.slots = threading.BoundedSemaphore(max_pending_batches or 2 * max_workers)
+        # pool_threads sizes the connection pool of the index, so that all workers can upsert at the same time
+        self.indexes = { name: client.client.Index(name, pool_threads=max_workers) for name in
+                        [client.INDEX_NAME_PARAGRAPH, client.INDEX_NAME_QUESTION, client.INDEX_NAME_DEVELOPMENT] }
+
+        self.lock = threading.Condition()
+        self.buffers:dict[str, list[tuple[Vector, Future]]] = { name: [] for name in self.indexes }
+        self.buffer_bytes = { name: 0 for name in self.indexes }
+        self.buffer_started_at = { name: None for name in self.indexes }
+        self.futures:list[Future] = []
+        self.errors:list[tuple[str, list[str], Exception]] = [] # [ (index name, vector ids, exception) ]
+        self.n_upserted = 0
+        self.n_batches = 0
+        self.closed = False
+
+        self.flusher = threading.Thread(target=self.flush_periodically, daemon=True)
+        self.flusher.start()
+
+    def __enter__(self) -> PineconeBulkWriter:
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+    def store_paragraph_chunk(self, chunk:ParagraphChunk, dense_vector:np.ndarray, sparse_vector:coo_array) -> Future:
+        # 40kb metadata limit
+        if 40000*0.8 < len(chunk.text):
+            logger.error(f"Metadata limit exceeded for paragraph {paragraph_chunk_vector_id(chunk)}")
+            raise ValueError("Metadata limit exceeded")
+        metadata = paragraph_chunk_metadata(chunk)
+        return self.add(self.client.INDEX_NAME_PARAGRAPH, paragraph_chunk_vector_id(chunk), dense_vector, sparse_vector, metadata)
+
+    def store_question(self, chunk:ParagraphChunk, question:str, question_id:str, dense_vector:np.ndarray, sparse_vector:coo_array) -> Future:
+        metadata = question_metadata(chunk, question)
+        return self.add(self.client.INDEX_NAME_QUESTION, question_vector_id(chunk, question_id), dense_vector, sparse_vector, metadata)
+
+    def store_item(self, id:str, dense_vector:np.ndarray, sparse_vector:coo_array, metadata:dict=None) -> Future:
+        return self.add(self.client.INDEX_NAME_DEVELOPMENT, id, dense_vector, sparse_vector, metadata)
+
+    def add(self, index_name:str, id:str, dense_vector:np.ndarray, sparse_vector:coo_array, metadata:dict) -> Future:
+        sparse_values = SparseValues(indices=sparse_vector.col.tolist(), values=sparse_vector.data.tolist())
+        vector = Vector(id=id, values=dense_vector.tolist(), sparse_values=sparse_values, metadata=metadata)
+        n_bytes = estimate_vector_bytes(vector)
+        future = Future()
+
+        with self.lock:
+            if self.closed: raise RuntimeError("Bulk writer is closed")
+            # Send the current batch first if this vector would make it too large
+            if len(self.buffers[index_name]) and self.max_bytes < self.buffer_bytes[index_name] + n_bytes:
+                self.send(index_name)
+            if not len(self.buffers[index_name]):
+                self.buffer_started_at[index_name] = time.time()
+            self.buffers[index_name].append((vector, future))
+            self.buffer_bytes[index_name] += n_bytes
+            if self.batch_size <= len(self.buffers[index_name]):
+                self.send(index_name)
+
+        return future
+
+    def send(self, index_name:str) -> None:
+        """ Sends the buffer of the index as a batch. Must be called with the lock held """
+        batch = self.buffers[index_name]
+        self.buffers[index_name], self.buffer_bytes[index_name], self.buffer_started_at[index_name] = [], 0, None
+
+        # Back-pressure. Waiting releases the lock, so that finished batches and other indexes are not blocked
+        while not self.slots.acquire(blocking=False):
+            self.lock.wait(0.05)
+        self.futures.append(self.executor.submit(self.upsert, index_name, batch))
+
+    def upsert(self, index_name:str, batch:list[tuple[Vector, Future]]) -> None:
+        vectors = [ vector for vector, _ in batch ]
+        try:
+            self.indexes[index_name].upsert(vectors=vectors)
+            with self.lock:
+                self.n_upserted += len(vectors)
+                self.n_batches += 1
+            for _, future in batch: future.set_result(None)
+        except Exception as e:
+            ids = [ vector.id for vector in vectors ]
+            logger.error(f"Upsert of {len(ids)} vectors into index {index_name} failed ({ids[0]} ... {ids[-1]}): {e}")
+            with self.lock:
+                self.errors.append((index_name, ids, e))
+            for _, future in batch: future.set_exception(e)
+        finally:
+            self.slots.release()
+            with self.lock:
+                self.lock.notify_all()
+
+    def flush(self) -> None:
+        """ Sends all buffered vectors, without waiting for them to be upserted """
+        with self.lock:
+            for index_name in self.buffers:
+                if len(self.buffers[index_name]): self.send(index_name)
+
+    def flush_periodically(self) -> None:
+        with self.lock:
+            while not self.closed:
+                self.lock.wait(self.max_delay / 4)
+                for index_name, started_at in self.buffer_started_at.items():
+                    if started_at is not None and self.max_delay <= time.time() - started_at:
+                        self.send(index_name)
+
+    def close(self) -> None:
+        """ Sends all buffered vectors and waits until every batch is upserted """
+        self.flush()
+        with self.lock:
+            self.closed = True
+            self.lock.notify_all()
+        self.flusher.join()
+        self.executor.shutdown(wait=True)
+        logger.info(f"Bulk writer upserted {self.n_upserted} vectors in {self.n_batches} batches. {len(self.errors)} batches failed")
+
 if __name__ == "__main__":
     dotenv.load_dotenv()
     client = PineconeClient(os.getenv("PINECONE_API_KEY"))
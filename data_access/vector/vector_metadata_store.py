@@ -0,0 +1,137 @@
+# System libraries
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
+import json
+import sqlite3
+import threading
+from typing import Iterator
+# Local libraries
+from data_access.vector.client_interface import paragraph_chunk_vector_id, question_vector_id, paragraph_chunk_metadata, question_metadata
+from data_structures.ParagraphChunk import ParagraphChunk
+from data_structures.TDPName import TDPName
+from MyLogger import logger
+
+class VectorMetadataStore:
+    """ Local copy of the metadata of all paragraph chunks and questions in the vector database, keyed by vector id. The metadata
+    never changes after ingestion, so search() can resolve it from this store instead of fetching it from the vector database.
+
+    The store is a single SQLite file with one table per index. It is written by process_tdps.py (or backfilled with
+    scripts/build_vector_metadata_store.py), and opened read-only and memory-mapped by the API. Every thread gets its own
+    connection, so lookups from the search thread pool never wait on each other.
+    """
+
+    TABLE_PARAGRAPH = "paragraph_chunk"
+    TABLE_QUESTION = "question"
+
+    # Upper bound on the number of ids in a single "IN (...)" query. SQLite allows at most 999 variables in older versions
+    MAX_IDS_PER_QUERY = 900
+
+    def __init__(self, filepath:str, read_only:bool=True, mmap_size:int=256*1024*1024) -> None:
+        self.filepath = filepath
+        self.read_only = read_only
+        self.mmap_size = mmap_size
+        self.local = threading.local()
+        self.write_lock = threading.Lock()
+
+        if read_only:
+            if not os.path.isfile(filepath):
+                raise FileNotFoundError(f"Vector metadata store {filepath} does not exist")
+        else:
+            self.ensure_tables()
+
+    def connection(self) -> sqlite3.Connection:
+        """ Returns the connection of the current thread, and opens it if needed """
+        connection = getattr(self.local, "connection", None)
+        if connection is not None:
+            return connection
+
+        if self.read_only:
+            connection = sqlite3.connect(f"file:{os.path.abspath(self.filepath)}?mode=ro", uri=True)
+            connection.execute("PRAGMA query_only = ON")
+        else:
+            connection = sqlite3.connect(self.filepath)
+            # WAL allows the API to keep reading while process_tdps.py is writing
+            connection.execute("PRAGMA journal_mode = WAL")
+            connection.execute("PRAGMA synchronous = NORMAL")
+        connection.execute(f"PRAGMA mmap_size = {self.mmap_size}")
+
+        self.local.connection = connection
+        return connection
+
+    def ensure_tables(self) -> None:
+        connection = self.connection()
+        for table in [self.TABLE_PARAGRAPH, self.TABLE_QUESTION]:
+            connection.execute(f"CREATE TABLE IF NOT EXISTS {table} (id TEXT PRIMARY KEY, metadata TEXT NOT NULL) WITHOUT ROWID")
+        connection.commit()
+
+    """ Reading """
+
+    def fetch(self, table:str, ids:list[str]) -> dict[str, dict]:
+        """ Returns { id: metadata } for all ids that are in the store. Unknown ids are left out, just like Pinecone's fetch() does """
+        connection = self.connection()
+        ids = list(dict.fromkeys(ids))
+        metadatas = {}
+        for i in range(0, len(ids), self.MAX_IDS_PER_QUERY):
+            batch = ids[i:i+self.MAX_IDS_PER_QUERY]
+            placeholders = ",".join("?" * len(batch))
+            for id, metadata in connection.execute(f"SELECT id, metadata FROM {table} WHERE id IN ({placeholders})", batch):
+                metadatas[id] = json.loads(metadata)
+        return metadatas
+
+    def get_paragraph_chunks_metadata_by_id(self, ids:list[str]) -> list[dict]:
+        return list(self.fetch(self.TABLE_PARAGRAPH, ids).values())
+
+    def get_questions_metadata_by_id(self, ids:list[str]) -> list[dict]:
+        return list(self.fetch(self.TABLE_QUESTION, ids).values())
+
+    def iterate(self, table:str) -> Iterator[tuple[str, dict]]:
+        """ Yields (id, metadata) of every record in the table """
+        for id, metadata in self.connection().execute(f"SELECT id, metadata FROM {table}"):
+            yield id, json.loads(metadata)
+
+    def count(self, table:str) -> int:
+        return self.connection().execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+
+    """ Writing """
+
+    def store(self, table:str, records:list[tuple[str, dict]]) -> None:
+        """ Insert or replace a list of (id, metadata) records """
+        if self.read_only:
+            raise PermissionError("Vector metadata store is opened read-only")
+        with self.write_lock:
+            connection = self.connection()
+            connection.executemany(f"INSERT OR REPLACE INTO {table} (id, metadata) VALUES (?, ?)", [ (id, json.dumps(metadata)) for id, metadata in records ])
+            connection.commit()
+
+    def store_paragraph_chunk(self, chunk:ParagraphChunk) -> None:
+        self.store(self.TABLE_PARAGRAPH, [ (paragraph_chunk_vector_id(chunk), paragraph_chunk_metadata(chunk)) ])
+
+    def store_question(self, chunk:ParagraphChunk, question:str, question_id:str) -> None:
+        self.store(self.TABLE_QUESTION, [ (question_vector_id(chunk, question_id), question_metadata(chunk, question)) ])
+
+    def delete(self, table:str, ids:list[str]) -> None:
+        if self.read_only:
+            raise PermissionError("Vector metadata store is opened read-only")
+        with self.write_lock:
+            connection = self.connection()
+            connection.executemany(f"DELETE FROM {table} WHERE id = ?", [ (id,) for id in ids ])
+            connection.commit()
+
+    def delete_by_tdpname(self, tdp_name:TDPName) -> None:
+        """ Remove all paragraph chunks and questions of a TDP """
+        if self.read_only:
+            raise PermissionError("Vector metadata store is opened read-only")
+        with self.write_lock:
+            connection = self.connection()
+            # Vector ids are "{filename}__{paragraph_sequence_id}__{chunk_sequence_id}[__{question_id}]". Range scan on the primary key
+            prefix = tdp_name.filename + "__"
+            for table in [self.TABLE_PARAGRAPH, self.TABLE_QUESTION]:
+                connection.execute(f"DELETE FROM {table} WHERE id >= ? AND id < ?", (prefix, prefix[:-1] + chr(ord(prefix[-1])+1)))
+            connection.commit()
+        logger.info(f"Deleted metadata of {tdp_name} from vector metadata store")
+
+if __name__ == "__main__":
+    store = VectorMetadataStore(sys.argv[1] if 1 < len(sys.argv) else "vector_metadata.sqlite")
+    print(f"Paragraph chunks: {store.count(VectorMetadataStore.TABLE_PARAGRAPH)}    Questions: {store.count(VectorMetadataStore.TABLE_QUESTION)}")
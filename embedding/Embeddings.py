@@ -3,19 +3,86 @@ import os
 import sys
 sys.path.append(os.path.dirname(os.path.dirname(__file__)))
 from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import itertools
 import json
 import mmh3
+import random
+import threading
+import time
 # Third party libraries
 import numpy as np
-from openai import OpenAI, RateLimitError
+from openai import OpenAI, APIConnectionError, APITimeoutError, InternalServerError, RateLimitError
 from pinecone_text.sparse.bm25_tokenizer import BM25Tokenizer
 # import pymilvus
 # import pymilvus.model
 from scipy.sparse import csr_matrix, coo_array
 import tiktoken
 # Local libraries
+from embedding.bm25_parameters import BM25Parameters
+from data_access.llm.openai_scheduler import OpenAIScheduler, PRIORITY_SERVING, get_retry_after, get_scheduler
+from embedding.embedding_cache import EmbeddingCache
 from MyLogger import logger
 
+def find_2grams_3grams(tokens_stopwords:list[str], tokens_nostopwords:list[str]) -> tuple[list[tuple[str, tuple[str, str]]], list[tuple[str, tuple[str, str, str]]]]:
+    """ Find all word 2-grams and 3-grams (from the tokens with stopwords) that also occur as token 2-grams and 3-grams (from the tokens
+    without stopwords). A word n-gram matches a token n-gram if each word starts with the corresponding token. If a word n-gram matches
+    multiple token n-grams, the token n-gram that occurs first is used.
+
+    Instead of comparing every word n-gram with every token n-gram, all token n-grams are indexed by their first position. For each word,
+    the tokens that it starts with are looked up, and only those combinations are checked. This is linear in the number of tokens and
+    gives exactly the same output as the quadratic comparison. See scripts/benchmark_ngrams.py
+    """
+    # For the example, assume that:
+    # tokens_stopwords   : ['whi', '3d', 'computer-vis', 'is', 'cool']
+    # tokens_nostopwords : ['3d', 'computer-vis', 'cool']
+
+    A, B = tokens_stopwords, tokens_nostopwords 
+
+    # Index all token 2-grams -> { ("3d", "computer-vision"): 0, ("computer-vision", "cool"): 1 }
+    token_ngrams2_first = {}
+    for i, ngram in enumerate(zip(B, B[1:])): token_ngrams2_first.setdefault(ngram, i)
+    # Index all token 3-grams -> { ("3d", "computer-vision", "cool"): 0 }
+    token_ngrams3_first = {}
+    for i, ngram in enumerate(zip(B, B[1:], B[2:])): token_ngrams3_first.setdefault(ngram, i)
+
+    # For each word, find all tokens that the word starts with. Usually this is only the token of the word itself, or nothing for stopwords
+    tokens = set(B)
+    word_prefixes = { word: [ word[:n] for n in range(len(word)+1) if word[:n] in tokens ] for word in set(A) }
+
+    # Check which word n-grams occur within the token n-grams, which in this case is only ("3d", "computer-vision")
+    ngrams2, ngrams3 = [], []
+    for (w1, w2) in zip(A, A[1:]):
+        matches = [ (token_ngrams2_first[(t1, t2)], (t1, t2)) for t1 in word_prefixes[w1] for t2 in word_prefixes[w2] if (t1, t2) in token_ngrams2_first ]
+        if len(matches):
+            # Store ngram as "3dcomputer-vision", so that it's a single word which can be hashed into an integer and stored
+            # in the sparse vector. Only the first token ngram is used, so the word ngram is only added once
+            _, (t1, t2) = min(matches)
+            ngrams2.append((t1 + t2, (t1, t2)))
+
+    for (w1, w2, w3) in zip(A, A[1:], A[2:]):
+        matches = [ (token_ngrams3_first[(t1, t2, t3)], (t1, t2, t3)) for t1 in word_prefixes[w1] for t2 in word_prefixes[w2] for t3 in word_prefixes[w3] if (t1, t2, t3) in token_ngrams3_first ]
+        if len(matches):
+            # Store ngram as a single word which can be hashed into an integer and stored in the sparse vector
+            _, (t1, t2, t3) = min(matches)
+            ngrams3.append((t1 + t2 + t3, (t1, t2, t3)))
+
+    return ngrams2, ngrams3
+
+# Input limits of the OpenAI embedding models, per text and per request
+MAX_EMBEDDING_TOKENS_PER_TEXT = 8191
+MAX_EMBEDDING_TEXTS_PER_REQUEST = 2048
+MAX_EMBEDDING_TOKENS_PER_REQUEST = 300_000
+# Seconds. Exponential backoff of failed embedding requests
+EMBEDDING_BACKOFF_BASE = 0.5
+EMBEDDING_BACKOFF_MAX = 60
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(encoding:str="cl100k_base") -> tiktoken.Encoding:
+    """ A single instance of every encoding, shared by all token counting. Encodings are immutable and safe to share between threads """
+    return tiktoken.get_encoding(encoding)
+
 class Embeddor:
 
     # Costs per token
@@ -34,6 +101,13 @@ class Embeddor:
         self.dense_milvus = None
         self.sparse_milvus_splade = None
         self.total_costs = 0
+        # Persistent cache of dense embeddings, shared by all processes. Disabled if EMBEDDING_CACHE_DIR is not set
+        self.embedding_cache:EmbeddingCache = EmbeddingCache(os.getenv("EMBEDDING_CACHE_DIR")) if os.getenv("EMBEDDING_CACHE_DIR") else None
+        # embed_dense_openai_batch calls the API from multiple threads
+        self.costs_lock = threading.Lock()
+        # Rate limits requests when OPENAI_RATE_LIMITS is set. process_tdps.py sets the priority to PRIORITY_INGESTION
+        self.scheduler:OpenAIScheduler = get_scheduler()
+        self.priority = PRIORITY_SERVING
 
         # Tokenizers used for creating ngrams in embed_sparse_prefitted_bm25()
         self.bm25_tokenizer_stopwords = BM25Tokenizer(
@@ -51,8 +125,35 @@ class Embeddor:
             language="english"
         )
         
-        self.bm25_parameters = json.load(open("bm25_prefitted_on_chunks_sep2024.json", "r"))
-        self.bm25_token_df_map = { token: df for token, df in zip(self.bm25_parameters['doc_freq']['indices'], self.bm25_parameters['doc_freq']['values']) }
+        # Loads the memory-mapped binary version (.npy) if it exists, and the JSON file otherwise. An explicitly configured file takes
+        # precedence over the file activated by scripts/fit_bm25.py, which in turn takes precedence over the original prefitted file
+        self.bm25_parameters_pinned:bool = os.getenv("BM25_PARAMETERS") is not None
+        self.bm25_parameters_filepath:str = None
+        self.bm25_parameters_failed_filepath:str = None # Not retried until fit_bm25.py activates another file
+        self.bm25_parameters_checked_at:float = time.time()
+        self.bm25_parameters:BM25Parameters = None
+        self.load_bm25_parameters(os.getenv("BM25_PARAMETERS") or BM25Parameters.current() or "bm25_prefitted_on_chunks_sep2024.json")
+
+    def load_bm25_parameters(self, filepath:str) -> None:
+        """ Hot-swap the BM25 parameters. The reference is replaced in one go, and every embed function captures the reference once
+        at the start, so calls that are running during the swap finish with the old parameters """
+        bm25_parameters = BM25Parameters.load(filepath)
+        self.bm25_parameters, self.bm25_parameters_filepath = bm25_parameters, filepath
+        logger.info(f"Loaded BM25 parameters {filepath} (version='{bm25_parameters.version}', n_docs={bm25_parameters.n_docs})")
+
+    def refresh_bm25_parameters(self, interval:float=60) -> None:
+        """ Switch to the parameter file activated by scripts/fit_bm25.py, if it changed. Checks at most once every interval seconds """
+        if self.bm25_parameters_pinned or time.time() - self.bm25_parameters_checked_at < interval:
+            return
+        self.bm25_parameters_checked_at = time.time()
+
+        filepath = BM25Parameters.current()
+        if filepath is not None and filepath != self.bm25_parameters_filepath and filepath != self.bm25_parameters_failed_filepath:
+            try:
+                self.load_bm25_parameters(filepath)
+            except Exception as e:
+                logger.error(f"Could not load BM25 parameters {filepath}, keeping {self.bm25_parameters_filepath}: {e}")
+                self.bm25_parameters_failed_filepath = filepath
 
     def cosine_similarity(self, a, b):
         return np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b))
@@ -68,18 +169,101 @@ class Embeddor:
         
         is_str:bool = isinstance(text, str)
 
-        try:
-            if is_str: 
-                response = self.openai_client.embeddings.create(input = [text], model=model)
-                self.total_costs += response.usage.prompt_tokens * self.api_costs[response.model]["input"]            
-                return np.array(response.data[0].embedding)
-            else:
-                response = self.openai_client.embeddings.create(input = text, model=model)
-                self.total_costs += response.usage.prompt_tokens * self.api_costs[response.model]["input"]
+        def embed(texts:list[str]) -> np.ndarray:
+            try:
+                response = self.create_embeddings(self.openai_client, texts, model)
+                self.track_costs(response)
+                return np.array([ _.embedding for _ in response.data ])
+            except RateLimitError as e:
+                logger.error(f"Rate limit error: {e}")
+                raise e
+
+        embeddings = self.with_embedding_cache([text] if is_str else text, model, embed)
+        return embeddings[0] if is_str else embeddings
+
+    def with_embedding_cache(self, texts:list[str], model:str, embed) -> np.ndarray:
+        """ Returns the embeddings of the texts, of which only the texts that are not in the embedding cache are embedded by embed() """
+        if self.embedding_cache is None or not len(texts):
+            return embed(texts)
+
+        embeddings = self.embedding_cache.get(model, texts)
+        missing = [ i for i, embedding in enumerate(embeddings) if embedding is None ]
+        if len(missing):
+            embeddings_missing = embed([ texts[i] for i in missing ])
+            self.embedding_cache.put(model, [ texts[i] for i in missing ], embeddings_missing)
+            for i, embedding in zip(missing, embeddings_missing): embeddings[i] = embedding
+
+        # Same dtype as embeddings that come straight from OpenAI
+        return np.array(embeddings, dtype=np.float64)
+
+    def create_embeddings(self, client:OpenAI, texts:list[str], model:str, max_retries:int=None):
+        """ Same as client.embeddings.create, but through the scheduler if there is one. max_retries is passed on to the scheduler """
+        if self.scheduler is not None:
+            return self.scheduler.embeddings_sync(self.priority, max_retries=max_retries, input=texts, model=model)
+        return client.embeddings.create(input=texts, model=model)
+
+    def track_costs(self, response) -> None:
+        with self.costs_lock:
+            self.total_costs += response.usage.prompt_tokens * self.api_costs[response.model]["input"]
+
+    def pack_embedding_requests(self, texts:list[str], max_texts:int=MAX_EMBEDDING_TEXTS_PER_REQUEST, max_tokens:int=MAX_EMBEDDING_TOKENS_PER_REQUEST) -> list[list[int]]:
+        """ Groups the indices of the texts into requests of at most max_texts texts and max_tokens tokens, in input order """
+        n_tokens = self.count_tokens_batch(texts)
+        requests, request, request_tokens = [], [], 0
+        for i_text, text_tokens in enumerate(n_tokens):
+            if MAX_EMBEDDING_TOKENS_PER_TEXT < text_tokens:
+                raise ValueError(f"Text {i_text} has {text_tokens} tokens, the embedding models accept at most {MAX_EMBEDDING_TOKENS_PER_TEXT}")
+            if len(request) and (max_texts <= len(request) or max_tokens < request_tokens + text_tokens):
+                requests.append(request)
+                request, request_tokens = [], 0
+            request.append(i_text)
+            request_tokens += text_tokens
+        if len(request): requests.append(request)
+        return requests
+
+    def embed_dense_openai_request(self, texts:list[str], model:str, max_retries:int) -> np.ndarray:
+        """ A single embedding request. Rate limits, timeouts and server errors are retried with exponential backoff and full jitter. If
+        the server sends Retry-After, at least that long is waited """
+        # The retries of the OpenAI client itself are disabled, so that a rate limit doesn't retry max_retries * 3 times
+        client = self.openai_client.with_options(max_retries=0)
+        for attempt in range(max_retries + 1):
+            try:
+                # This loop is the only one that retries. The scheduler only pauses the model on a rate limit, and raises
+                response = self.create_embeddings(client, texts, model, max_retries=0)
+                self.track_costs(response)
                 return np.array([ _.embedding for _ in response.data ])
-        except RateLimitError as e:
-            logger.error(f"Rate limit error: {e}")
-            raise e
+            except (RateLimitError, APIConnectionError, APITimeoutError, InternalServerError) as e:
+                if max_retries <= attempt:
+                    logger.error(f"Embedding request failed after {attempt+1} attempts: {e}")
+                    raise e
+                delay = random.uniform(0, min(EMBEDDING_BACKOFF_MAX, EMBEDDING_BACKOFF_BASE * 2**attempt))
+                retry_after = get_retry_after(e)
+                if retry_after is not None: delay = max(delay, retry_after + random.uniform(0, EMBEDDING_BACKOFF_BASE))
+                logger.warning(f"Embedding request failed ({type(e).__name__}), retrying in {delay:.2f}s ({attempt+1}/{max_retries})")
+                time.sleep(delay)
+
+    def embed_dense_openai_batch(self, texts:list[str], model:str="text-embedding-3-small", max_workers:int=4, max_retries:int=6) -> np.ndarray:
+        """ Embeds any number of texts with as few requests as possible. Texts in the embedding cache are not sent at all. The others are
+        packed into requests under the input limits of the embedding models, and the requests are sent by max_workers threads, that share
+        the connection pool of the OpenAI client. Returns an array of shape (len(texts), dimensions), in the same order as the texts """
+        if not len(texts): return np.zeros((0, 0))
+        if self.openai_client is None:
+            self.load_openai_client()
+        return self.with_embedding_cache(texts, model, lambda texts: self.embed_dense_openai_requests(texts, model, max_workers, max_retries))
+
+    def embed_dense_openai_requests(self, texts:list[str], model:str, max_workers:int, max_retries:int) -> np.ndarray:
+
+        requests = self.pack_embedding_requests(texts)
+        if len(requests) == 1:
+            return self.embed_dense_openai_request(texts, model, max_retries)
+
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(requests))) as executor:
+            futures = [ executor.submit(self.embed_dense_openai_request, [ texts[i] for i in request ], model, max_retries) for request in requests ]
+            # The requests hold consecutive indices, so concatenating the responses in request order restores the input order
+            embeddings = np.concatenate([ future.result() for future in futures ])
+
+        logger.info(f"Embedded {len(texts)} texts in {len(requests)} requests")
+        return embeddings
 
     def embed_dense_milvus(self, text:str | list[str]) -> np.ndarray:
         # https://milvus.io/api-reference/pymilvus/v2.4.x/EmbeddingModels/SentenceTransformerEmbeddingFunction/SentenceTransformerEmbeddingFunction.md
@@ -116,8 +300,10 @@ class Embeddor:
             raise NotImplementedError("Batch encoding not implemented yet")
 
     def embed_sparse_prefitted_bm25(self, text:str, is_query:bool=False) -> tuple[coo_array, dict[str, float]]:
-        avgdl = self.bm25_parameters['avgdl']
-        n_docs = self.bm25_parameters['n_docs']
+        self.refresh_bm25_parameters()
+        bm25_parameters = self.bm25_parameters
+        avgdl = bm25_parameters.avgdl
+        n_docs = bm25_parameters.n_docs
 
         # Copied from pinecone_text.sparse.BM25Encoder
         b: float = 0.75
@@ -126,49 +312,9 @@ class Embeddor:
         def _hash_text(token:str) -> int:
             return mmh3.hash(token, signed=False)
 
-        def _find_2grams_3grams(tokens_stopwords, tokens_nostopwords):
-            # For the example, assume that:
-            # tokens_stopwords   : ['whi', '3d', 'computer-vis', 'is', 'cool']
-            # tokens_nostopwords : ['3d', 'computer-vis', 'cool']
-
-            A, B = tokens_stopwords, tokens_nostopwords 
-
-            # Find all 2-grams -> [("why", "3d"), ("3d", "computer-vision"), ("computer-vision", "is"), ("is", "cool")]
-            word_pairs_ngrams2 = list(zip(A, A[1:]))
-            # Find all 3-grams -> [("why", "3d", "computer-vision"), ("3d", "computer-vision", "is"), ("computer-vision", "is", "cool")]
-            word_pairs_ngrams3 = list(zip(A, A[1:], A[2:]))
-
-            # Find all 2-grams -> [("3d", "computer-vision"), ("computer-vision", "cool")]
-            token_pairs_ngrams2 = list(zip(B, B[1:]))
-            # Find all 3-grams -> [("3d", "computer-vision", "cool")]
-            token_pairs_ngrams3 = list(zip(B, B[1:], B[2:]))
-
-            # Check which word n-grams occur within the token n-grams, which in this case is only ("3d", "computer-vision")
-            ngrams2, ngrams3 = [], []
-            for (w1, w2) in word_pairs_ngrams2:
-                for (t1, t2) in token_pairs_ngrams2:
-                    if w1.startswith(t1) and w2.startswith(t2):
-                        # Store ngram as "3dcomputer-vision", so that it's a single word which can be hashed into an integer and stored
-                        # in the sparse vector. Break so the word ngram is only added once, even if the token ngram occurs multiple times.
-                        ngrams2.append((t1 + t2, (t1, t2)))
-                        break
-            
-            for (w1, w2, w3) in word_pairs_ngrams3:
-                for (t1, t2, t3) in token_pairs_ngrams3:
-                    if w1.startswith(t1) and w2.startswith(t2) and w3.startswith(t3):
-                        # Store ngram as a single word which can be hashed into an integer and stored
-                        # in the sparse vector. Break so the word ngram is only added once, even if the token ngram occurs multiple times.
-                        ngrams3.append((t1 + t2 + t3, (t1, t2, t3)))
-                        break
-            
-            return ngrams2, ngrams3
-
-        tokens_stopwords = self.bm25_tokenizer_stopwords(text)
-        tokens_nostopwords = self.bm25_tokenizer_nostopwords(text)
-        ngrams2, ngrams3 = _find_2grams_3grams(tokens_stopwords, tokens_nostopwords)
+        tokens_nostopwords, ngrams2, ngrams3 = self.tokenize_bm25(text)
 
         # if is_query:
-        #     print("tokens_stopwords:", tokens_stopwords)
         #     print("tokens_nostopwords:", tokens_nostopwords)
 
         #     print("ngrams2:", ngrams2)
@@ -182,7 +328,7 @@ class Embeddor:
             # Encode query
             
             def _get_df(token:str) -> float:
-                return self.bm25_token_df_map.get(_hash_text(token), 1)
+                return bm25_parameters.get_df(_hash_text(token), 1)
 
             # All 1grams (so words), 2grams, 3grams
             N1, N2, N3 = tokens_nostopwords, ngrams2, ngrams3
@@ -243,9 +389,112 @@ class Embeddor:
             array = coo_array(( token_frequencies_normed, (np.zeros(len(token_frequencies_normed),dtype=int), indices) ))
             return array, {}
 
+    def embed_sparse_prefitted_bm25_batch(self, texts:list[str], is_query:bool=False) -> tuple[csr_matrix, list[dict[str, float]]]:
+        """ Batched version of embed_sparse_prefitted_bm25(). Each unique token is hashed only once over the entire batch, and the
+        term frequency normalization and IDF weighting are calculated with NumPy over the entire batch at once.
+
+        Returns:
+            csr_matrix: Matrix [len(texts) x 2^32] in which row i is the sparse vector of texts[i]. Use coo_array(matrix[[i]]) to get the
+                same coo_array as returned by embed_sparse_prefitted_bm25()
+            list[dict[str, float]]: The keyword idf map of each text. Empty dictionaries when encoding documents
+        """
+        self.refresh_bm25_parameters()
+        bm25_parameters = self.bm25_parameters
+        avgdl = bm25_parameters.avgdl
+        n_docs = bm25_parameters.n_docs
+
+        # Copied from pinecone_text.sparse.BM25Encoder
+        b: float = 0.75
+        k1: float = 1.2
+
+        def _hash_tokens(unique_tokens:list[str]) -> dict[str, int]:
+            # Hash each unique token in the batch only once. Equivalent to { token: mmh3.hash(token, signed=False) }
+            return dict(zip(unique_tokens, map(mmh3.hash, unique_tokens, itertools.repeat(0), itertools.repeat(False))))
+
+        shape = (len(texts), 2**32)
+        tokenized = [ self.tokenize_bm25(text) for text in texts ]
+
+        if not is_query:
+            # Encode documents. Gather all tokens of all documents
+            # All loops over the tokens are done with map() and dict(), so that they run in C instead of Python
+            token_lists = [ N1 + [ _[0] for _ in N2 ] + [ _[0] for _ in N3 ] for N1, N2, N3 in tokenized ]
+            all_tokens = list(itertools.chain.from_iterable(token_lists))
+            token_hashes = _hash_tokens(list(dict.fromkeys(all_tokens)))
+
+            # The hash of each token, together with the row (text) that it belongs to
+            rows = np.repeat(np.arange(len(texts), dtype=np.int64), [ len(tokens) for tokens in token_lists ])
+            hashes = np.fromiter(map(token_hashes.__getitem__, all_tokens), dtype=np.int64, count=len(all_tokens))
+
+            # Count how often a token occurs within each text, by combining row and hash into a single key
+            keys, token_frequencies = np.unique((rows << 32) | hashes, return_counts=True)
+            key_rows, key_hashes = keys >> 32, keys & 0xFFFFFFFF
+            document_lengths = np.bincount(rows, minlength=len(texts))
+
+            # Normalize token frequencies
+            token_frequencies_normed = token_frequencies / (
+                k1 * (1.0 - b + b * (document_lengths[key_rows] / avgdl)) + token_frequencies
+            )
+
+            matrix = csr_matrix((token_frequencies_normed, (key_rows, key_hashes)), shape=shape)
+            return matrix, [ {} for _ in texts ]
+
+        # Encode queries. Look up the document frequencies of all unique tokens in the batch at once
+        all_tokens = set()
+        for N1, N2, N3 in tokenized:
+            all_tokens.update(N1)
+            for token, ngram in N2 + N3: all_tokens.add(token); all_tokens.update(ngram)
+        token_hashes = _hash_tokens(list(all_tokens))
+        all_dfs = bm25_parameters.get_dfs(np.array(list(token_hashes.values()), dtype=np.uint32), 1)
+        token_df = { token: int(df) for token, df in zip(token_hashes.keys(), all_dfs) }
+
+        rows, tokens, dfs = [], [], []
+        for i_text, (N1, N2, N3) in enumerate(tokenized):
+            # Same order and document frequencies as in embed_sparse_prefitted_bm25()
+            for token in set(N1):
+                rows.append(i_text); tokens.append(token); dfs.append(token_df[token])
+            for token, (t1, t2) in set(N2):
+                df_harmonic_mean = .5 / ( 1/token_df[t1] + 1/token_df[t2])
+                rows.append(i_text); tokens.append(token); dfs.append(max(token_df[token], df_harmonic_mean))
+            for token, (t1, t2, t3) in set(N3):
+                df_harmonic_mean = .25 / ( 1/token_df[t1] + 1/token_df[t2] + 1/token_df[t3])
+                rows.append(i_text); tokens.append(token); dfs.append(max(token_df[token], df_harmonic_mean))
+
+        rows = np.array(rows, dtype=np.int64)
+        hashes = np.array([ token_hashes[token] for token in tokens ], dtype=np.int64)
+
+        # Calculate the normalized IDF (inverse document frequency), normalized per text
+        dfs = np.array(dfs).astype(int)                                             # Document Frequencies
+        idfs = np.log((n_docs + 1) / (dfs + 0.5))                                   # Inverse Document Frequencies
+        idfs_sum = np.bincount(rows, weights=idfs, minlength=len(texts))
+        idfs_norm = idfs / idfs_sum[rows] if len(rows) else idfs                    # Normalized Inverse Document Frequencies
+
+        matrix = csr_matrix((idfs_norm, (rows, hashes)), shape=shape)
+
+        # Get all N1 tokens (so just the words from each query) and map to their normalized idf value
+        keyword_maps = [ {} for _ in texts ]
+        for row, token, idf in zip(rows, tokens, idfs):
+            if token in tokenized[row][0]: keyword_maps[row][token] = idf
+        for keywords_idf_map in keyword_maps:
+            keywords_idf_sum = sum(keywords_idf_map.values())
+            for token, idf in keywords_idf_map.items(): keywords_idf_map[token] = idf / keywords_idf_sum
+
+        return matrix, keyword_maps
+
+    def tokenize_bm25(self, text:str) -> tuple[list[str], list[tuple[str, tuple[str, str]]], list[tuple[str, tuple[str, str, str]]]]:
+        """ Tokenize a text into words (without stopwords), 2-grams and 3-grams, as used by the BM25 sparse embeddings """
+        tokens_stopwords = self.bm25_tokenizer_stopwords(text)
+        tokens_nostopwords = self.bm25_tokenizer_nostopwords(text)
+        ngrams2, ngrams3 = find_2grams_3grams(tokens_stopwords, tokens_nostopwords)
+        return tokens_nostopwords, ngrams2, ngrams3
+
     def count_tokens(self, text:str, encoding:str="cl100k_base") -> int:
         # https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
-        return len(tiktoken.get_encoding(encoding).encode(text))
+        return len(get_encoding(encoding).encode(text))
+
+    def count_tokens_batch(self, texts:list[str], encoding:str="cl100k_base") -> list[int]:
+        """ Same as count_tokens, but encodes all texts in a single call, which tiktoken runs on multiple threads """
+        if not len(texts): return []
+        return [ len(tokens) for tokens in get_encoding(encoding).encode_batch(texts) ]
     
     def get_price_per_token(self, model:str="text-embedding-3-small") -> float:
         """
@@ -0,0 +1,126 @@
+from __future__ import annotations
+# System libraries
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+import json
+# Third party libraries
+import numpy as np
+# Local libraries
+from MyLogger import logger
+
+# Text file that contains the path of the active parameter file. Written by scripts/fit_bm25.py --activate
+BM25_CURRENT_FILEPATH = os.getenv("BM25_CURRENT", "bm25_current.txt")
+
+class BM25Parameters:
+    """ Prefitted BM25 parameters. The document frequencies are stored as two sorted uint32 arrays (token hash, document frequency)
+    in a single .npy file, which is memory-mapped when loaded. Lookups are done with np.searchsorted, so there is no need to build
+    a Python dict with one entry per token. All other parameters are stored in a small .meta.json file next to the .npy file.
+
+    bm25_prefitted_on_chunks_sep2024.npy        : uint32 array [2 x n_tokens]. Row 0 are the sorted token hashes, row 1 the document frequencies
+    bm25_prefitted_on_chunks_sep2024.meta.json  : { avgdl, n_docs, b, k1, ... }
+    """
+
+    def __init__(self, hashes:np.ndarray, dfs:np.ndarray, parameters:dict) -> None:
+        self.hashes:np.ndarray = hashes
+        self.dfs:np.ndarray = dfs
+        self.parameters:dict = parameters
+
+        self.avgdl:float = parameters['avgdl']
+        self.n_docs:int = parameters['n_docs']
+        self.b:float = parameters.get('b', 0.75)
+        self.k1:float = parameters.get('k1', 1.2)
+        self.version:str = parameters.get('version', "")
+
+    def get_df(self, token_hash:int, default:int=1) -> int:
+        idx = np.searchsorted(self.hashes, token_hash)
+        if idx < len(self.hashes) and self.hashes[idx] == token_hash:
+            return int(self.dfs[idx])
+        return default
+
+    def get_dfs(self, token_hashes:np.ndarray, default:int=1) -> np.ndarray:
+        """ Vectorized version of get_df() """
+        token_hashes = np.asarray(token_hashes, dtype=np.uint32)
+        if not len(self.hashes):
+            return np.full(len(token_hashes), default, dtype=np.int64)
+        idx = np.minimum(np.searchsorted(self.hashes, token_hashes), len(self.hashes)-1)
+        found = self.hashes[idx] == token_hashes
+        return np.where(found, self.dfs[idx], default).astype(np.int64)
+
+    def save(self, filepath:str) -> None:
+        """ Store the parameters in the binary format. filepath should end with .npy """
+        filepath_meta = filepath[:-len(".npy")] + ".meta.json"
+        # Write to temporary files first, so that a process loading the same filepath never sees a half-written file
+        with open(filepath + ".tmp", "wb") as file:
+            np.save(file, np.vstack([self.hashes, self.dfs]).astype(np.uint32))
+        with open(filepath_meta + ".tmp", "w") as file:
+            json.dump(self.parameters, file, indent=4)
+        os.replace(filepath_meta + ".tmp", filepath_meta)
+        os.replace(filepath + ".tmp", filepath)
+        logger.info(f"Stored BM25 parameters with {len(self.hashes)} tokens at {filepath}")
+
+    @staticmethod
+    def from_json(filepath:str) -> BM25Parameters:
+        """ Load parameters from the JSON format as created by pinecone_text.sparse.BM25Encoder.dump() """
+        with open(filepath, "r") as file:
+            parameters = json.load(file)
+
+        doc_freq = parameters.pop('doc_freq')
+        hashes = np.array(doc_freq['indices'], dtype=np.uint32)
+        dfs = np.array(doc_freq['values'], dtype=np.uint32)
+        order = np.argsort(hashes, kind='stable')
+
+        return BM25Parameters(hashes[order], dfs[order], parameters)
+
+    @staticmethod
+    def from_npy(filepath:str) -> BM25Parameters:
+        """ Load parameters from the binary format. The arrays are memory-mapped and thus shared between processes """
+        array = np.load(filepath, mmap_mode='r')
+        with open(filepath[:-len(".npy")] + ".meta.json", "r") as file:
+            parameters = json.load(file)
+
+        return BM25Parameters(array[0], array[1], parameters)
+
+    @staticmethod
+    def load(filepath:str) -> BM25Parameters:
+        """ Load parameters from either format. If a .json file is given and its binary counterpart exists, the binary file is used """
+        if filepath.endswith(".json") and os.path.isfile(filepath[:-len(".json")] + ".npy"):
+            filepath = filepath[:-len(".json")] + ".npy"
+
+        if filepath.endswith(".npy"):
+            return BM25Parameters.from_npy(filepath)
+
+        logger.warning(f"Loading BM25 parameters from JSON file {filepath}. Convert it with embedding/bm25_parameters.py for faster loading")
+        return BM25Parameters.from_json(filepath)
+
+    @staticmethod
+    def activate(filepath:str) -> None:
+        """ Make filepath the active parameter file. Running Embeddors pick it up via BM25Parameters.current() """
+        with open(BM25_CURRENT_FILEPATH + ".tmp", "w") as file:
+            file.write(os.path.abspath(filepath))
+        os.replace(BM25_CURRENT_FILEPATH + ".tmp", BM25_CURRENT_FILEPATH)
+        logger.info(f"Activated BM25 parameters {filepath}")
+
+    @staticmethod
+    def current() -> str | None:
+        """ Returns the path of the active parameter file, or None if no parameter file has been activated """
+        if not os.path.isfile(BM25_CURRENT_FILEPATH):
+            return None
+        with open(BM25_CURRENT_FILEPATH, "r") as file:
+            return file.read().strip() or None
+
+if __name__ == "__main__":
+    # Convert a JSON file to the binary format. Usage: python embedding/bm25_parameters.py [bm25_prefitted_on_chunks_sep2024.json]
+    filepath_json = sys.argv[1] if 1 < len(sys.argv) else "bm25_prefitted_on_chunks_sep2024.json"
+    filepath_npy = filepath_json[:-len(".json")] + ".npy"
+
+    parameters = BM25Parameters.from_json(filepath_json)
+    parameters.save(filepath_npy)
+
+    # Sanity check, compare every document frequency with the original JSON file
+    with open(filepath_json, "r") as file:
+        doc_freq = json.load(file)['doc_freq']
+    loaded = BM25Parameters.from_npy(filepath_npy)
+    dfs = loaded.get_dfs(np.array(doc_freq['indices'], dtype=np.uint32))
+    assert np.array_equal(dfs, np.array(doc_freq['values']).astype(np.int64)), "Conversion failed"
+    print(f"Converted {filepath_json} to {filepath_npy}")
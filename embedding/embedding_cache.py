@@ -0,0 +1,248 @@
+# System libraries
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+import hashlib
+import threading
+try:
+    import fcntl
+except ImportError:
+    # Windows. Writes are then only synchronized between the threads of a single process
+    fcntl = None
+# Third party libraries
+import numpy as np
+# Local libraries
+from MyLogger import logger
+
+def text_key(text:str) -> bytes:
+    return hashlib.sha256(text.encode("utf-8")).digest()
+
+class ModelStore:
+    """ The cached embeddings of a single model, in one directory:
+
+    index.bin                    : header (magic, dimensions, generation), followed by fixed size records (sha256 of text, shard, row)
+    shard_<generation>_<shard>.f32 : raw float32 vectors, one row per embedding
+
+    Both are append-only. A vector is always written before its index record, so a record never points to a missing vector. The index
+    is read into a dict, and other processes that append are picked up by reading the index from the last known offset. Compaction
+    writes a new generation and replaces index.bin, after which every reader reloads
+    """
+
+    MAGIC = b"EMBC"
+    HEADER = np.dtype([ ('magic', 'S4'), ('dims', '<u4'), ('generation', '<u8') ])
+    RECORD = np.dtype([ ('key', 'S32'), ('shard', '<u4'), ('row', '<u4') ])
+
+    def __init__(self, directory:str, shard_max_bytes:int) -> None:
+        self.directory = directory
+        self.shard_max_bytes = shard_max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+        self.lock = threading.RLock()
+        self.index:dict[bytes, tuple[int, int]] = {}
+        self.dims:int = None
+        self.generation:int = None
+        self.offset = 0
+        self.shards:dict[int, np.memmap] = {}
+
+    def index_filepath(self) -> str:
+        return os.path.join(self.directory, "index.bin")
+
+    def shard_filepath(self, shard:int, generation:int=None) -> str:
+        return os.path.join(self.directory, f"shard_{self.generation if generation is None else generation:04d}_{shard:05d}.f32")
+
+    def file_lock(self):
+        """ Exclusive lock between processes, held while appending or compacting """
+        store = self
+        class FileLock:
+            def __enter__(self):
+                self.file = open(os.path.join(store.directory, "lock"), "a")
+                if fcntl is not None: fcntl.flock(self.file, fcntl.LOCK_EX)
+            def __exit__(self, *args):
+                if fcntl is not None: fcntl.flock(self.file, fcntl.LOCK_UN)
+                self.file.close()
+        return FileLock()
+
+    def refresh(self) -> None:
+        """ Reads the index records that were appended since the last refresh, or reloads the index if it was compacted """
+        if not os.path.isfile(self.index_filepath()): return
+        with open(self.index_filepath(), "rb") as file:
+            header = np.frombuffer(file.read(self.HEADER.itemsize), dtype=self.HEADER)[0]
+            if header['magic'] != self.MAGIC:
+                raise ValueError(f"{self.index_filepath()} is not an embedding cache index")
+            if int(header['generation']) != self.generation:
+                self.index, self.shards, self.offset = {}, {}, self.HEADER.itemsize
+                self.dims, self.generation = int(header['dims']), int(header['generation'])
+            file.seek(self.offset)
+            data = file.read()
+        # A record that is still being written by another process is read on the next refresh
+        n_records = len(data) // self.RECORD.itemsize
+        records = np.frombuffer(data[:n_records * self.RECORD.itemsize], dtype=self.RECORD)
+        for key, shard, row in zip(records['key'], records['shard'].tolist(), records['row'].tolist()):
+            self.index[key] = (shard, row)
+        self.offset += n_records * self.RECORD.itemsize
+
+    def shard(self, shard:int, row:int) -> np.memmap:
+        """ Returns the memory-mapped shard. Mapped again if it grew since it was mapped """
+        array = self.shards.get(shard)
+        if array is None or len(array) <= row:
+            n_rows = os.path.getsize(self.shard_filepath(shard)) // (4 * self.dims)
+            array = self.shards[shard] = np.memmap(self.shard_filepath(shard), dtype=np.float32, mode="r", shape=(n_rows, self.dims))
+        return array
+
+    def get(self, keys:list[bytes]) -> list[np.ndarray | None]:
+        with self.lock:
+            if any([ key not in self.index for key in keys ]):
+                self.refresh()
+            vectors = []
+            for key in keys:
+                location = self.index.get(key)
+                try:
+                    vectors.append(None if location is None else np.array(self.shard(*location)[location[1]]))
+                except (FileNotFoundError, ValueError):
+                    # The shard was removed by a compaction in another process. The next refresh reloads the index
+                    vectors.append(None)
+            return vectors
+
+    def put(self, keys:list[bytes], vectors:np.ndarray) -> None:
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(len(keys), -1)
+        with self.lock, self.file_lock():
+            if not os.path.isfile(self.index_filepath()):
+                self.write_index(self.index_filepath(), vectors.shape[1], 0, np.zeros(0, dtype=self.RECORD))
+            self.refresh()
+            if vectors.shape[1] != self.dims:
+                raise ValueError(f"Embedding cache {self.directory} has {self.dims} dimensions, got {vectors.shape[1]}")
+
+            # Skip keys that are already cached, including duplicates within this call
+            new = {}
+            for key, vector in zip(keys, vectors):
+                if key not in self.index and key not in new: new[key] = vector
+            if not len(new): return
+
+            # Append to the last shard, or start a new shard once it is full
+            shard = max([ shard for shard, _ in self.index.values() ], default=0)
+            n_bytes = os.path.getsize(self.shard_filepath(shard)) if os.path.isfile(self.shard_filepath(shard)) else 0
+            if self.shard_max_bytes < n_bytes + 4 * self.dims * len(new):
+                shard, n_bytes = shard + 1, 0
+            row = n_bytes // (4 * self.dims)
+
+            records = np.zeros(len(new), dtype=self.RECORD)
+            records['key'] = list(new.keys())
+            records['shard'] = shard
+            records['row'] = np.arange(row, row + len(new))
+
+            with open(self.shard_filepath(shard), "ab") as file:
+                file.write(np.stack(list(new.values())).astype(np.float32).tobytes())
+            with open(self.index_filepath(), "ab") as file:
+                file.write(records.tobytes())
+            self.refresh()
+
+    def write_index(self, filepath:str, dims:int, generation:int, records:np.ndarray) -> None:
+        header = np.array([ (self.MAGIC, dims, generation) ], dtype=self.HEADER)
+        with open(filepath, "wb") as file:
+            file.write(header.tobytes())
+            file.write(records.tobytes())
+
+    def compact(self, live_keys:set[bytes]=None) -> dict:
+        """ Rewrites the cache as a new generation without duplicate vectors, and without keys that are not in live_keys if given """
+        with self.lock, self.file_lock():
+            self.refresh()
+            if self.generation is None: return { 'kept': 0, 'removed': 0 }
+
+            n_bytes_before = sum([ os.path.getsize(os.path.join(self.directory, f)) for f in os.listdir(self.directory) if f.endswith(".f32") ])
+            keys = [ key for key in self.index if live_keys is None or key in live_keys ]
+            generation = self.generation + 1
+            rows_per_shard = max(1, self.shard_max_bytes // (4 * self.dims))
+
+            records = np.zeros(len(keys), dtype=self.RECORD)
+            for i_start in range(0, len(keys), rows_per_shard):
+                shard_keys = keys[i_start:i_start+rows_per_shard]
+                vectors = np.stack([ self.shard(*self.index[key])[self.index[key][1]] for key in shard_keys ]) if len(shard_keys) else None
+                shard = i_start // rows_per_shard
+                with open(self.shard_filepath(shard, generation), "wb") as file:
+                    file.write(vectors.astype(np.float32).tobytes())
+                records['key'][i_start:i_start+len(shard_keys)] = shard_keys
+                records['shard'][i_start:i_start+len(shard_keys)] = shard
+                records['row'][i_start:i_start+len(shard_keys)] = np.arange(len(shard_keys))
+
+            # Replacing the index switches all readers to the new generation at once
+            self.write_index(self.index_filepath() + ".tmp", self.dims, generation, records)
+            os.replace(self.index_filepath() + ".tmp", self.index_filepath())
+
+            for filename in os.listdir(self.directory):
+                if filename.endswith(".f32") and not filename.startswith(f"shard_{generation:04d}_"):
+                    os.remove(os.path.join(self.directory, filename))
+
+            n_removed = len(self.index) - len(keys)
+            self.generation = None
+            self.refresh()
+            n_bytes_after = sum([ os.path.getsize(os.path.join(self.directory, f)) for f in os.listdir(self.directory) if f.endswith(".f32") ])
+            return { 'kept': len(keys), 'removed': n_removed, 'bytes_before': n_bytes_before, 'bytes_after': n_bytes_after }
+
+    def __len__(self) -> int:
+        with self.lock:
+            self.refresh()
+            return len(self.index)
+
+class EmbeddingCache:
+    """ Persistent cache of dense embeddings, keyed by (model, sha256 of the text). Every model has its own directory, see ModelStore.
+    The cache is shared by all processes that use the same directory, e.g. process_tdps.py and the API. Embeddings never change for
+    the same model and text, so entries never expire. Use scripts/compact_embedding_cache.py to reclaim space """
+
+    def __init__(self, root_dir:str, shard_max_bytes:int=256*1024*1024) -> None:
+        self.root_dir = root_dir
+        self.shard_max_bytes = shard_max_bytes
+        self.stores:dict[str, ModelStore] = {}
+        self.lock = threading.Lock()
+        self.n_hits = 0
+        self.n_misses = 0
+
+    def store(self, model:str) -> ModelStore:
+        with self.lock:
+            if model not in self.stores:
+                self.stores[model] = ModelStore(os.path.join(self.root_dir, model), self.shard_max_bytes)
+            return self.stores[model]
+
+    def models(self) -> list[str]:
+        if not os.path.isdir(self.root_dir): return []
+        return sorted([ _ for _ in os.listdir(self.root_dir) if os.path.isfile(os.path.join(self.root_dir, _, "index.bin")) ])
+
+    def get(self, model:str, texts:list[str]) -> list[np.ndarray | None]:
+        """ Returns the cached embedding of every text, or None if it is not cached """
+        vectors = self.store(model).get([ text_key(text) for text in texts ])
+        n_hits = sum([ vector is not None for vector in vectors ])
+        with self.lock:
+            self.n_hits += n_hits
+            self.n_misses += len(texts) - n_hits
+        return vectors
+
+    def put(self, model:str, texts:list[str], vectors:np.ndarray) -> None:
+        try:
+            self.store(model).put([ text_key(text) for text in texts ], vectors)
+        except OSError as e:
+            # E.g. a full disk. Caching should never break embedding
+            logger.error(f"Could not write to embedding cache {self.root_dir}: {e}")
+
+    def compact(self, live_texts:list[str]=None) -> dict[str, dict]:
+        live_keys = None if live_texts is None else set([ text_key(text) for text in live_texts ])
+        return { model: self.store(model).compact(live_keys) for model in self.models() }
+
+    def hit_rate(self) -> float:
+        with self.lock:
+            return self.n_hits / max(1, self.n_hits + self.n_misses)
+
+    def statistics(self) -> dict:
+        with self.lock:
+            statistics = { 'hits': self.n_hits, 'misses': self.n_misses }
+        statistics['hit_rate'] = self.hit_rate()
+        statistics['entries'] = { model: len(self.store(model)) for model in self.models() }
+        return statistics
+
+if __name__ == "__main__":
+    import tempfile
+    cache = EmbeddingCache(tempfile.mkdtemp(), shard_max_bytes=4*8*10)
+    texts = [ f"text {i}" for i in range(25) ]
+    cache.put("test-model", texts, np.random.rand(25, 8))
+    cache.put("test-model", texts[:5], np.random.rand(5, 8))
+    print([ v is not None for v in cache.get("test-model", texts[20:] + ["unknown"]) ])
+    print(cache.compact(live_texts=texts[:10]))
+    print(cache.statistics())
@@ -13,6 +13,7 @@ from .Semver import Semver
 from .Span import Span
 from .Image import Image
 from data_access.llm.llm_client import OpenAIClient
+from data_access.llm.openai_scheduler import PRIORITY_INGESTION
 from data_structures.TDPStructure import TDPStructure
 from data_structures.Paragraph import Paragraph
 from data_structures.Sentence import Sentence
@@ -23,7 +24,7 @@ from . import utilities as U
 
 # PyMuPDF documentation: https://buildmedia.readthedocs.org/media/pdf/pymupdf/latest/pymupdf.pdf
 
-llm_client:OpenAIClient = OpenAIClient()
+llm_client:OpenAIClient = OpenAIClient(priority=PRIORITY_INGESTION)
 
 """
 TODO:
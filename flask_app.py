@@ -7,7 +7,7 @@ import os
 import time
 import threading
 # Third party libraries
-from flask import Flask, g, render_template, request, send_from_directory, Response
+from flask import Flask, g, render_template, request, send_from_directory, Response, stream_with_context
 from telegram import Bot
 # Local libraries
 import app
@@ -98,7 +98,7 @@ def api_query():
 
     flask_response = Response(json_response)
     flask_response.headers['Content-Type'] = "application/json"
-    flask_response.headers['Cache-Control'] = "max-age=604800, public"
+    flask_response.headers['Cache-Control'] = app.CACHE_CONTROL_QUERY
     
     return flask_response
 
@@ -115,5 +115,18 @@ def api_query_llm():
     
     return flask_response
 
+@flask_app.route("/api/query/llm/stream")
+def api_query_llm_stream():
+    query = request.args.get('query')
+    filter = VectorFilter.from_dict(dict(request.args))
+
+    flask_response = Response(stream_with_context(app.api_query_llm_stream(query, filter)))
+    flask_response.headers['Content-Type'] = "text/event-stream"
+    flask_response.headers['Cache-Control'] = "no-cache"
+    # Prevent reverse proxies such as nginx from buffering the stream
+    flask_response.headers['X-Accel-Buffering'] = "no"
+
+    return flask_response
+
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=5000)
\ No newline at end of file
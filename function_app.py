@@ -6,6 +6,12 @@ from dotenv import load_dotenv
 import threading
 # Third party libraries
 from azure import functions as func
+try:
+    # HTTP streaming needs the azurefunctions-extensions-http-fastapi package. Without it, streams are sent as a single response
+    from azurefunctions.extensions.http.fastapi import Request, StreamingResponse
+    http_streaming = True
+except ImportError:
+    http_streaming = False
 # Local libraries
 import app
 from data_access.metadata.metadata_client import MongoDBClient
@@ -129,7 +135,7 @@ def api_query(req: func.HttpRequest):
 
     headers = { 
         "Access-Control-Allow-Origin": "*",
-        "Cache-Control": "max-age=604800, public"
+        "Cache-Control": app.CACHE_CONTROL_QUERY
     }
     
     return func.HttpResponse(json_response, mimetype="application/json", headers=headers)
@@ -156,4 +162,35 @@ def api_query_llm(req: func.HttpRequest):
         "Cache-Control": "max-age=604800, public"
     }
     
-    return func.HttpResponse(json_response, mimetype="application/json", headers=headers)
\ No newline at end of file
+    return func.HttpResponse(json_response, mimetype="application/json", headers=headers)
+
+if http_streaming:
+    @azure_app.route("query/llm/stream")
+    async def api_query_llm_stream(req: Request) -> StreamingResponse:
+        query = req.query_params.get('query')
+        filter = VectorFilter.from_dict(dict(req.query_params))
+
+        headers = {
+            "Access-Control-Allow-Origin": "*",
+            "Cache-Control": "no-cache"
+        }
+        # api_query_llm_stream is a blocking generator. StreamingResponse iterates it in a thread pool
+        return StreamingResponse(app.api_query_llm_stream(query, filter), media_type="text/event-stream", headers=headers)
+else:
+    @azure_app.route("query/llm/stream")
+    def api_query_llm_stream(req: func.HttpRequest):
+        query = req.params.get('query')
+        filter = VectorFilter.from_dict(dict(req.params))
+
+        headers = {
+            "Access-Control-Allow-Origin": "*",
+            "Cache-Control": "no-cache"
+        }
+        # Same events, but only sent once the whole answer is generated
+        return func.HttpResponse("".join(app.api_query_llm_stream(query, filter)), mimetype="text/event-stream", headers=headers)
+
+@azure_app.timer_trigger(schedule="0 0 3 * * *", arg_name="timer", run_on_startup=False)
+def compact_cache(timer: func.TimerRequest) -> None:
+    # Nightly compaction of the MongoDB cache. Same as scripts/compact_cache.py
+    statistics = startup.get_cache_client().compact()
+    logger.info(f"Compacted cache: {statistics}")
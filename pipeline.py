@@ -0,0 +1,114 @@
+# System libraries
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+import threading
+import time
+# Local libraries
+from MyLogger import logger
+
+def timed(function, *args, **kwargs) -> tuple[object, float]:
+    """ Returns the result of the function and its duration. Module level, so that it can be sent to a process pool """
+    t_start = time.time()
+    result = function(*args, **kwargs)
+    return result, time.time() - t_start
+
+class Stage:
+    """ A stage of a pipeline. Runs tasks on a pool of max_workers threads or processes. At most max_pending tasks can be queued or
+    running at any time. Once that many are pending, submit() blocks until one finishes. This is the back-pressure of the pipeline: a
+    fast stage can't run ahead of a slow stage downstream, and memory stays bounded
+
+    Stages must form a directed acyclic graph. A task may submit to a stage further downstream, but a cycle of blocking submits can deadlock
+    """
+
+    def __init__(self, name:str, max_workers:int, max_pending:int=None, use_processes:bool=False) -> None:
+        self.name = name
+        self.max_workers = max_workers
+        self.max_pending = max_pending or 2 * max_workers
+        self.executor:Executor = ProcessPoolExecutor(max_workers) if use_processes else ThreadPoolExecutor(max_workers, thread_name_prefix=name)
+        self.slots = threading.BoundedSemaphore(self.max_pending)
+
+        self.lock = threading.Lock()
+        self.n_submitted = 0
+        self.n_done = 0
+        self.n_failed = 0
+        self.busy_seconds = 0
+        self.blocked_seconds = 0
+
+    def submit(self, function, *args, **kwargs) -> Future:
+        """ Returns a future with the result of function(*args, **kwargs). Blocks while the stage is full """
+        t_start = time.time()
+        self.slots.acquire()
+        future_timed = self.executor.submit(timed, function, *args, **kwargs)
+        with self.lock:
+            self.n_submitted += 1
+            self.blocked_seconds += time.time() - t_start
+
+        # Unwrap the duration, so that the caller only sees the result of the function
+        future = Future()
+        future.set_running_or_notify_cancel()
+        def done(future_timed:Future):
+            self.slots.release()
+            exception = future_timed.exception()
+            with self.lock:
+                self.n_done += 1
+                if exception is None: self.busy_seconds += future_timed.result()[1]
+                else: self.n_failed += 1
+            if exception is None: future.set_result(future_timed.result()[0])
+            else: future.set_exception(exception)
+        future_timed.add_done_callback(done)
+
+        return future
+
+    def n_pending(self) -> int:
+        with self.lock:
+            return self.n_submitted - self.n_done
+
+    def shutdown(self) -> None:
+        self.executor.shutdown(wait=True)
+
+    def report(self, duration:float) -> str:
+        """ duration is the number of seconds that the pipeline has been running """
+        with self.lock:
+            throughput = self.n_done / max(duration, 1e-9)
+            # Fraction of the time that the workers were busy. Near 1 means that this stage is the bottleneck
+            utilization = self.busy_seconds / max(duration * self.max_workers, 1e-9)
+            return (f"{self.name:>10} | done {self.n_done:6} | pending {self.n_submitted-self.n_done:4}/{self.max_pending:<4} | failed {self.n_failed:4} | "
+                    f"{throughput:7.2f}/s | utilization {utilization:6.1%} | blocked {self.blocked_seconds:7.1f}s")
+
+class Pipeline:
+    """ A set of stages, with a background thread that logs the progress of every stage """
+
+    def __init__(self, stages:list[Stage]) -> None:
+        self.stages = stages
+        self.t_start = time.time()
+        self.stopped = threading.Event()
+
+    def report(self) -> str:
+        duration = time.time() - self.t_start
+        return f"Pipeline running for {duration:.0f}s\n" + "\n".join([ stage.report(duration) for stage in self.stages ])
+
+    def start_reporting(self, interval:float=30, extra=None) -> None:
+        """ Logs the report every interval seconds. extra is an optional function that returns a string to log along with it """
+        def report():
+            while not self.stopped.wait(interval):
+                logger.info(self.report() + ("" if extra is None else f"\n{extra()}"))
+        threading.Thread(target=report, daemon=True).start()
+
+    def shutdown(self) -> None:
+        """ Waits for all stages, upstream first, since upstream tasks can still submit to downstream stages """
+        for stage in self.stages:
+            stage.shutdown()
+        self.stopped.set()
+
+if __name__ == "__main__":
+    slow = Stage("slow", max_workers=2, max_pending=4)
+    fast = Stage("fast", max_workers=4)
+    pipeline = Pipeline([fast, slow])
+
+    def fast_task(i:int):
+        # Blocks as soon as the slow stage is full, which limits how far the fast stage can run ahead
+        slow.submit(time.sleep, 0.1)
+
+    for i in range(40):
+        fast.submit(fast_task, i)
+    pipeline.shutdown()
+    print(pipeline.report())
@@ -0,0 +1,63 @@
+# System libraries
+import json
+import os
+import threading
+import time
+# Local libraries
+from MyLogger import logger
+
+class QueryLog:
+    """ Appends one JSON record per API query to a JSONL file. Used to analyse latency, and by scripts/warmup_cache.py to find the
+    most frequent queries. A record looks like:
+
+    { "timestamp": 1727000000, "endpoint": "query", "query": "dribbler design", "filter": { "league": "soccer_smallsize" },
+      "cache": "hit", "latency_ms": 12.3, "timings": { "embed": 0.21, "query_index": 0.35, ... } }
+
+    cache is one of "hit", "stale" (served, refreshed in the background), "semantic", "miss", "coalesced" (waited for a concurrent miss of
+    the same query, and got its result), or "error"
+    """
+
+    def __init__(self, filepath:str) -> None:
+        self.filepath = filepath
+        self.lock = threading.Lock()
+        self.enabled = True
+
+    def record(self, endpoint:str, query:str, filter:dict, cache:str, latency_ms:float, timings:dict=None) -> None:
+        if not self.enabled: return
+
+        record = {
+            "timestamp": int(time.time()),
+            "endpoint": endpoint,
+            "query": query,
+            "filter": filter,
+            "cache": cache,
+            "latency_ms": round(latency_ms, 2),
+            "timings": { stage: round(duration, 4) for stage, duration in (timings or {}).items() }
+        }
+        line = json.dumps(record) + "\n"
+
+        try:
+            with self.lock:
+                with open(self.filepath, "a") as file:
+                    file.write(line)
+        except OSError as e:
+            # E.g. a read-only filesystem. Logging queries should never break the API
+            logger.error(f"Could not write to query log {self.filepath}, disabling it: {e}")
+            self.enabled = False
+
+    def read(self) -> list[dict]:
+        """ Returns all records. Lines that can't be parsed, e.g. a line that was being written during a crash, are skipped """
+        if not os.path.isfile(self.filepath):
+            return []
+        records = []
+        with open(self.filepath, "r") as file:
+            for line in file:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    continue
+        return records
+
+# Set QUERY_LOG to an empty string to disable
+instance = QueryLog(os.getenv("QUERY_LOG", "query_log.jsonl"))
+instance.enabled = instance.filepath != ""
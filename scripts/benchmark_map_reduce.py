@@ -0,0 +1,126 @@
+# System libraries
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import re
+import threading
+import time
+# Third party libraries
+import numpy as np
+# Local libraries
+from MyLogger import logger
+
+""" Benchmark of OpenAIClient.answer_question (single-shot) against OpenAIClient.answer_question_map_reduce, for an increasing number
+of paragraphs. Runs against a local stand-in for the OpenAI API, so it costs nothing and is reproducible. The stand-in simulates the
+latency of a completion as
+
+    latency = base + input tokens * prefill time per token + output tokens * time per output token
+
+and answers with the [id]s of all paragraphs it received, so the benchmark also checks that map-reduce cites the same sources as
+single-shot. The default latencies roughly match gpt-4o-mini. Tune them with the arguments to match your own measurements.
+
+Usage: python scripts/benchmark_map_reduce.py --paragraphs 10 20 40 --group-size 5 --max-workers 4
+"""
+
+WORDS = "the robot uses a brushless motor to drive the dribbler which keeps the ball close while turning at high speed".split()
+
+class StandInLLM(BaseHTTPRequestHandler):
+    """ Minimal OpenAI compatible /chat/completions endpoint """
+    latency_base = 0.3
+    latency_input_token = 0.00002
+    latency_output_token = 0.006
+    tokens_answer = 2500
+    tokens_facts = 200
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        text_in = "".join([ message['content'] for message in request['messages'] ])
+        is_map = "Extract every fact" in request['messages'][0]['content']
+
+        ids = sorted(set(re.findall(r"\[\d{4}\]", request['messages'][-1]['content'])))
+        n_tokens_in = len(text_in) // 4
+        n_tokens_out = StandInLLM.tokens_facts * max(1, len(ids)) // 5 if is_map else StandInLLM.tokens_answer
+
+        if is_map:
+            content = "\n".join([ f"{' '.join(WORDS[:10])} {id}" for id in ids ]) or "NONE"
+        else:
+            content = " ".join(WORDS * (n_tokens_out // len(WORDS))) + " " + " ".join(ids)
+
+        time.sleep(StandInLLM.latency_base + n_tokens_in * StandInLLM.latency_input_token + n_tokens_out * StandInLLM.latency_output_token)
+
+        response = json.dumps({
+            "id": "chatcmpl-standin", "object": "chat.completion", "created": int(time.time()), "model": request['model'],
+            "choices": [{ "index": 0, "finish_reason": "stop", "message": { "role": "assistant", "content": content } }],
+            "usage": { "prompt_tokens": n_tokens_in, "completion_tokens": n_tokens_out, "total_tokens": n_tokens_in + n_tokens_out }
+        }).encode()
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, format, *args):
+        pass
+
+def make_paragraphs(n:int, n_words:int=250) -> list[str]:
+    """ Paragraphs in the format of search.build_llm_input_groups """
+    rng = np.random.default_rng(n)
+    paragraphs = []
+    for i in range(n):
+        text = " ".join(rng.choice(WORDS, n_words))
+        paragraphs.append(f"\n\n\n\n=============== NEW PARAGRAPH ================\nSOURCE : | id='[{1000+i}]', team='Team {i}', year='2024', league='Soccer SmallSize', paragraph='Dribbler' |\nTEXT : | {text} |")
+    return paragraphs
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark single-shot against map-reduce answering on a local stand-in LLM")
+    parser.add_argument("--paragraphs", type=int, nargs="+", default=[10, 20, 40], help="Numbers of paragraphs to benchmark")
+    parser.add_argument("--group-size", type=int, default=5)
+    parser.add_argument("--max-workers", type=int, default=4)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--latency-base", type=float, default=StandInLLM.latency_base, help="Seconds per request")
+    parser.add_argument("--latency-input-token", type=float, default=StandInLLM.latency_input_token, help="Seconds per input token")
+    parser.add_argument("--latency-output-token", type=float, default=StandInLLM.latency_output_token, help="Seconds per output token")
+    parser.add_argument("--tokens-answer", type=int, default=StandInLLM.tokens_answer, help="Output tokens of the final answer")
+    args = parser.parse_args()
+
+    StandInLLM.latency_base = args.latency_base
+    StandInLLM.latency_input_token = args.latency_input_token
+    StandInLLM.latency_output_token = args.latency_output_token
+    StandInLLM.tokens_answer = args.tokens_answer
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInLLM)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    # The OpenAI client reads these when it is created
+    os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{server.server_address[1]}/v1"
+    os.environ["OPENAI_API_KEY"] = "stand-in"
+    from data_access.llm.llm_client import OpenAIClient
+    llm_client = OpenAIClient()
+
+    question = "How do teams design their dribbler?"
+
+    print(f"\n{'paragraphs':>10} | {'mode':>10} | {'mean':>7} | {'max':>7} | {'cost':>9} | citations")
+    for n_paragraphs in args.paragraphs:
+        paragraphs = make_paragraphs(n_paragraphs)
+        groups = [ "".join(paragraphs[i:i+args.group_size]) for i in range(0, len(paragraphs), args.group_size) ]
+        ids_expected = set(re.findall(r"\[\d{4}\]", "".join(paragraphs)))
+
+        for mode in ["single", "map-reduce"]:
+            durations, costs_start = [], llm_client.total_costs
+            for _ in range(args.repeats):
+                t_start = time.time()
+                if mode == "single":
+                    answer = llm_client.answer_question(question, "".join(paragraphs))
+                else:
+                    answer = llm_client.answer_question_map_reduce(question, groups, max_workers=args.max_workers)
+                durations.append(time.time() - t_start)
+
+            citations = "ok" if set(re.findall(r"\[\d{4}\]", answer)) == ids_expected else "MISSING"
+            cost = (llm_client.total_costs - costs_start) / args.repeats
+            print(f"{n_paragraphs:>10} | {mode:>10} | {np.mean(durations):6.2f}s | {np.max(durations):6.2f}s | ${cost:.5f} | {citations}")
+
+    server.shutdown()
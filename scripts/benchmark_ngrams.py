@@ -0,0 +1,76 @@
+# System libraries
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+import time
+# Third party libraries
+import numpy as np
+# Local libraries
+from data_access.file.chunk_archive import ChunkArchive, CHUNK_ARCHIVE_DIR
+from embedding.Embeddings import instance as embeddor, find_2grams_3grams
+from MyLogger import logger
+import startup
+
+""" Micro-benchmark for the n-gram matching in Embeddor.embed_sparse_prefitted_bm25(). Compares the original quadratic implementation
+with find_2grams_3grams() on the chunk texts that process_tdps.py stored on disk, and checks that both give exactly the same output """
+
+N_CHUNKS = 2000
+N_REPEATS = 3
+
+def find_2grams_3grams_quadratic(tokens_stopwords, tokens_nostopwords):
+    """ The original implementation, compares every word n-gram with every token n-gram """
+    A, B = tokens_stopwords, tokens_nostopwords
+
+    word_pairs_ngrams2 = list(zip(A, A[1:]))
+    word_pairs_ngrams3 = list(zip(A, A[1:], A[2:]))
+    token_pairs_ngrams2 = list(zip(B, B[1:]))
+    token_pairs_ngrams3 = list(zip(B, B[1:], B[2:]))
+
+    ngrams2, ngrams3 = [], []
+    for (w1, w2) in word_pairs_ngrams2:
+        for (t1, t2) in token_pairs_ngrams2:
+            if w1.startswith(t1) and w2.startswith(t2):
+                ngrams2.append((t1 + t2, (t1, t2)))
+                break
+
+    for (w1, w2, w3) in word_pairs_ngrams3:
+        for (t1, t2, t3) in token_pairs_ngrams3:
+            if w1.startswith(t1) and w2.startswith(t2) and w3.startswith(t3):
+                ngrams3.append((t1 + t2 + t3, (t1, t2, t3)))
+                break
+
+    return ngrams2, ngrams3
+
+def benchmark(function, tokens:list[tuple[list[str], list[str]]]) -> tuple[float, list]:
+    durations, results = [], None
+    for _ in range(N_REPEATS):
+        t_start = time.perf_counter()
+        results = [ function(A, B) for A, B in tokens ]
+        durations.append(time.perf_counter() - t_start)
+    return min(durations), results
+
+if __name__ == "__main__":
+    file_client = startup.get_file_client()
+
+    chunk_archive = ChunkArchive(os.path.join(file_client.root_dir, CHUNK_ARCHIVE_DIR))
+    texts = [ chunk['text'] for chunk in chunk_archive.iterate(limit=N_CHUNKS) ]
+    logger.info(f"Loaded {len(texts)} chunks")
+
+    # Add a number of questions-sized texts, which are the other common input during ingestion
+    texts += [ " ".join(text.split(" ")[:20]) for text in texts ]
+
+    # Tokenize once, only the n-gram matching is benchmarked
+    tokens = [ (embeddor.bm25_tokenizer_stopwords(text), embeddor.bm25_tokenizer_nostopwords(text)) for text in texts ]
+    n_tokens = np.array([ len(A) for A, _ in tokens ])
+    logger.info(f"Tokens per text: mean={n_tokens.mean():.1f} max={n_tokens.max()}")
+
+    duration_quadratic, results_quadratic = benchmark(find_2grams_3grams_quadratic, tokens)
+    duration_linear, results_linear = benchmark(find_2grams_3grams, tokens)
+
+    n_mismatches = sum([ a != b for a, b in zip(results_quadratic, results_linear) ])
+
+    print(f"Texts      : {len(texts)}")
+    print(f"Quadratic  : {duration_quadratic*1000:10.2f} ms    {1e6*duration_quadratic/len(texts):8.2f} us/text")
+    print(f"Linear     : {duration_linear*1000:10.2f} ms    {1e6*duration_linear/len(texts):8.2f} us/text")
+    print(f"Speedup    : {duration_quadratic/duration_linear:10.2f}x")
+    print(f"Mismatches : {n_mismatches}")
@@ -0,0 +1,44 @@
+# System libraries
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+# Local libraries
+from data_access.vector.vector_metadata_store import VectorMetadataStore
+from MyLogger import logger
+import startup
+
+""" Backfill the vector metadata store (VECTOR_METADATA_STORE) from the vector database, for all TDPs that were processed before
+process_tdps.py started writing to it. Safe to run multiple times, existing records are replaced.
+
+Usage: VECTOR_METADATA_STORE=vector_metadata.sqlite python scripts/build_vector_metadata_store.py
+"""
+
+# Number of ids per fetch request
+BATCH_SIZE = 100
+
+if __name__ == "__main__":
+    metadata_client = startup.get_metadata_client()
+    vector_client = startup.get_vector_client()
+    vector_metadata_store = startup.get_vector_metadata_store(read_only=False)
+
+    if vector_metadata_store is None:
+        raise ValueError("VECTOR_METADATA_STORE is not set")
+
+    tdps = metadata_client.find_tdps()
+    logger.info(f"Copying metadata of {len(tdps)} TDPs to {vector_metadata_store.filepath}")
+
+    for i_tdp, tdp in enumerate(tdps):
+        paragraph_chunk_ids = vector_client.get_paragraph_chunks_by_tdpname(tdp.tdp_name)
+        question_ids = vector_client.get_questions_by_tdpname(tdp.tdp_name)
+
+        for i in range(0, len(paragraph_chunk_ids), BATCH_SIZE):
+            metadatas = vector_client.fetch_paragraph_chunks_metadata(paragraph_chunk_ids[i:i+BATCH_SIZE])
+            vector_metadata_store.store(VectorMetadataStore.TABLE_PARAGRAPH, list(metadatas.items()))
+
+        for i in range(0, len(question_ids), BATCH_SIZE):
+            metadatas = vector_client.fetch_questions_metadata(question_ids[i:i+BATCH_SIZE])
+            vector_metadata_store.store(VectorMetadataStore.TABLE_QUESTION, list(metadatas.items()))
+
+        logger.info(f"{i_tdp+1:4}/{len(tdps)} {tdp.tdp_name}: {len(paragraph_chunk_ids)} paragraph chunks, {len(question_ids)} questions")
+
+    logger.info(f"Paragraph chunks: {vector_metadata_store.count(VectorMetadataStore.TABLE_PARAGRAPH)}    Questions: {vector_metadata_store.count(VectorMetadataStore.TABLE_QUESTION)}")
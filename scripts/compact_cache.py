@@ -0,0 +1,19 @@
+# System libraries
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+import json
+# Local libraries
+from MyLogger import logger
+import startup
+
+""" Compacts the MongoDB cache: compresses entries that were stored as plain strings, deletes expired entries, and evicts the entries
+with the fewest hits until the collections are within CACHE_QUERY_MAX_ENTRIES and CACHE_LLM_MAX_ENTRIES entries, and within
+CACHE_QUERY_MAX_MB and CACHE_LLM_MAX_MB of stored values. Also runs nightly as the compact_cache timer trigger in function_app.py """
+
+if __name__ == "__main__":
+    cache_client = startup.get_cache_client()
+
+    logger.info(f"Before: {cache_client.cache_client.count_queries()} queries, {cache_client.cache_client.count_llms()} LLM answers")
+    statistics = cache_client.compact()
+    print(json.dumps(statistics, indent=4))
@@ -0,0 +1,39 @@
+# System libraries
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+import argparse
+import json
+# Local libraries
+from data_access.vector.vector_metadata_store import VectorMetadataStore
+from embedding.embedding_cache import EmbeddingCache
+from MyLogger import logger
+import startup
+
+""" Compacts the embedding cache in EMBEDDING_CACHE_DIR: rewrites the shards without duplicate vectors. With --prune, also removes every
+embedding of a text that is no longer a paragraph chunk or question in the vector metadata store (VECTOR_METADATA_STORE), e.g. chunks of
+reprocessed TDPs and embedded search queries. Processes that use the cache can keep running, they switch to the compacted cache on their
+next miss """
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compact the embedding cache")
+    parser.add_argument("--prune", action="store_true", help="Only keep embeddings of texts in the vector metadata store")
+    args = parser.parse_args()
+
+    if not os.getenv("EMBEDDING_CACHE_DIR"):
+        logger.error("EMBEDDING_CACHE_DIR is not set")
+        exit()
+    cache = EmbeddingCache(os.getenv("EMBEDDING_CACHE_DIR"))
+
+    live_texts = None
+    if args.prune:
+        store = startup.get_vector_metadata_store()
+        if store is None:
+            logger.error("--prune needs VECTOR_METADATA_STORE")
+            exit()
+        live_texts = [ metadata['text'] for _, metadata in store.iterate(VectorMetadataStore.TABLE_PARAGRAPH) ]
+        live_texts += [ metadata['question'] for _, metadata in store.iterate(VectorMetadataStore.TABLE_QUESTION) ]
+        logger.info(f"Keeping the embeddings of {len(live_texts)} texts")
+
+    logger.info(f"Before: {cache.statistics()['entries']}")
+    print(json.dumps(cache.compact(live_texts), indent=4))
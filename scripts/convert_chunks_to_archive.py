@@ -0,0 +1,55 @@
+# System libraries
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+import argparse
+from collections import defaultdict
+import glob
+import json
+# Local libraries
+from data_access.file.chunk_archive import ChunkArchive, CHUNK_ARCHIVE_DIR
+from data_structures.TDPName import TDPName
+from MyLogger import logger
+import startup
+
+""" Converts the chunk files that older versions of process_tdps.py wrote to <LOCAL_FILE_ROOT>/chunks, one JSON file per chunk, into
+the chunk archive: one JSONL shard per TDP. Every directory in the old layout holds the chunks of a single TDP. TDPs that already have a
+shard are skipped, unless --overwrite is given. The old chunk files are left untouched """
+
+if __name__ == "__main__":
+    file_client = startup.get_file_client()
+
+    parser = argparse.ArgumentParser(description="Convert the per-chunk JSON files into the chunk archive")
+    parser.add_argument("--chunks", type=str, default=os.path.join(file_client.root_dir, "chunks"), help="Directory with the old chunk files")
+    parser.add_argument("--archive", type=str, default=os.path.join(file_client.root_dir, CHUNK_ARCHIVE_DIR), help="Chunk archive directory")
+    parser.add_argument("--overwrite", action="store_true", help="Also rewrite TDPs that already have a shard")
+    args = parser.parse_args()
+
+    chunk_archive = ChunkArchive(args.archive)
+
+    filepaths_per_directory:dict[str, list[str]] = defaultdict(list)
+    for filepath in glob.glob(os.path.join(args.chunks, "**", "*.json"), recursive=True):
+        filepaths_per_directory[os.path.dirname(filepath)].append(filepath)
+    logger.info(f"Found {sum(map(len, filepaths_per_directory.values()))} chunk files of {len(filepaths_per_directory)} TDPs in {args.chunks}")
+
+    n_converted, n_skipped, n_chunks = 0, 0, 0
+    for directory, filepaths in sorted(filepaths_per_directory.items()):
+        try:
+            tdp_name = TDPName.from_string(os.path.basename(directory))
+        except Exception as e:
+            logger.error(f"Skipping {directory}: {e}")
+            continue
+
+        if not args.overwrite and os.path.isfile(chunk_archive.shard_filepath(tdp_name)):
+            n_skipped += 1
+            continue
+
+        chunks = []
+        for filepath in filepaths:
+            with open(filepath, "r") as file:
+                chunks.append(json.load(file))
+        chunk_archive.write_tdp(tdp_name, chunks)
+        n_converted += 1
+        n_chunks += len(chunks)
+
+    logger.info(f"Converted {n_chunks} chunks of {n_converted} TDPs, skipped {n_skipped} TDPs that were already archived")
@@ -0,0 +1,135 @@
+# System libraries
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+import argparse
+from collections import Counter
+import json
+from multiprocessing import Pool
+import time
+# Third party libraries
+import mmh3
+import numpy as np
+from pinecone_text.sparse.bm25_tokenizer import BM25Tokenizer
+# Local libraries
+from data_access.file.chunk_archive import ChunkArchive
+from embedding.bm25_parameters import BM25Parameters, BM25_CURRENT_FILEPATH
+from MyLogger import logger
+
+""" Refit the BM25 parameters (doc_freq, avgdl, n_docs) on the current corpus, and write them to a new versioned parameter file.
+
+Documents are read from the chunk archive stored on disk by process_tdps.py, or from the paragraph metadata of a LocalVectorClient. The
+document frequencies are counted in parallel: each worker process tokenizes a batch of documents and returns the hashed document
+frequencies of that batch (map), after which all batches are summed (reduce). The result is identical to
+pinecone_text.sparse.BM25Encoder.fit(), which was used to create bm25_prefitted_on_chunks_sep2024.json.
+
+Usage:
+    python scripts/fit_bm25.py --chunks <LOCAL_FILE_ROOT>/chunk_archive [--activate]
+    python scripts/fit_bm25.py --vectors <LOCAL_VECTOR_ROOT> [--activate]
+
+With --activate, the new parameters are written to bm25_current.txt, and every running Embeddor will hot-swap to them within a minute
+"""
+
+BATCH_SIZE = 500
+
+# Same settings as Embeddor.bm25_tokenizer_nostopwords and the prefitted parameters
+TOKENIZER_SETTINGS = {
+    "lower_case": True,
+    "remove_punctuation": True,
+    "remove_stopwords": True,
+    "stem": True,
+    "language": "english"
+}
+
+tokenizer:BM25Tokenizer = None
+
+def init_worker():
+    global tokenizer
+    tokenizer = BM25Tokenizer(**TOKENIZER_SETTINGS)
+
+def count_batch(texts:list[str]) -> tuple[Counter, int, int]:
+    """ Map step. Returns the document frequency of each token hash, the number of documents, and the total number of tokens """
+    doc_freq = Counter()
+    n_docs, n_tokens = 0, 0
+    for text in texts:
+        tokens = tokenizer(text)
+        # Same as BM25Encoder.fit(), documents without any tokens don't count
+        if not len(tokens): continue
+        n_docs += 1
+        n_tokens += len(tokens)
+        doc_freq.update(set([ mmh3.hash(token, signed=False) for token in tokens ]))
+    return doc_freq, n_docs, n_tokens
+
+def read_texts_from_chunks(chunks_dir:str):
+    """ Yields batches of texts from the chunk archive written by process_tdps.py """
+    chunk_archive = ChunkArchive(chunks_dir)
+    logger.info(f"Found {len(chunk_archive.list_shards())} chunk shards in {chunks_dir}")
+    yield from chunk_archive.iterate_texts(BATCH_SIZE)
+
+def read_texts_from_vectors(vectors_dir:str):
+    """ Yields batches of texts from the paragraph metadata of a LocalVectorClient """
+    with open(os.path.join(vectors_dir, "paragraph", "metadata.jsonl"), "r") as file:
+        batch = []
+        for line in file:
+            batch.append(json.loads(line)['metadata']['text'])
+            if len(batch) == BATCH_SIZE:
+                yield batch
+                batch = []
+        if len(batch): yield batch
+
+def fit(batches, n_processes:int=None) -> BM25Parameters:
+    doc_freq, n_docs, n_tokens = Counter(), 0, 0
+
+    # Reduce step. Sum the results of all batches as they come in
+    with Pool(processes=n_processes, initializer=init_worker) as pool:
+        for batch_doc_freq, batch_n_docs, batch_n_tokens in pool.imap_unordered(count_batch, batches):
+            doc_freq.update(batch_doc_freq)
+            n_docs += batch_n_docs
+            n_tokens += batch_n_tokens
+
+    if n_docs == 0:
+        raise ValueError("No documents found")
+
+    hashes = np.fromiter(doc_freq.keys(), dtype=np.uint32, count=len(doc_freq))
+    dfs = np.fromiter(doc_freq.values(), dtype=np.uint32, count=len(doc_freq))
+    order = np.argsort(hashes)
+
+    parameters = {
+        "avgdl": n_tokens / n_docs,
+        "n_docs": n_docs,
+        "b": 0.75,
+        "k1": 1.2,
+        **TOKENIZER_SETTINGS
+    }
+
+    return BM25Parameters(hashes[order], dfs[order], parameters)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Refit the BM25 parameters on the current corpus")
+    parser.add_argument("--chunks", type=str, help="Chunk archive directory written by process_tdps.py")
+    parser.add_argument("--vectors", type=str, help="Root directory of a LocalVectorClient")
+    parser.add_argument("--output", type=str, default=".", help="Directory to write the versioned parameter file to")
+    parser.add_argument("--processes", type=int, default=None, help="Number of worker processes. Defaults to the number of CPUs")
+    parser.add_argument("--activate", action="store_true", help=f"Point {BM25_CURRENT_FILEPATH} to the new parameters")
+    args = parser.parse_args()
+
+    if args.chunks is not None:
+        batches, source = read_texts_from_chunks(args.chunks), f"chunks:{args.chunks}"
+    elif args.vectors is not None:
+        batches, source = read_texts_from_vectors(args.vectors), f"vectors:{args.vectors}"
+    else:
+        parser.error("Either --chunks or --vectors is required")
+
+    t_start = time.time()
+    parameters = fit(batches, args.processes)
+
+    version = time.strftime("%Y%m%d_%H%M%S")
+    parameters.parameters['version'] = version
+    parameters.parameters['source'] = source
+
+    filepath = os.path.join(args.output, f"bm25_prefitted_on_chunks_{version}.npy")
+    parameters.save(filepath)
+    logger.info(f"Fitted BM25 on {parameters.n_docs} documents with {len(parameters.hashes)} unique tokens in {time.time()-t_start:.2f}s. avgdl={parameters.avgdl:.2f}")
+
+    if args.activate:
+        BM25Parameters.activate(filepath)
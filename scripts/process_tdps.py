@@ -2,16 +2,26 @@
 import os
 import sys
 sys.path.append(os.path.dirname(os.path.dirname(__file__)))
-import json
+import argparse
+from collections import Counter
+from concurrent.futures import Future
+import socket
+import threading
+import time
 # Third party libraries
 import numpy as np
+from scipy.sparse import coo_array
 # Local libraries
 from blacklist import blacklist
 from data_access.metadata.metadata_client import MongoDBClient
+from data_access.file.chunk_archive import ChunkArchive, CHUNK_ARCHIVE_DIR
 from data_access.file.file_client import LocalFileClient
 from data_access.llm.llm_client import OpenAIClient
+from data_access.llm.openai_scheduler import PRIORITY_INGESTION
 # from data_access.vector.weaviate_client import WeaviateClient
+from data_access.vector.client_interface import paragraph_chunk_hash, paragraph_chunk_vector_id, paragraph_chunk_vector_id_of_question, tdp_filename_of_paragraph_chunk_vector_id
 from data_access.vector.pinecone_client import PineconeClient
+from data_access.vector.vector_metadata_store import VectorMetadataStore
 from data_structures.Paragraph import Paragraph
 from data_structures.ParagraphChunk import ParagraphChunk
 from data_structures.ProcessStateEnum import ProcessStateEnum
@@ -21,7 +31,7 @@ from data_structures.TDPStructure import TDPStructure
 from embedding.Embeddings import instance as embeddor
 from extraction import extractor
 from MyLogger import logger
-from simple_profiler import SimpleProfiler
+from pipeline import Pipeline, Stage
 import startup
 from text_processing.text_processing import reconstruct_paragraph_text
 
@@ -87,32 +97,403 @@ def create_paragraph_chunks(paragraph:Paragraph, n_chars_per_group:int = 2000, n
     return chunks
 
 
+class TDPJob:
+    """ Tracks all pipeline tasks of a single TDP. Once the last task finishes, the process state of the TDP is set to COMPLETED, or to
+    FAILED if any task raised an exception. Once a task failed, the remaining tasks of the TDP are skipped """
+
+    def __init__(self, i_pdf:int, tdp_name:TDPName, worker_id:str=None, reingest:bool=False) -> None:
+        self.i_pdf = i_pdf
+        self.tdp_name = tdp_name
+        # Set in queue mode, where the TDP was claimed by this worker
+        self.worker_id = worker_id
+        # Set if the TDP was already completed, and only its changed chunks have to be stored. See diff_chunks()
+        self.reingest = reingest
+        self.lock = threading.Lock()
+        self.n_pending = 0
+        self.error:Exception = None
+
+    def submit(self, stage:Stage, function, *args) -> None:
+        with self.lock:
+            self.n_pending += 1
+        stage.submit(self.run, function, *args)
+
+    def track(self, future:Future) -> None:
+        """ Keeps the job open until the future is done, e.g. until the bulk writer upserted a vector """
+        with self.lock:
+            self.n_pending += 1
+        future.add_done_callback(lambda future: self.end(future.exception()))
+
+    def run(self, function, *args) -> None:
+        error = None
+        try:
+            if self.error is None:
+                function(self, *args)
+        except Exception as e:
+            error = e
+        finally:
+            self.end(error)
+
+    def end(self, error:Exception=None) -> None:
+        """ Marks one task as done """
+        if error is not None:
+            logger.error(f"Error processing PDF {self.tdp_name}: {error}")
+        with self.lock:
+            if self.error is None: self.error = error
+            self.n_pending -= 1
+            is_last = self.n_pending == 0
+        if is_last: self.finish()
+
+    def abort(self, error:Exception) -> None:
+        """ Skips all remaining tasks, e.g. when the lease on the TDP was lost """
+        with self.lock:
+            if self.error is None: self.error = error
+
+    def finish(self) -> None:
+        if self.error is not None:
+            count("n_exceptions")
+            self.release(ProcessStateEnum.FAILED, error=str(self.error))
+            return
+
+        self.release(ProcessStateEnum.COMPLETED)
+        count("n_tdps_completed")
+        logger.info(f"Completed {self.tdp_name}. Current costs: {embeddor.total_costs + llm_client.total_costs:.2f} (Embeddings: {embeddor.total_costs:.2f}  LLM: {llm_client.total_costs:.2f})")
+
+    def release(self, process_state:ProcessStateEnum, error:str=None) -> None:
+        """ Sets the final process state of the TDP. In queue mode, only if this worker still holds the lease """
+        if self.worker_id is None:
+            metadata_client.update_tdp_process_state(self.tdp_name, process_state, error=error)
+            return
+        leases.remove(self)
+        metadata_client.release_tdp(self.tdp_name, self.worker_id, process_state, error=error)
+
+class LeaseKeeper:
+    """ Queue mode. Renews the leases of all TDPs that this worker claimed, three times per lease. If a lease was lost, e.g. because
+    this worker stalled for longer than the lease and another worker claimed the TDP, the job is aborted """
+
+    def __init__(self, worker_id:str, lease_seconds:float) -> None:
+        self.worker_id = worker_id
+        self.lease_seconds = lease_seconds
+        self.jobs:set[TDPJob] = set()
+        self.lock = threading.Lock()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def add(self, job:TDPJob) -> None:
+        with self.lock:
+            self.jobs.add(job)
+
+    def remove(self, job:TDPJob) -> None:
+        with self.lock:
+            self.jobs.discard(job)
+
+    def run(self) -> None:
+        while True:
+            time.sleep(self.lease_seconds / 3)
+            with self.lock:
+                jobs = list(self.jobs)
+            for job in jobs:
+                try:
+                    if not metadata_client.renew_tdp_lease(job.tdp_name, self.worker_id, self.lease_seconds):
+                        logger.error(f"Lost the lease on {job.tdp_name}, aborting it")
+                        job.abort(Exception("Lost the lease"))
+                        self.remove(job)
+                except Exception as e:
+                    # E.g. a network hiccup. The lease is renewed again well before it expires
+                    logger.error(f"Could not renew the lease on {job.tdp_name}: {e}")
+
+def count(statistic:str, n:int=1) -> None:
+    with statistics_lock:
+        statistics[statistic] += n
+
+def prepare_tdp(i_pdf:int, tdp_name:TDPName) -> tuple[str | None, bool]:
+    """ Returns the filepath of the PDF if it has to be processed, and whether it is re-ingested. Removes any earlier, unfinished
+    processing of the TDP """
+    if tdp_name.filename in blacklist: return None, False
+
+    logger.info(f"Preparing PDF {i_pdf+1:3}/{len(pdfs)} : {tdp_name}")
+    pdf_filepath = file_client.get_pdf(tdp_name, no_copy=True)
+
+    tdp_db = metadata_client.find_tdp_by_name(tdp_name)
+
+    ### Check metadata if this TDP was already processed and if that succeeded
+    if tdp_db is not None:
+        # Already processed. Skip
+        if tdp_db.state['process_state'] == ProcessStateEnum.COMPLETED:
+            # Re-extract, and only store the chunks that changed
+            if args.reingest is not None and (not len(args.reingest) or tdp_name.filename in args.reingest):
+                logger.info(f"Re-ingesting {tdp_name}")
+                return pdf_filepath, True
+
+            # Sanity check. Count number of paragraphs and questions in vector database
+            n_paragraphs = len(vector_client.get_paragraph_chunks_by_tdpname(tdp_name))
+            n_questions = len(vector_client.get_questions_by_tdpname(tdp_name))
+            logger.info(f"Already processed {tdp_name} with {n_paragraphs} paragraphs and {n_questions} questions")
+            if n_paragraphs == 0 or n_questions == 0:
+                logger.info("Wait what...? No paragraphs or questions?")
+                input()
+            return None, False
+
+        # Somehow not completed. Remove and reprocess
+        error = False
+        error |= vector_client.delete_paragraph_chunks_by_tdpname(tdp_name)
+        error |= vector_client.delete_questions_by_tdpname(tdp_name)
+        if not error: metadata_client.delete_tdp_by_name(tdp_name)
+        if vector_metadata_store is not None: vector_metadata_store.delete_by_tdpname(tdp_name)
+        logger.info(f"Reprocessing {tdp_name}. State={tdp_db.state['process_state']}. Error={tdp_db.state['error']}")
+
+    return pdf_filepath, False
+
+def prepare_claimed_tdp(tdp_name:TDPName) -> str:
+    """ Queue mode. Returns the filepath of the PDF of a claimed TDP. Removes anything stored by an earlier attempt, e.g. of a worker
+    that crashed. The TDP itself stays in the metadata, since it holds the lease """
+    logger.info(f"Preparing claimed PDF {tdp_name}")
+    pdf_filepath = file_client.get_pdf(tdp_name, no_copy=True)
+    vector_client.delete_paragraph_chunks_by_tdpname(tdp_name)
+    vector_client.delete_questions_by_tdpname(tdp_name)
+    if vector_metadata_store is not None: vector_metadata_store.delete_by_tdpname(tdp_name)
+    return pdf_filepath
+
+def ingest_tdp(job:TDPJob, pdf_filepath:str, future_structure:Future) -> None:
+    """ Stage 'tdp'. Stores the extracted TDP, splits it into chunks, and submits the chunks to the other stages """
+    tdp_name = job.tdp_name
+
+    ### Parse. Failing to extract the PDF does not change the process state, since the TDP has not been inserted yet. In queue mode
+    ### it has, and the claim has to be released
+    try:
+        tdp_structure:TDPStructure = future_structure.result()
+    except Exception as e:
+        logger.error(f"Error processing PDF {tdp_name}: {e}")
+        count("n_exceptions")
+        if job.worker_id is not None: job.release(ProcessStateEnum.FAILED, error=str(e))
+        return
+
+    try:
+        pdf_filehash = file_client.get_filehash(tdp_name, ext=TDPName.PDF_EXT)
+        tdp = TDP(tdp_name=tdp_name, filehash=pdf_filehash, structure=tdp_structure, process_state=ProcessStateEnum.IN_PROGRESS)
+        tdp.propagate_information()
+
+        ### Store TDP in metadata. In queue mode, it was already stored by --enqueue. When re-ingesting, it is already stored as well
+        if job.reingest: metadata_client.update_tdp_process_state(tdp_name, ProcessStateEnum.IN_PROGRESS)
+        elif job.worker_id is None: metadata_client.insert_tdp(tdp)
+    except Exception as e:
+        count("n_exceptions")
+        logger.error(f"Error processing PDF {tdp_name}: {e}")
+        job.release(ProcessStateEnum.FAILED, error=str(e))
+        return
+
+    # From here on, the job sets the TDP to COMPLETED or FAILED once all its tasks are done
+    with job.lock:
+        job.n_pending += 1
+    job.run(ingest_paragraphs, tdp)
+
+def ingest_paragraphs(job:TDPJob, tdp:TDP) -> None:
+    logger.info(f"Processing {len(tdp.structure.paragraphs)} paragraphs of {tdp.tdp_name}")
+
+    ### Split each paragraph into chunks
+    paragraphs_chunks:list[list[ParagraphChunk]] = []
+    archive_chunks:list[dict] = []
+    for paragraph in tdp.structure.paragraphs:
+
+        n_tokens = embeddor.count_tokens(paragraph.content_raw())
+        n_chars = len(paragraph.content_raw())
+
+        if n_chars < 10: 
+            logger.info(f"    {paragraph.text_raw:50} {n_tokens:4} tokens    {n_chars:5} chars   SKIPPING")
+            continue
+
+        paragraph_chunks:list[ParagraphChunk] = create_paragraph_chunks(paragraph, n_chars_per_group=2000, n_chars_overlap=500)
+
+        logger.info(f"    {paragraph.text_raw:50} {n_tokens:>4} tokens    {n_chars:>5} chars    {len(paragraph_chunks):>2} chunks   {n_chars/n_tokens:10.2f} chars/token  {[ len(_.text) for _ in paragraph_chunks ]}")
+
+        # Reconstruct the paragraph from the chunks
+        reconstructed_text = reconstruct_paragraph_text(paragraph_chunks)
+        if paragraph.content_raw() != reconstructed_text:
+            logger.error("!!!!!!!!!!\nParagraph content raw\n")
+            logger.error(paragraph.content_raw())
+            logger.error("\nreconstructed text\n")
+            logger.error(reconstructed_text)
+            logger.error("\n\n")
+            print("!!!! Reconstruction failed !!!!")
+            raise Exception("Reconstruction failed")
+
+        # Archive chunks locally on disk, written once per TDP below
+        for chunk in paragraph_chunks:
+            archive_chunks.append({
+                'text': chunk.text,
+                'start': chunk.start,
+                'end': chunk.end,
+                'paragraph_sequence_id': chunk.paragraph_sequence_id,
+                'chunk_sequence_id': chunk.sequence_id,
+
+                'tdp_name': chunk.tdp_name.filename,
+                'paragraph_title': chunk.title,
+                'league': chunk.tdp_name.league.name,
+                'team': chunk.tdp_name.team_name.name,
+                'year': chunk.tdp_name.year
+            })
+
+        paragraphs_chunks.append(paragraph_chunks)
+
+    # Replaces the shard of this TDP as a whole, which also drops the chunks that no longer exist when re-ingesting
+    chunk_archive.write_tdp(tdp.tdp_name, archive_chunks)
+
+    if job.reingest:
+        paragraphs_chunks = diff_chunks(tdp.tdp_name, paragraphs_chunks)
+
+    ### Embed and store the chunks, and generate their questions
+    for paragraph_chunks in paragraphs_chunks:
+        if not len(paragraph_chunks): continue
+
+        # Create the sparse embeddings of all chunks at once
+        sparse_embeddings, _ = embeddor.embed_sparse_prefitted_bm25_batch([ chunk.text for chunk in paragraph_chunks ])
+
+        job.submit(stage_embed, embed_chunks, paragraph_chunks, sparse_embeddings)
+
+        for chunk in paragraph_chunks:
+            # Generate questions
+            n_questions = len(chunk.text) // 500
+            if 0 < n_questions:
+                job.submit(stage_llm, generate_questions, chunk, n_questions)
+
+def stored_chunk_hashes(tdp_name:TDPName) -> dict[str, str]:
+    """ Returns { vector id: chunk hash } of all chunks of the TDP in the vector database. Chunks stored before chunk hashes existed
+    have hash None, and are thus always treated as changed """
+    # Listing is by prefix, which can also match other TDPs whose filename starts with this one
+    ids = [ id for id in vector_client.get_paragraph_chunks_by_tdpname(tdp_name) if tdp_filename_of_paragraph_chunk_vector_id(id) == tdp_name.filename ]
+    return { id: metadata.get('chunk_hash') for id, metadata in vector_client.fetch_paragraph_chunks_metadata(ids).items() }
+
+def diff_chunks(tdp_name:TDPName, paragraphs_chunks:list[list[ParagraphChunk]]) -> list[list[ParagraphChunk]]:
+    """ Re-ingest. Compares the new chunks with the stored chunks by their hash. Deletes the chunks that no longer exist, and the questions
+    of all chunks that changed or no longer exist. Returns only the chunks that are new or changed, in the same structure. Changed chunks
+    keep their vector id, so storing them overwrites the old vectors """
+    stored = stored_chunk_hashes(tdp_name)
+    chunks = { paragraph_chunk_vector_id(chunk): chunk for paragraph_chunks in paragraphs_chunks for chunk in paragraph_chunks }
+    changed = set([ id for id, chunk in chunks.items() if stored.get(id) != paragraph_chunk_hash(chunk) ])
+    removed = [ id for id in stored if id not in chunks ]
+
+    # Questions are regenerated for changed chunks, and might be fewer than before. So all old questions of these chunks go
+    stale = changed | set(removed)
+    question_ids = [ id for id in vector_client.get_questions_by_tdpname(tdp_name) if paragraph_chunk_vector_id_of_question(id) in stale ]
+
+    # Delete before anything new is stored, since new questions can get the same ids as the old ones
+    vector_client.delete_paragraph_chunks_by_id(removed)
+    vector_client.delete_questions_by_id(question_ids)
+    if vector_metadata_store is not None:
+        vector_metadata_store.delete(VectorMetadataStore.TABLE_PARAGRAPH, removed)
+        vector_metadata_store.delete(VectorMetadataStore.TABLE_QUESTION, question_ids)
+
+    count("n_chunks_unchanged", len(chunks) - len(changed))
+    count("n_chunks_removed", len(removed))
+    logger.info(f"Re-ingesting {tdp_name}: {len(chunks) - len(changed)} chunks unchanged, {len(changed)} new or changed, {len(removed)} removed, {len(question_ids)} questions removed")
+
+    return [ [ chunk for chunk in paragraph_chunks if paragraph_chunk_vector_id(chunk) in changed ] for paragraph_chunks in paragraphs_chunks ]
+
+def embed_chunks(job:TDPJob, chunks:list[ParagraphChunk], sparse_embeddings) -> None:
+    """ Stage 'embed'. Creates the dense embeddings of all chunks of a paragraph in a single request """
+    dense_embeddings = embeddor.embed_dense_openai_batch([ chunk.text for chunk in chunks ], model="text-embedding-3-small")
+    for i_chunk, chunk in enumerate(chunks):
+        store_chunk(job, chunk, dense_embeddings[i_chunk], coo_array(sparse_embeddings[[i_chunk]]))
+
+def store_chunk(job:TDPJob, chunk:ParagraphChunk, dense_embedding:np.ndarray, sparse_embedding:coo_array) -> None:
+    # Buffered by the bulk writer. The job stays open until the vector is upserted
+    job.track(vector_writer.store_paragraph_chunk(chunk, dense_embedding, sparse_embedding))
+    if vector_metadata_store is not None: vector_metadata_store.store_paragraph_chunk(chunk)
+    count("n_chunks_stored")
+
+def generate_questions(job:TDPJob, chunk:ParagraphChunk, n_questions:int) -> None:
+    """ Stage 'llm'. Generates the specific and the generic questions that the chunk answers """
+    logger.info(f"Generating {n_questions} questions")
+    response_obj = llm_client.generate_paragraph_chunk_information(chunk, n_questions)
+
+    questions = [] # [ (question, question_id, kind, sparse_embedding) ]
+    for key, prefix, kind in [ ('questions_specific', "s", "specific"), ('questions_generic', "g", "generic") ]:
+        if key in response_obj and len(response_obj[key]):
+            sparse_embeddings_questions, _ = embeddor.embed_sparse_prefitted_bm25_batch(response_obj[key])
+            for i_question, question in enumerate(response_obj[key]):
+                questions.append((question, f"{prefix}{i_question}", kind, coo_array(sparse_embeddings_questions[[i_question]])))
+        else:
+            logger.info(f"No {kind} questions generated")
+
+    if len(questions):
+        job.submit(stage_embed, embed_questions, chunk, questions)
+
+def embed_questions(job:TDPJob, chunk:ParagraphChunk, questions:list[tuple[str, str, str, coo_array]]) -> None:
+    """ Stage 'embed'. Creates the dense embeddings of all questions of a chunk in a single request """
+    dense_embeddings = embeddor.embed_dense_openai_batch([ question for question, _, _, _ in questions ], model="text-embedding-3-small")
+    for (question, question_id, kind, sparse_embedding), dense_embedding in zip(questions, dense_embeddings):
+        store_question(job, chunk, question, question_id, kind, dense_embedding, sparse_embedding)
+
+def store_question(job:TDPJob, chunk:ParagraphChunk, question:str, question_id:str, kind:str, dense_embedding:np.ndarray, sparse_embedding:coo_array) -> None:
+    job.track(vector_writer.store_question(chunk, question, question_id, dense_embedding, sparse_embedding))
+    if vector_metadata_store is not None: vector_metadata_store.store_question(chunk, question, question_id)
+    count(f"n_questions_{kind}_stored")
+
+def progress() -> str:
+    with statistics_lock:
+        string = (f"TDPs completed {statistics['n_tdps_completed']}/{len(pdfs)}, exceptions {statistics['n_exceptions']}. "
+                  f"Stored {statistics['n_chunks_stored']} chunks ({statistics['n_chunks_unchanged']} unchanged, {statistics['n_chunks_removed']} removed), "
+                  f"{statistics['n_questions_specific_stored']} specific and "
+                  f"{statistics['n_questions_generic_stored']} generic questions. Costs {embeddor.total_costs + llm_client.total_costs:.2f}")
+    if embeddor.embedding_cache is not None:
+        string += f". Embedding cache hit rate {embeddor.embedding_cache.hit_rate():.1%}"
+    if llm_client.response_cache is not None:
+        string += f". LLM cache hit rate {llm_client.response_cache.hit_rate():.1%}"
+    if llm_client.scheduler is not None:
+        string += f"\n{llm_client.scheduler.report()}"
+    return string
+
+
+parser = argparse.ArgumentParser(description="Extract, chunk, embed and store all TDPs")
+parser.add_argument("--extract-workers", type=int, default=os.cpu_count(), help="Processes that extract PDFs")
+parser.add_argument("--tdp-workers", type=int, default=2, help="Threads that store and chunk extracted TDPs")
+parser.add_argument("--llm-workers", type=int, default=8, help="Threads that generate questions")
+parser.add_argument("--embed-workers", type=int, default=8, help="Threads that create dense embeddings")
+parser.add_argument("--upsert-workers", type=int, default=4, help="Threads of the bulk writer that upsert batches of vectors")
+parser.add_argument("--report-interval", type=float, default=30, help="Seconds between progress reports")
+parser.add_argument("--reingest", type=str, nargs="*", default=None, help="Re-extract completed TDPs, all or only the given filenames, and only store the chunks that changed")
+# Queue mode. Run --enqueue once, then start --queue workers on any number of machines that share the metadata and vector databases
+parser.add_argument("--enqueue", action="store_true", help="Add all PDFs that are not in the metadata yet as PENDING")
+parser.add_argument("--queue", action="store_true", help="Claim PENDING and FAILED TDPs from the metadata until there are none left")
+parser.add_argument("--worker-id", type=str, default=f"{socket.gethostname()}-{os.getpid()}", help="Name of this worker in the queue")
+parser.add_argument("--lease", type=float, default=600, help="Seconds that a claimed TDP stays claimed without a heartbeat")
+parser.add_argument("--max-attempts", type=int, default=3, help="Attempts per TDP, after which it stays FAILED")
+args = parser.parse_args()
+
 file_client:LocalFileClient = startup.get_file_client()
+chunk_archive:ChunkArchive = ChunkArchive(os.path.join(file_client.root_dir, CHUNK_ARCHIVE_DIR))
 metadata_client:MongoDBClient = startup.get_metadata_client()
 vector_client:PineconeClient = startup.get_vector_client()
-llm_client = OpenAIClient()
-
-profiler = SimpleProfiler()
+# Local copy of all vector metadata, used by search(). Only written when VECTOR_METADATA_STORE is set
+vector_metadata_store:VectorMetadataStore = startup.get_vector_metadata_store(read_only=False)
+# Ingestion leaves part of the rate limits to user queries, see openai_scheduler.py. Only applies when OPENAI_RATE_LIMITS is set
+llm_client = OpenAIClient(priority=PRIORITY_INGESTION)
+embeddor.priority = PRIORITY_INGESTION
 
 pdfs:list[TDPName] = file_client.list_pdfs()[0]
 logger.info(f"Found {len(pdfs)} PDFs")
 
-n_exceptions = 0
-total_n_tokens = []
-n_max_paragraph_tokens = 0
-paper_max_paragraph_tokens = 0
+statistics = Counter()
+statistics_lock = threading.Lock()
+# Heartbeats of the claimed TDPs. Only used in queue mode
+leases:LeaseKeeper = None
 
-n_chunks_stored = 0
-n_questions_specific_stored = 0
-n_questions_generic_stored = 0
+if args.enqueue:
+    n_enqueued = 0
+    for tdp_name in pdfs:
+        if tdp_name.filename in blacklist: continue
+        n_enqueued += metadata_client.enqueue_tdp(tdp_name, file_client.get_filehash(tdp_name, ext=TDPName.PDF_EXT))
+    logger.info(f"Enqueued {n_enqueued} new TDPs. Process states: {metadata_client.count_tdps_by_process_state()}")
+    if not args.queue: exit()
 
 logger.info(f"Paragraphs: {vector_client.count_paragraph_chunks()}    Questions: {vector_client.count_questions()}")
-if vector_client.count_paragraph_chunks() > 0 or vector_client.count_questions() > 0:
-    confirmation = input(f"Are you sure you want to process {len(pdfs)} PDFs? (y/n): ")
-    if confirmation.lower() != "y":
-        print("Exiting")
-        exit()
-exit()
+# Queue workers run unattended, and only process what was deliberately enqueued with --enqueue
+if not args.queue:
+    if vector_client.count_paragraph_chunks() > 0 or vector_client.count_questions() > 0:
+        confirmation = input(f"Are you sure you want to process {len(pdfs)} PDFs? (y/n): ")
+        if confirmation.lower() != "y":
+            print("Exiting")
+            exit()
+    # Safety guard against accidentally re-running a full ingestion. --reingest only stores the chunks that changed
+    if args.reingest is None: exit()
 
 # vector_client.delete_paragraph_chunks()
 # vector_client.delete_questions()
@@ -120,194 +501,68 @@ exit()
 # metadata_client.drop_tdps()
 # metadata_client.drop_paragraphs()
 
-for i_pdf, tdp_name in enumerate(pdfs):
-    try:
-        ### Load
-        if tdp_name.filename in blacklist: continue
-
-        logger.info(f"\n\n\n\n\nProcessing PDF {i_pdf+1:3}/{len(pdfs)} : {tdp_name}")
-        profiler.start("load pdf and hash")
-        pdf_filepath = file_client.get_pdf(tdp_name, no_copy=True)
-        pdf_filehash = file_client.get_filehash(tdp_name, ext=TDPName.PDF_EXT)
-        profiler.stop()
-
-        profiler.start("find tdp in metadata")
-        tdp_db = metadata_client.find_tdp_by_name(tdp_name)
-        profiler.stop()
-
-        ### Check metadata if this TDP was already processed and if that succeeded
-        if tdp_db is not None:
-            # Already processed. Skip
-            if tdp_db.state['process_state'] == ProcessStateEnum.COMPLETED:
-                # Sanity check. Count number of paragraphs and questions in vector database
-                n_paragraphs = len(vector_client.get_paragraph_chunks_by_tdpname(tdp_name))
-                n_questions = len(vector_client.get_questions_by_tdpname(tdp_name))
-                logger.info(f"Already processed {tdp_name} with {n_paragraphs} paragraphs and {n_questions} questions")
-                if n_paragraphs == 0 or n_questions == 0:
-                    logger.info("Wait what...? No paragraphs or questions?")
-                    input()
-                continue
-            
-            # Somehow not completed. Remove and reprocess
-            profiler.start("delete from database")
-            error = False
-            error |= vector_client.delete_paragraph_chunks_by_tdpname(tdp_name)
-            error |= vector_client.delete_questions_by_tdpname(tdp_name)
-            if not error: metadata_client.delete_tdp_by_name(tdp_name)
-            profiler.stop()
-            logger.info(f"Reprocessing {tdp_name}. State={tdp_db.state['process_state']}. Error={tdp_db.state['error']}")
-
-        ### Parse
+### Pipeline. Every stage only submits to stages further down this list, so that back-pressure can't deadlock
+# extract (processes) -> tdp -> llm -> embed -> bulk writer
+stage_extract = Stage("extract", args.extract_workers, use_processes=True)
+stage_tdp = Stage("tdp", args.tdp_workers)
+stage_llm = Stage("llm", args.llm_workers, max_pending=4*args.llm_workers)
+stage_embed = Stage("embed", args.embed_workers, max_pending=4*args.embed_workers)
+pipeline = Pipeline([ stage_extract, stage_tdp, stage_llm, stage_embed ])
+vector_writer = vector_client.bulk_writer(max_workers=args.upsert_workers)
+pipeline.start_reporting(args.report_interval, extra=progress)
+
+if args.queue:
+    leases = LeaseKeeper(args.worker_id, args.lease)
+    i_claimed = 0
+    while True:
+        metadata_client.requeue_expired_tdps(args.max_attempts)
+        # Claims one TDP at a time. Since submitting blocks while the extract stage is full, a worker never claims far ahead
+        tdp_claimed = metadata_client.claim_tdp(args.worker_id, args.lease, args.max_attempts)
+        if tdp_claimed is None: break
+
+        job = TDPJob(i_claimed, tdp_claimed.tdp_name, worker_id=args.worker_id)
+        leases.add(job)
+        i_claimed += 1
         try:
-            profiler.start("process pdf")
-            tdp_structure:TDPStructure = extractor.process_pdf(pdf_filepath)
-            duration = profiler.stop()
-            logger.info(f"Processed PDF in {duration:.2f} seconds")
+            pdf_filepath = prepare_claimed_tdp(job.tdp_name)
+            future_structure = stage_extract.submit(extractor.process_pdf, pdf_filepath)
+            stage_tdp.submit(ingest_tdp, job, pdf_filepath, future_structure)
         except Exception as e:
-            profiler.stop()
-            logger.error(f"Error processing PDF {tdp_name}: {e}")
-            n_exceptions += 1
-            continue
+            count("n_exceptions")
+            logger.error(f"Error processing PDF {job.tdp_name}: {e}")
+            job.release(ProcessStateEnum.FAILED, error=str(e))
+    logger.info(f"Worker {args.worker_id} found no more TDPs to claim, after claiming {i_claimed}")
 
-        tdp = TDP(tdp_name=tdp_name, filehash=pdf_filehash, structure=tdp_structure, process_state=ProcessStateEnum.IN_PROGRESS)
-        tdp.propagate_information()
+else:
+    for i_pdf, tdp_name in enumerate(pdfs):
+        try:
+            pdf_filepath, reingest = prepare_tdp(i_pdf, tdp_name)
+            if pdf_filepath is None: continue
 
-        ### Store TDP in metadata
-        profiler.start("insert metadata")
-        metadata_client.insert_tdp(tdp)
-        profiler.stop()
-
-        logger.info(f"Processing {len(tdp.structure.paragraphs)} paragraphs")
-
-        ### Process each paragraph
-        for paragraph in tdp.structure.paragraphs:
-
-            n_tokens = embeddor.count_tokens(paragraph.content_raw())
-            n_chars = len(paragraph.content_raw())
-
-            if n_chars < 10: 
-                logger.info(f"    {paragraph.text_raw:50} {n_tokens:4} tokens    {n_chars:5} chars   SKIPPING")
-                continue
-
-            paragraph_chunks:list[ParagraphChunk] = create_paragraph_chunks(paragraph, n_chars_per_group=2000, n_chars_overlap=500)
-
-            logger.info(f"    {paragraph.text_raw:50} {n_tokens:>4} tokens    {n_chars:>5} chars    {len(paragraph_chunks):>2} chunks   {n_chars/n_tokens:10.2f} chars/token  {[ len(_.text) for _ in paragraph_chunks ]}")
-
-            # Reconstruct the paragraph from the chunks
-            reconstructed_text = reconstruct_paragraph_text(paragraph_chunks)
-            if paragraph.content_raw() != reconstructed_text:
-                logger.error("!!!!!!!!!!\nParagraph content raw\n")
-                logger.error(paragraph.content_raw())
-                logger.error("\nreconstructed text\n")
-                logger.error(reconstructed_text)
-                logger.error("\n\n")
-                print("!!!! Reconstruction failed !!!!")
-                raise Exception("Reconstruction failed")
-
-            # Store chunks locally on disk
-            for i_chunk, chunk in enumerate(paragraph_chunks):
-                metadata = {
-                    'text': chunk.text,
-                    'start': chunk.start,
-                    'end': chunk.end,
-                    'paragraph_sequence_id': chunk.paragraph_sequence_id,
-                    'chunk_sequence_id': chunk.sequence_id,
-
-                    'tdp_name': chunk.tdp_name.filename,
-                    'paragraph_title': chunk.title,
-                    'league': chunk.tdp_name.league.name,
-                    'team': chunk.tdp_name.team_name.name,
-                    'year': chunk.tdp_name.year
-                }
-
-                chunk_filepath = os.path.join(
-                    file_client.root_dir,
-                    "chunks",
-                    chunk.tdp_name.to_filepath(TDPName.PDF_EXT)[:-4],
-                    f"{chunk.tdp_name}#{chunk.paragraph_sequence_id}__{chunk.sequence_id}.json"
-                )
-                os.makedirs(os.path.dirname(chunk_filepath), exist_ok=True)
-                with open(chunk_filepath, "w") as chunk_file:
-                    chunk_file.write(json.dumps(metadata, indent=4))
-            
-            # Store chunks in vector database
-            for i_chunk, chunk in enumerate(paragraph_chunks):
-                
-                # Create dense and sparse embedding on chunk text, and store in vector database
-                profiler.start("embed dense openai")
-                dense_embedding = embeddor.embed_dense_openai(chunk.text, model="text-embedding-3-small")
-                profiler.start("embed sparse pinecone")
-                sparse_embedding, _ = embeddor.embed_sparse_prefitted_bm25(chunk.text)
-                profiler.start("store paragraph chunk")
-                vector_client.store_paragraph_chunk(chunk, dense_embedding, sparse_embedding)
-                profiler.stop()
-                n_chunks_stored += 1
-                
-                # Generate questions
-                n_questions = len(chunk.text) // 500
-                if 0 < n_questions:
-                    logger.info(f"Generating {n_questions} questions")
-                    profiler.start("generate paragraph chunk info")
-                    response_obj = llm_client.generate_paragraph_chunk_information(chunk, n_questions)
-                    profiler.stop()
-
-                    if 'questions_specific' in response_obj:
-                        for i_question, question in enumerate(response_obj['questions_specific']):
-                            # print(f"        S? {question}")
-                            profiler.start("embed dense openai")
-                            dense_embedding = embeddor.embed_dense_openai(question, model="text-embedding-3-small")
-                            profiler.start("embed sparse pinecone")
-                            sparse_embedding, _ = embeddor.embed_sparse_prefitted_bm25(question)
-                            profiler.start("store question")
-                            vector_client.store_question(chunk, question, f"s{i_question}", dense_embedding, sparse_embedding)
-                            profiler.stop()
-                            n_questions_specific_stored += 1
-                    else:
-                        logger.info("No specific questions generated")
-
-                    if 'questions_generic' in response_obj:
-                        for i_question, question in enumerate(response_obj['questions_generic']):
-                            # print(f"        G? {question}")
-                            profiler.start("embed dense openai")
-                            dense_embedding = embeddor.embed_dense_openai(question, model="text-embedding-3-small")
-                            profiler.start("embed sparse pinecone")
-                            sparse_embedding, _ = embeddor.embed_sparse_prefitted_bm25(question)
-                            profiler.start("store question")
-                            vector_client.store_question(chunk, question, f"g{i_question}", dense_embedding, sparse_embedding)
-                            profiler.stop()
-                            n_questions_generic_stored += 1
-                    else:
-                        logger.info("No generic questions generated")
-
-        logger.info(f"Processed paragraphs")
-
-        profiler.start("update tdp process state")
-        metadata_client.update_tdp_process_state(tdp_name, ProcessStateEnum.COMPLETED)
-        profiler.stop()
-        logger.info(f"Current costs: {embeddor.total_costs + llm_client.total_costs:.2f} (Embeddings: {embeddor.total_costs:.2f}  LLM: {llm_client.total_costs:.2f})")
- 
-        if i_pdf % 10 == 0:
-            logger.info(f"Stored {n_chunks_stored} chunks over {len(pdfs)} PDFs")
-            logger.info(f"Stored {n_questions_specific_stored} specific questions")
-            logger.info(f"Stored {n_questions_generic_stored} generic questions")
-            logger.info(profiler.print_statistics())
+            # Blocks while the extract stage is full. The tdp stage waits for the extracted structure
+            future_structure = stage_extract.submit(extractor.process_pdf, pdf_filepath)
+            job = TDPJob(i_pdf, tdp_name, reingest=reingest)
+            stage_tdp.submit(ingest_tdp, job, pdf_filepath, future_structure)
 
-    except Exception as e:
-        n_exceptions += 1
-        logger.error(f"Error processing PDF {tdp_name}: {e}")
-        profiler.start("update tdp process state")
-        metadata_client.update_tdp_process_state(tdp_name, ProcessStateEnum.FAILED, error=str(e))
-        profiler.stop()
+        except Exception as e:
+            count("n_exceptions")
+            logger.error(f"Error processing PDF {tdp_name}: {e}")
+            metadata_client.update_tdp_process_state(tdp_name, ProcessStateEnum.FAILED, error=str(e))
 
-    profiler.print_statistics()
+pipeline.shutdown()
+# Upserts the remaining vectors. The last TDPs are completed once their vectors are upserted
+vector_writer.close()
+logger.info(pipeline.report())
 
 
 print("\n\n\n")
 for tdp_name in pdfs: logger.info(tdp_name.filename)
 print("\n")
 
-logger.info(f"Stored {n_chunks_stored} chunks over {len(pdfs)} PDFs")
-logger.info(f"Stored {n_questions_specific_stored} specific questions")
-logger.info(f"Stored {n_questions_generic_stored} generic questions")
+logger.info(progress())
 
 logger.info(f"Number of PDFS in metadata: {metadata_client.count_tdps()}")
+
+# The index changed. Mark all cached search results as stale, so that they are refreshed in the background when requested
+if 0 < statistics['n_chunks_stored']:
+    startup.get_cache_client().cache_client.bump_index_version()
@@ -0,0 +1,106 @@
+# System libraries
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+import argparse
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+# Local libraries
+import app
+from data_access.cache.cache_client import make_cache_key
+from data_access.vector.vector_filter import VectorFilter
+from embedding.Embeddings import instance as embeddor
+from MyLogger import logger
+from query_log import instance as query_log
+import search
+import startup
+
+""" Warms the cache after a deployment or after re-indexing, by replaying the most frequent queries from the query log (QUERY_LOG)
+against search() and llm(). Queries that are cached and not stale are skipped, unless --force is given.
+
+The replay runs with at most --concurrency queries in flight, and stops starting new queries once the OpenAI costs of this run reach
+--max-cost dollars. Queries that are already running when the budget is reached still finish, so the budget can be exceeded by at
+most --concurrency queries.
+
+Usage: python scripts/warmup_cache.py --top 200 --endpoint both --concurrency 4 --max-cost 1.00
+"""
+
+def current_costs() -> float:
+    return embeddor.total_costs + search.llm_client.total_costs
+
+def top_queries(endpoint:str, n:int, since_days:float) -> list[tuple[str, str, dict, int]]:
+    """ Returns the n most frequent (endpoint, query, filter, count) in the query log, counted per canonical cache key """
+    t_min = time.time() - since_days * 24 * 3600
+    counts, examples = Counter(), {}
+    for record in query_log.read():
+        if record['timestamp'] < t_min or record['cache'] == "error" or not record['query']: continue
+        if endpoint != "both" and record['endpoint'] != endpoint: continue
+
+        filter = VectorFilter.from_dict(record['filter'] or {})
+        key = (record['endpoint'], make_cache_key(record['query'], filter))
+        counts[key] += 1
+        examples[key] = (record['query'], record['filter'] or {})
+
+    return [ (key[0], *examples[key], count) for key, count in counts.most_common(n) ]
+
+def is_warm(endpoint:str, cache_key:str) -> bool:
+    # Directly on the MongoDB cache, so that the check does not count as a hit
+    cache_client = startup.get_cache_client().cache_client
+    if endpoint == "query":
+        cache_hit, timestamp = cache_client.find_query(cache_key, count_hit=False)
+        return cache_hit is not None and not app.is_stale(timestamp)
+    cache_hit, _ = cache_client.find_llm(cache_key, count_hit=False)
+    return cache_hit is not None
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay the most frequent queries from the query log to warm the cache")
+    parser.add_argument("--top", type=int, default=100, help="Number of queries to replay")
+    parser.add_argument("--endpoint", type=str, default="both", choices=["query", "llm", "both"])
+    parser.add_argument("--since-days", type=float, default=30, help="Only count queries from the last N days")
+    parser.add_argument("--concurrency", type=int, default=4, help="Maximum number of queries in flight")
+    parser.add_argument("--max-cost", type=float, default=1.00, help="OpenAI budget of this run in dollars")
+    parser.add_argument("--force", action="store_true", help="Also recompute queries that are cached and not stale")
+    args = parser.parse_args()
+
+    queries = top_queries(args.endpoint, args.top, args.since_days)
+    logger.info(f"Replaying the top {len(queries)} queries from {query_log.filepath}")
+
+    costs_start = current_costs()
+    statistics = Counter()
+    statistics_lock = threading.Lock()
+
+    def warm(endpoint:str, query:str, filter_dict:dict, count:int) -> None:
+        filter = VectorFilter.from_dict(filter_dict)
+        cache_key = make_cache_key(query, filter)
+
+        def count_as(status:str):
+            with statistics_lock: statistics[status] += 1
+
+        spent = current_costs() - costs_start
+        if args.max_cost <= spent:
+            return count_as("skipped_budget")
+
+        if not args.force and is_warm(endpoint, cache_key):
+            return count_as("already_warm")
+
+        t_start = time.time()
+        try:
+            if endpoint == "query":
+                app.query_flight.do(cache_key, app.run_query, query, filter, cache_key, force=args.force)
+            else:
+                app.llm_flight.do(cache_key, app.run_query_llm, query, filter, cache_key, force=args.force)
+        except Exception as e:
+            logger.error(f"Could not warm {endpoint} '{query}': {e}")
+            return count_as("failed")
+
+        logger.info(f"Warmed {endpoint:5} ({count:4}x) in {time.time()-t_start:5.2f}s, spent ${current_costs()-costs_start:.4f}: {cache_key}")
+        count_as("warmed")
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        for endpoint, query, filter_dict, count in queries:
+            executor.submit(warm, endpoint, query, filter_dict, count)
+
+    logger.info(f"Done. {dict(statistics)}. Spent ${current_costs()-costs_start:.4f} of ${args.max_cost:.2f}")
+    startup.get_cache_client().flush_hits()
@@ -2,7 +2,10 @@
 import os
 import sys
 sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+from concurrent.futures import ThreadPoolExecutor
 import itertools
+import time
+from typing import Iterator
 # Third party libraries
 from dotenv import load_dotenv
 load_dotenv()
@@ -11,18 +14,24 @@ import numpy as np
 from data_access.llm.llm_client import OpenAIClient
 from data_access.vector.pinecone_client import PineconeClient
 from data_access.vector.vector_filter import VectorFilter
+from data_access.vector.vector_metadata_store import VectorMetadataStore
 from data_structures.Paragraph import Paragraph
 from data_structures.ParagraphChunk import ParagraphChunk
 from data_structures.Sentence import Sentence
 from data_structures.TDPName import TDPName
 from embedding.Embeddings import instance as embeddor
 from MyLogger import logger
+from text_processing.context_packer import get_token_budget, pack_context
 from text_processing.text_processing import reconstruct_paragraph_text, split_text_into_sentences
 import re
 
 vector_client = PineconeClient(os.getenv("PINECONE_API_KEY"))
 llm_client = OpenAIClient()
 
+# Thread pool used by search() to fan out the embedding, index and metadata requests. These are all network bound, so threads
+# are sufficient. A single search() never has more than two requests in flight, so this allows for a few concurrent searches
+search_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="search")
+
 def summarize_by_sentence(text:str, keywords:list[str]) -> str:
 
     use_sentence = lambda sentence: any([ _.lower() in sentence.lower() for _ in keywords ])
@@ -110,67 +119,183 @@ def summarize(text:str, keywords:list[str], T=20, N=3) -> str:
 
     return " ... ".join(sentences)
 
-def llm(vector_client:PineconeClient, query:str, filter:VectorFilter=None, model:str="gpt-4o-mini") -> tuple[str, str]:
-    paragraphs, _ = search(vector_client, query, filter)
-    # Source offset is needed because sometimes, the paragraph also contains sources, e.g. "[0]" "[1]".
-    # The LLM gets confused when I say source [5] is e.g. TDP RoboTeam 2024, and then some paragraph also
-    # mentions [5] as source. The offset ensures that the sources that I add won't be in any paragraph.
-    SOURCE_OFFSET = 1000
-    llm_input = ""
-
-    sources = {}
-
-    llm_input += "\n"
+# Source offset is needed because sometimes, the paragraph also contains sources, e.g. "[0]" "[1]".
+# The LLM gets confused when I say source [5] is e.g. TDP RoboTeam 2024, and then some paragraph also
+# mentions [5] as source. The offset ensures that the sources that I add won't be in any paragraph.
+SOURCE_OFFSET = 1000
+
+# Map-reduce answering. With many paragraphs, the facts are first extracted from groups of MAP_REDUCE_GROUP_SIZE paragraphs in parallel,
+# and the answer is then generated from the facts only. See OpenAIClient.answer_question_map_reduce. 0 disables it
+MAP_REDUCE_MIN_PARAGRAPHS = int(os.getenv("LLM_MAP_REDUCE_MIN_PARAGRAPHS", 0))
+MAP_REDUCE_GROUP_SIZE = int(os.getenv("LLM_MAP_REDUCE_GROUP_SIZE", 5))
+MAP_REDUCE_MAX_WORKERS = int(os.getenv("LLM_MAP_REDUCE_MAX_WORKERS", 4))
+
+def build_llm_input_groups(paragraphs:list[Paragraph], model:str="gpt-4o-mini", group_size:int=None) -> tuple[list[str], dict[int, TDPName]]:
+    """ Returns the source texts for the LLM, and the TDP of every source id minus SOURCE_OFFSET. Paragraphs are packed by score into
+    the token budget of the model, see pack_context(). If a group_size is given, every source text holds at most group_size paragraphs,
+    otherwise there is a single source text """
+    source_lines, headers = [], []
     for i_paragraph, paragraph in enumerate(paragraphs):
-        llm_input = f"SOURCE : [{i_paragraph+SOURCE_OFFSET}] = {paragraph.tdp_name.filename}\n"
-        sources[i_paragraph] = paragraph.tdp_name
-    llm_input += "\n"
+        source_lines.append(f"SOURCE : [{i_paragraph+SOURCE_OFFSET}] = {paragraph.tdp_name.filename}\n")
+        headers.append("\n\n\n\n=============== NEW PARAGRAPH ================\n"
+            f"SOURCE : | id='[{i_paragraph+SOURCE_OFFSET}]', team='{paragraph.tdp_name.team_name.name_pretty}', year='{paragraph.tdp_name.year}', league='{paragraph.tdp_name.league.name_pretty}', paragraph='{paragraph.text_raw}' |\n")
+
+    # Every packed paragraph adds its source line, its header and its text. Source ids of skipped paragraphs are simply not used
+    packed = pack_context([ l + h for l, h in zip(source_lines, headers) ], [ paragraph.content_raw() for paragraph in paragraphs ], get_token_budget(model))
+
+    sources = { i_paragraph: paragraphs[i_paragraph].tdp_name for i_paragraph, _ in packed }
+
+    groups = [ packed ] if group_size is None else [ packed[i:i+group_size] for i in range(0, len(packed), group_size) ]
+
+    llm_inputs = []
+    for group in groups:
+        llm_input = "\n"
+        for i_paragraph, _ in group:
+            llm_input += source_lines[i_paragraph]
+        llm_input += "\n"
+
+        for i_paragraph, text in group:
+            llm_input += headers[i_paragraph]
+            llm_input += f"TEXT : | {text} |"
+        llm_inputs.append(llm_input)
+
+    return llm_inputs, sources
+
+def build_llm_input(paragraphs:list[Paragraph], model:str="gpt-4o-mini") -> tuple[str, dict[int, TDPName]]:
+    """ Returns the source text for the LLM, and the TDP of every source id minus SOURCE_OFFSET """
+    llm_inputs, sources = build_llm_input_groups(paragraphs, model)
+    return llm_inputs[0], sources
+
+def replace_sources(text:str, sources:dict[int, TDPName]) -> str:
+    """ Replace all [i] in the text with a link to the TDP of source i. Numbers that are not a source, e.g. a reference that the LLM
+    copied from a paragraph, are left as they are """
+    def to_link(match:re.Match) -> str:
+        source:TDPName = sources.get(int(match.group()[1:-1]) - SOURCE_OFFSET)
+        if source is None: return match.group()
+        return f"[({source.team_name.name_pretty}, {source.year}, {source.league.name_pretty})](#/tdp/{source.filename}?ref=llm) "
+    return re.sub(r"\[\d+\]", to_link, text)
+
+class SourceLinkRewriter:
+    """ Applies replace_sources() to a stream of text. A source id can be split over multiple tokens, e.g. "[10" "02]", so any
+    trailing text that could still become a source id is held back until the next piece of text arrives """
+
+    def __init__(self, sources:dict[int, TDPName]) -> None:
+        self.sources = sources
+        self.buffer = ""
+
+    def feed(self, text:str) -> str:
+        self.buffer += text
+        i_bracket = self.buffer.rfind("[")
+        if i_bracket != -1 and re.fullmatch(r"\[\d*", self.buffer[i_bracket:]):
+            complete, self.buffer = self.buffer[:i_bracket], self.buffer[i_bracket:]
+        else:
+            complete, self.buffer = self.buffer, ""
+        return replace_sources(complete, self.sources)
+
+    def flush(self) -> str:
+        complete, self.buffer = self.buffer, ""
+        return replace_sources(complete, self.sources)
+
+def llm(vector_client:PineconeClient, query:str, filter:VectorFilter=None, model:str="gpt-4o-mini", metadata_store:VectorMetadataStore=None, dense_vector:np.ndarray=None, timings:dict=None, map_reduce:bool=None) -> tuple[str, str]:
+    """ If a timings dict is given, the duration in seconds of every stage is stored in it. If map_reduce is None, it is used when
+    search() returns at least MAP_REDUCE_MIN_PARAGRAPHS paragraphs """
+    if timings is None: timings = {}
+    paragraphs, _ = search(vector_client, query, filter, metadata_store=metadata_store, dense_vector=dense_vector, timings=timings)
+    if map_reduce is None:
+        map_reduce = 0 < MAP_REDUCE_MIN_PARAGRAPHS <= len(paragraphs)
+
+    t_start = time.time()
+    if map_reduce:
+        llm_inputs, sources = build_llm_input_groups(paragraphs, model, MAP_REDUCE_GROUP_SIZE)
+        llm_input = "".join(llm_inputs)
+    else:
+        llm_input, sources = build_llm_input(paragraphs, model)
+    timings['llm_input'] = time.time() - t_start
 
-    for i_paragraph, paragraph in enumerate(paragraphs):
-        llm_input += "\n\n\n\n=============== NEW PARAGRAPH ================\n"
-        llm_input += f"SOURCE : | id='[{i_paragraph+SOURCE_OFFSET}]', team='{paragraph.tdp_name.team_name.name_pretty}', year='{paragraph.tdp_name.year}', league='{paragraph.tdp_name.league.name_pretty}', paragraph='{paragraph.text_raw}' |\n"
-        llm_input += f"TEXT : | {paragraph.content_raw()} |"
-
-    max_tokens = 0
-    if "3.5" in model: max_tokens = 16000
-    if "4o" in model: max_tokens = 128000
-
-    if 0 < max_tokens:
-        n_tokens = embeddor.count_tokens(llm_input)
-        ratio = n_tokens / max_tokens
-        if 1 < ratio:
-            logger.warning(f"LLM input is too long ({n_tokens} tokens). Ratio: {ratio:.2f}. Pruning")
-            llm_input = llm_input[:int(0.95 * len(llm_input)/ratio)]
-            logger.warning(f"LLM input is now {embeddor.count_tokens(llm_input)} tokens")
-            
-    llm_response = llm_client.answer_question(question=query, source_text=llm_input, model=model)
+    t_start = time.time()
+    if map_reduce:
+        llm_response = llm_client.answer_question_map_reduce(question=query, source_texts=llm_inputs, model=model, max_workers=MAP_REDUCE_MAX_WORKERS)
+    else:
+        llm_response = llm_client.answer_question(question=query, source_text=llm_input, model=model)
+    timings['llm'] = time.time() - t_start
     # llm_response = llm_client.answer_question(question=query, source_text=llm_input, model="gpt-4o")
 
-    # Replace all [i] with the actual text in the llm_response
-    matches = [ m for m in re.finditer(r"\[\d+\]", llm_response) ]
-
-    for m in matches[::-1]:
-        start, end = m.span()
-        source:TDPName = sources[int(llm_response[start+1:end-1])-SOURCE_OFFSET]
-        url = f"[({source.team_name.name_pretty}, {source.year}, {source.league.name_pretty})](#/tdp/{source.filename}?ref=llm) "
-        llm_response = llm_response[:start] + url + llm_response[end:]
+    llm_response = replace_sources(llm_response, sources)
 
     return llm_input, llm_response
 
-def search(vector_client:PineconeClient, query:str, filter:VectorFilter=None, compress_text=False) -> tuple[list[Paragraph], list[str]]:
+def llm_stream(vector_client:PineconeClient, query:str, filter:VectorFilter=None, model:str="gpt-4o-mini", metadata_store:VectorMetadataStore=None, dense_vector:np.ndarray=None, timings:dict=None) -> tuple[str, Iterator[str]]:
+    """ Same as llm(), but returns the LLM response as an iterator over pieces of text, in which the source ids are already replaced.
+    The search is done before this function returns. The time until the first piece of text is stored in timings['llm_first_token'] """
+    if timings is None: timings = {}
+    paragraphs, _ = search(vector_client, query, filter, metadata_store=metadata_store, dense_vector=dense_vector, timings=timings)
+    t_start = time.time()
+    llm_input, sources = build_llm_input(paragraphs, model)
+    timings['llm_input'] = time.time() - t_start
+
+    def stream() -> Iterator[str]:
+        t_start = time.time()
+        rewriter = SourceLinkRewriter(sources)
+        for delta in llm_client.answer_question_stream(question=query, source_text=llm_input, model=model):
+            text = rewriter.feed(delta)
+            if not len(text): continue
+            if 'llm_first_token' not in timings: timings['llm_first_token'] = time.time() - t_start
+            yield text
+        text = rewriter.flush()
+        if len(text): yield text
+        timings['llm'] = time.time() - t_start
+
+    return llm_input, stream()
+
+def resolve_matches(matches:list, metadatas:dict[str, dict]) -> list[dict] | None:
+    """ Attach the locally stored metadata to the matches of a query that was done with include_metadata=False. Returns None if
+    the metadata of any match is missing, e.g. because the vector was ingested before the metadata store existed """
+    if any([ match['id'] not in metadatas for match in matches ]):
+        return None
+    return [ { 'id': match['id'], 'score': match['score'], 'metadata': metadatas[match['id']] } for match in matches ]
+
+def search(vector_client:PineconeClient, query:str, filter:VectorFilter=None, compress_text=False, metadata_store:VectorMetadataStore=None, dense_vector:np.ndarray=None, timings:dict=None) -> tuple[list[Paragraph], list[str]]:
+    """ If a metadata_store is given, the vector database only returns ids and scores, and all metadata is resolved locally. If the
+    dense_vector of the query was already created by the caller, it is not created again. If a timings dict is given, the duration in
+    seconds of every stage is stored in it """
     if query is None or query == "": return [], []
+    if timings is None: timings = {}
 
-    dense_vector = embeddor.embed_dense_openai(query)
+    t_start = time.time()
+    # Create the sparse vector locally while the dense vector is being created by OpenAI
+    if dense_vector is None:
+        future_dense_vector = search_executor.submit(embeddor.embed_dense_openai, query)
     sparse_vector, keywords = embeddor.embed_sparse_prefitted_bm25(query, is_query=True)
     keywords = [ _ for _ in keywords.keys() if 0.1 < keywords[_] ]
+    if dense_vector is None:
+        dense_vector = future_dense_vector.result()
+    timings['embed'] = time.time() - t_start
 
     logger.debug(f"Query: {query}")
     logger.debug(f"Keywords: {keywords}")
     logger.debug(f"Filter: {filter}")
 
-    # Get paragraphs and questions from vector database
-    response_paragraph_chunks = vector_client.query_paragraph_chunks(dense_vector, sparse_vector, limit=30, filter=filter)
-    response_questions = vector_client.query_questions(dense_vector, sparse_vector, limit=60, filter=filter)
+    # Get paragraphs and questions from vector database, both at the same time
+    t_start = time.time()
+    include_metadata = metadata_store is None
+    future_paragraph_chunks = search_executor.submit(vector_client.query_paragraph_chunks, dense_vector, sparse_vector, limit=30, filter=filter, include_metadata=include_metadata)
+    future_questions = search_executor.submit(vector_client.query_questions, dense_vector, sparse_vector, limit=60, filter=filter, include_metadata=include_metadata)
+    response_paragraph_chunks = future_paragraph_chunks.result()
+    response_questions = future_questions.result()
+    timings['query_index'] = time.time() - t_start
+
+    t_start = time.time()
+
+    paragraph_chunk_matches = response_paragraph_chunks['matches'] # [ id, metadata, score, values ]
+    question_matches = response_questions['matches'] # [ id, metadata, score, values ]
+
+    if metadata_store is not None:
+        paragraph_chunk_matches = resolve_matches(paragraph_chunk_matches, metadata_store.fetch(VectorMetadataStore.TABLE_PARAGRAPH, [ _['id'] for _ in paragraph_chunk_matches ]))
+        question_matches = resolve_matches(question_matches, metadata_store.fetch(VectorMetadataStore.TABLE_QUESTION, [ _['id'] for _ in question_matches ]))
+        # The store is incomplete. Fall back to querying the vector database including metadata
+        if paragraph_chunk_matches is None or question_matches is None:
+            logger.warning("Vector metadata store is missing vectors. Falling back to the vector database")
+            return search(vector_client, query, filter, compress_text, dense_vector=dense_vector, timings=timings)
 
     """ Paragraph metadata:
     
@@ -204,8 +329,6 @@ def search(vector_client:PineconeClient, query:str, filter:VectorFilter=None, co
     paragraphs = {}
 
     # ================ PARAGRAPH CHUNKS ================
-    # Get paragraph chunks
-    paragraph_chunk_matches = response_paragraph_chunks['matches'] # [ id, metadata, score, values ]
     # Get the questions that are associated with the paragraph chunks
     vector_ids = [match['id'] for match in paragraph_chunk_matches]
 
@@ -213,8 +336,22 @@ def search(vector_client:PineconeClient, query:str, filter:VectorFilter=None, co
         logger.debug("No matches found. Returning empty results")        
         return [], []
 
-    # Get all questions from all paragraph chunks
-    paragraph_chunk_questions = vector_client.get_questions_metadata_by_id(vector_ids) # [ metadata ]
+    # Get the paragraph chunks that are associated with the questions
+    paragraph_chunk_ids_from_questions = list(set([f"{match['metadata']['tdp_name']}__{int(match['metadata']['paragraph_sequence_id'])}__{int(match['metadata']['chunk_sequence_id'])}" for match in question_matches]))
+
+    # Get all questions from all paragraph chunks, and all paragraph chunks from all questions
+    if metadata_store is not None:
+        paragraph_chunk_questions = metadata_store.get_questions_metadata_by_id(vector_ids) # [ metadata ]
+        question_paragraph_chunks = metadata_store.get_paragraph_chunks_metadata_by_id(paragraph_chunk_ids_from_questions) # [ metadata ]
+    else:
+        # Both at the same time
+        future_paragraph_chunk_questions = search_executor.submit(vector_client.get_questions_metadata_by_id, vector_ids)
+        future_question_paragraph_chunks = search_executor.submit(vector_client.get_paragraph_chunks_metadata_by_id, paragraph_chunk_ids_from_questions)
+        paragraph_chunk_questions = future_paragraph_chunk_questions.result() # [ metadata ]
+        question_paragraph_chunks = future_question_paragraph_chunks.result() # [ metadata ]
+    timings['fetch_metadata'] = time.time() - t_start
+
+    t_start = time.time()
     
     # For all paragraph chunks, prepare or add to the paragraph
     for i_match, match in enumerate(paragraph_chunk_matches):
@@ -234,13 +371,6 @@ def search(vector_client:PineconeClient, query:str, filter:VectorFilter=None, co
         paragraphs[paragraph_id]['questions'].append(metadata)
 
     # ================ QUESTIONS ================
-    # Get questions
-    question_matches = response_questions['matches'] # [ id, metadata, score, values ]
-    # Get the paragraph chunks that are associated with the questions
-    paragraph_chunk_ids_from_questions = list(set([f"{match['metadata']['tdp_name']}__{int(match['metadata']['paragraph_sequence_id'])}__{int(match['metadata']['chunk_sequence_id'])}" for match in question_matches]))
-    # Get all paragraph chunks from all questions
-    question_paragraph_chunks = vector_client.get_paragraph_chunks_metadata_by_id(paragraph_chunk_ids_from_questions) # [ metadata ]
-
     # For all paragraph chunks, prepare or add to the paragraph
     for i_paragraph, metadata in enumerate(question_paragraph_chunks):
         # print(f"{i_paragraph:2} ({question_matches[i_paragraph]['score']:.2f}): {metadata['text']}")
@@ -341,4 +471,6 @@ def search(vector_client:PineconeClient, query:str, filter:VectorFilter=None, co
         # SOURCES += f"TEXT : | {reconstructed_text} |"
     
 
+    timings['reconstruct'] = time.time() - t_start
+
     return reconstructed_paragraphs, keywords
\ No newline at end of file
@@ -0,0 +1,85 @@
+# System libraries
+import threading
+# Local libraries
+from MyLogger import logger
+
+class SingleFlight:
+    """ Coalesces concurrent calls with the same key. The first caller (the leader) executes the function, and every caller that
+    arrives with the same key while the leader is still running waits for it and receives the same result, or the same exception.
+    Once the leader is done the key is released, so later callers execute the function again (normally hitting the cache by then)
+
+    Works across threads, e.g. the request threads of Flask, or the thread pool in which an Azure Functions worker runs synchronous functions
+    """
+
+    class Call:
+        def __init__(self) -> None:
+            self.done = threading.Event()
+            self.result = None
+            self.exception:BaseException = None
+            self.n_waiting = 0
+
+    def __init__(self, name:str="") -> None:
+        self.name = name
+        self.lock = threading.Lock()
+        self.calls:dict[str, SingleFlight.Call] = {}
+
+    def do(self, key:str, function, *args, timeout:float=None, **kwargs):
+        """ Returns the result of function(*args, **kwargs), shared with all concurrent callers that use the same key. If the leader did
+        not finish within timeout seconds, the caller stops waiting and executes the function itself """
+        return self.do_shared(key, function, *args, timeout=timeout, **kwargs)[0]
+
+    def do_shared(self, key:str, function, *args, timeout:float=None, **kwargs) -> tuple[object, bool]:
+        """ Same as do(), but returns (result, shared). shared is True if the caller joined an in-flight call and received the result
+        of the leader, instead of executing the function itself """
+        with self.lock:
+            call = self.calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = self.calls[key] = SingleFlight.Call()
+            else:
+                call.n_waiting += 1
+
+        if not is_leader:
+            logger.info(f"[{self.name}] Waiting for in-flight call with key {key}")
+            if not call.done.wait(timeout):
+                logger.warning(f"[{self.name}] In-flight call with key {key} did not finish within {timeout}s. Executing it again")
+                return function(*args, **kwargs), False
+            if call.exception is not None:
+                raise call.exception
+            return call.result, True
+
+        try:
+            call.result = function(*args, **kwargs)
+            return call.result, False
+        except BaseException as e:
+            call.exception = e
+            raise
+        finally:
+            # Release the key before waking up the waiters, so that no new caller can join a call that already finished
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+            if call.n_waiting:
+                logger.info(f"[{self.name}] Shared the result of key {key} with {call.n_waiting} waiting callers")
+
+    def in_flight(self) -> int:
+        with self.lock:
+            return len(self.calls)
+
+if __name__ == "__main__":
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+
+    flight = SingleFlight("demo")
+    n_executions = 0
+
+    def slow_square(x:int) -> int:
+        global n_executions
+        n_executions += 1
+        time.sleep(0.5)
+        return x * x
+
+    with ThreadPoolExecutor(max_workers=10) as executor:
+        results = list(executor.map(lambda _: flight.do("key", slow_square, 4), range(10)))
+
+    print(f"Results: {results}. Executions: {n_executions}")
@@ -10,20 +10,25 @@ from telegram import Bot
 from data_access.metadata.metadata_client import MongoDBClient as MetadataClient
 from data_access.file.file_client import AzureFileClient, LocalFileClient
 from data_access.vector.pinecone_client import PineconeClient
-from data_access.cache.cache_client import MongoDBClient as CacheClient
+from data_access.vector.local_client import LocalVectorClient
+from data_access.vector.vector_metadata_store import VectorMetadataStore
+from data_access.cache.cache_client import MongoDBClient as CacheClient, TwoTierCacheClient
+from data_access.cache.semantic_cache import SemanticCache
 from MyLogger import logger
 from simple_profiler import SimpleProfiler
 
 metadata_client = None
 file_client = None
 vector_client = None
+vector_metadata_store = None
 cache_client = None
+semantic_cache = None
 telegram_bot = None
 telegram_chat_id = None
 
 profiler = SimpleProfiler()
 
-def get_clients() -> tuple[MetadataClient, AzureFileClient|LocalFileClient, PineconeClient]:
+def get_clients() -> tuple[MetadataClient, AzureFileClient|LocalFileClient, PineconeClient|LocalVectorClient]:
     # TODO remove this function in favor of individual client getters
     global metadata_client, file_client, vector_client
 
@@ -45,7 +50,7 @@ def get_clients() -> tuple[MetadataClient, AzureFileClient|LocalFileClient, Pine
     metadata_client = MetadataClient(os.getenv("MONGODB_CONNECTION_STRING"))
 
     profiler.start("[get_clients] initialize vector client")
-    vector_client = PineconeClient(os.getenv("PINECONE_API_KEY"))
+    vector_client = create_vector_client()
 
     profiler.stop()
     
@@ -85,7 +90,7 @@ def get_file_client() -> AzureFileClient|LocalFileClient:
 
     return file_client
 
-def get_vector_client() -> PineconeClient:
+def get_vector_client() -> PineconeClient|LocalVectorClient:
     global vector_client
 
     if vector_client is not None:
@@ -93,13 +98,46 @@ def get_vector_client() -> PineconeClient:
 
     ENVIRONMENT:str = get_environment()
 
-    vector_client = PineconeClient(os.getenv("PINECONE_API_KEY"))
+    vector_client = create_vector_client()
 
     logger.info(f"Vector client for environment {ENVIRONMENT} initialized successfully")
 
     return vector_client
 
-def get_cache_client() -> CacheClient:
+def create_vector_client() -> PineconeClient|LocalVectorClient:
+    # Set VECTOR_CLIENT=LOCAL to answer all queries in process from the vectors stored in LOCAL_VECTOR_ROOT, instead of Pinecone
+    VECTOR_CLIENT = os.getenv("VECTOR_CLIENT", "PINECONE").upper()
+
+    if VECTOR_CLIENT == "LOCAL":
+        return LocalVectorClient(os.getenv("LOCAL_VECTOR_ROOT", "vectors"))
+    if VECTOR_CLIENT == "PINECONE":
+        return PineconeClient(os.getenv("PINECONE_API_KEY"))
+
+    raise ValueError("Invalid vector client")
+
+def get_vector_metadata_store(read_only:bool=True) -> VectorMetadataStore|None:
+    """ Returns the local vector metadata store at VECTOR_METADATA_STORE, or None if it is not configured. The API opens it read-only,
+    and only if it exists, in which case search() resolves all metadata from it. process_tdps.py opens it writable """
+    global vector_metadata_store
+
+    if vector_metadata_store is not None and (read_only or not vector_metadata_store.read_only):
+        return vector_metadata_store
+
+    VECTOR_METADATA_STORE = os.getenv("VECTOR_METADATA_STORE")
+    if VECTOR_METADATA_STORE is None:
+        return None
+
+    if read_only and not os.path.isfile(VECTOR_METADATA_STORE):
+        logger.warning(f"Vector metadata store {VECTOR_METADATA_STORE} does not exist. Fetching metadata from the vector database")
+        return None
+
+    vector_metadata_store = VectorMetadataStore(VECTOR_METADATA_STORE, read_only=read_only)
+
+    logger.info(f"Vector metadata store {VECTOR_METADATA_STORE} opened successfully (read_only={read_only})")
+
+    return vector_metadata_store
+
+def get_cache_client() -> TwoTierCacheClient:
     global cache_client
 
     if cache_client is not None:
@@ -107,12 +145,48 @@ def get_cache_client() -> CacheClient:
 
     ENVIRONMENT:str = get_environment()
 
-    cache_client = CacheClient(os.getenv("MONGODB_CONNECTION_STRING"))
+    # In-process LRU cache in front of the MongoDB cache
+    cache_client = TwoTierCacheClient(
+        CacheClient(
+            os.getenv("MONGODB_CONNECTION_STRING"),
+            ttl_query=float(os.getenv("CACHE_QUERY_TTL_DAYS", 30)) * 24 * 3600,
+            ttl_llm=float(os.getenv("CACHE_LLM_TTL_DAYS", 90)) * 24 * 3600,
+            max_queries=int(os.getenv("CACHE_QUERY_MAX_ENTRIES", 50000)),
+            max_llms=int(os.getenv("CACHE_LLM_MAX_ENTRIES", 20000)),
+            max_query_bytes=int(os.getenv("CACHE_QUERY_MAX_MB", 256)) * 1024 * 1024,
+            max_llm_bytes=int(os.getenv("CACHE_LLM_MAX_MB", 256)) * 1024 * 1024
+        ),
+        max_entries=int(os.getenv("CACHE_LRU_MAX_ENTRIES", 1000)),
+        max_bytes=int(os.getenv("CACHE_LRU_MAX_MB", 64)) * 1024 * 1024,
+        ttl=float(os.getenv("CACHE_LRU_TTL", 600))
+    )
 
     logger.info(f"Cache client for environment {ENVIRONMENT} initialized successfully")
 
     return cache_client
 
+def get_semantic_cache() -> SemanticCache|None:
+    """ Returns the semantic cache for LLM answers, filled with the embeddings stored in the cache database. Returns None unless
+    SEMANTIC_CACHE_THRESHOLD is set """
+    global semantic_cache
+
+    if semantic_cache is not None:
+        return semantic_cache
+
+    # SEMANTIC_CACHE_THRESHOLD: minimum cosine similarity (0 to 1) between two queries under the same filter to share an LLM answer. Off
+    # by default: no threshold has been evaluated yet, and queries that only differ in a team or year can score above 0.9 with
+    # text-embedding-3-small. Before enabling it, check the similarity that the log shows for every semantic hit on real queries
+    SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", 0))
+    if SEMANTIC_CACHE_THRESHOLD <= 0:
+        return None
+
+    semantic_cache = SemanticCache(threshold=SEMANTIC_CACHE_THRESHOLD)
+    semantic_cache.load(get_cache_client().find_llm_embeddings(limit=10000))
+
+    logger.info(f"Semantic cache initialized successfully with threshold {SEMANTIC_CACHE_THRESHOLD}")
+
+    return semantic_cache
+
 def get_telegram_bot() -> Bot:
     global telegram_bot
     global telegram_chat_id
@@ -0,0 +1,118 @@
+# System libraries
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+# Local libraries
+from embedding.Embeddings import instance as embeddor
+from MyLogger import logger
+from text_processing.text_processing import split_text_into_sentences
+
+# Maximum number of tokens of the LLM input, per model. This is the context window minus room for the system prompt and the answer
+LLM_INPUT_BUDGETS = {
+    "3.5": 16_385 - 4_096 - 1_000,
+    "4o": 128_000 - 16_384 - 1_000,
+}
+
+# Sentences shorter than this are never removed as duplicates. Short sentences such as "Fig. 3" or "Results" repeat naturally
+MIN_DEDUPLICATE_LENGTH = 30
+
+def get_token_budget(model:str) -> int | None:
+    """ Returns the token budget of the LLM input for the given model. LLM_INPUT_MAX_TOKENS lowers it for every model, e.g. to reduce
+    costs. Returns None if there is no budget """
+    budget = None
+    for model_substring, model_budget in LLM_INPUT_BUDGETS.items():
+        if model_substring in model: budget = model_budget
+
+    max_tokens = os.getenv("LLM_INPUT_MAX_TOKENS")
+    if max_tokens is not None:
+        budget = int(max_tokens) if budget is None else min(budget, int(max_tokens))
+
+    return budget
+
+def normalize_sentence(sentence:str) -> str:
+    return " ".join(sentence.lower().split())
+
+def sentence_starts(text:str, sentences:list[str]) -> list[int]:
+    """ Returns the position of every sentence in the text. The sentences of split_text_into_sentences() are stripped substrings of the
+    text, in order """
+    starts, position = [], 0
+    for sentence in sentences:
+        position = text.find(sentence, position)
+        starts.append(position)
+        position += len(sentence)
+    return starts
+
+def remove_sentences(text:str, sentences:list[str], keep:list[bool]) -> str:
+    """ Removes the sentences that are not kept from the text, together with the whitespace that follows them. Everything else,
+    including newlines between the kept sentences, is left as it is """
+    if all(keep): return text
+    starts = sentence_starts(text, sentences)
+    ends = starts[1:] + [len(text)]
+    return (text[:starts[0]] + "".join([ text[start:end] for start, end, is_kept in zip(starts, ends, keep) if is_kept ])).rstrip()
+
+def pack_context(headers:list[str], texts:list[str], budget:int=None, n_tokens_fixed:int=0) -> list[tuple[int, str]]:
+    """ Select the paragraphs that go into the LLM input. Paragraphs must be given sorted by score, high to low. Each paragraph is a
+    header, e.g. its source, and a text. Paragraphs are packed greedily: a paragraph that does not fit the budget is skipped, and a later,
+    smaller paragraph can still fit. Paragraphs are never cut.
+
+    Sentences that already occur in a packed paragraph are removed from the text, e.g. overlap between chunks that search() did not
+    reconstruct into a single text, or text that occurs in multiple TDPs. n_tokens_fixed is the number of tokens of the LLM input that
+    are not part of any paragraph.
+
+    Returns [ (index of the paragraph, deduplicated text) ] in the original order
+    """
+    sentences = [ split_text_into_sentences(text) for text in texts ]
+
+    # Count all tokens in a single batch. The token count of a text is about the sum of the token counts of its sentences
+    sentences_flat = [ sentence for paragraph_sentences in sentences for sentence in paragraph_sentences ]
+    n_tokens_flat = embeddor.count_tokens_batch(headers + sentences_flat)
+    n_tokens_headers, n_tokens_sentences = n_tokens_flat[:len(headers)], n_tokens_flat[len(headers):]
+
+    packed = []
+    seen = set()
+    n_tokens_used = n_tokens_fixed
+    n_sentences_removed, n_paragraphs_skipped = 0, 0
+
+    i_sentence = 0
+    for i_paragraph, paragraph_sentences in enumerate(sentences):
+        paragraph_n_tokens = n_tokens_sentences[i_sentence:i_sentence+len(paragraph_sentences)]
+        i_sentence += len(paragraph_sentences)
+
+        keep, kept_normalized, n_tokens = [], [], n_tokens_headers[i_paragraph]
+        for sentence, sentence_n_tokens in zip(paragraph_sentences, paragraph_n_tokens):
+            normalized = normalize_sentence(sentence)
+            if MIN_DEDUPLICATE_LENGTH <= len(normalized):
+                if normalized in seen or normalized in kept_normalized:
+                    keep.append(False)
+                    continue
+                kept_normalized.append(normalized)
+            keep.append(True)
+            # +1 for the whitespace between the sentences
+            n_tokens += sentence_n_tokens + 1
+
+        if not any(keep): continue
+
+        if budget is not None and budget < n_tokens_used + n_tokens:
+            n_paragraphs_skipped += 1
+            continue
+
+        n_sentences_removed += keep.count(False)
+        seen.update(kept_normalized)
+        n_tokens_used += n_tokens
+        # The text is cut from the original, so that newlines, e.g. of lists and tables, reach the LLM unchanged
+        packed.append((i_paragraph, remove_sentences(texts[i_paragraph], paragraph_sentences, keep)))
+
+    if n_sentences_removed or n_paragraphs_skipped:
+        logger.info(f"Packed {len(packed)}/{len(texts)} paragraphs in {n_tokens_used} tokens (budget {budget}). Removed {n_sentences_removed} duplicate sentences")
+
+    return packed
+
+if __name__ == "__main__":
+    headers = [ "SOURCE : | id='[1000]' |", "SOURCE : | id='[1001]' |", "SOURCE : | id='[1002]' |" ]
+    texts = [
+        "The dribbler uses a brushless motor. The motor is driven at 12 volts by a custom ESC on the main board.",
+        "The motor is driven at 12 volts by a custom ESC on the main board. The dribbler bar is made of silicone.\n- Bar: 10 mm\n- Motor: 50 W",
+        "The kicker is a solenoid. " * 50,
+    ]
+    for i_paragraph, text in pack_context(headers, texts, budget=120):
+        print(f"{i_paragraph}: {text}")